@@ -0,0 +1,295 @@
+#
+# Copyright 2017 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+
+"""
+Coalescing of Content operations.
+Requests waiting for the rpm lock are queued in arrival order.  The
+thread that gets the lock takes the request at the head of the queue
+together with the consecutive compatible requests and dispatches them
+as one operation (one yum transaction).  The report is then split into
+a reply for each request.  When the merged operation fails, the requests are dispatched
+one by one so that a failure is reported only to the request causing it.
+Each request keeps the cancellation of the thread that queued it: an
+operation is cancelled when any of its requests is, so that a merged
+operation cancelled by one request is retried separately for the others.
+"""
+
+import sys
+
+from copy import deepcopy
+from logging import getLogger
+from threading import Lock, local
+
+
+log = getLogger(__name__)
+
+
+# Operations that may be merged.
+MERGED = ('install', 'update')
+
+# The content type whose report is split by package name.
+RPM = 'rpm'
+
+
+class Request(object):
+    """
+    A queued Content operation.
+    :ivar method: The dispatcher method.
+    :type method: str
+    :ivar units: The content units.
+    :type units: list
+    :ivar options: The operation options.
+    :type options: dict
+    :ivar reply: The report (dict).
+    :type reply: dict
+    :ivar exception: The exception raised by the dispatcher.
+    :type exception: Exception
+    :ivar done: The request has been processed.
+    :type done: bool
+    :ivar cancelled: Returns whether the request has been cancelled.
+    :type cancelled: callable
+    """
+
+    def __init__(self, method, units, options, cancelled=None):
+        self.method = method
+        self.units = units
+        self.options = options
+        self.cancelled = cancelled or (lambda: False)
+        self.reply = None
+        self.exception = None
+        self.done = False
+
+    def compatible(self, other):
+        """
+        Get whether the request can be merged with another.
+        Requests without units (update all) are never merged.
+        :param other: Another request.
+        :type other: Request
+        :rtype: bool
+        """
+        return \
+            self.method in MERGED and \
+            self.method == other.method and \
+            bool(self.units) and bool(other.units) and \
+            self.options == other.options
+
+    def names(self):
+        """
+        Get the names of the requested packages.
+        :rtype: set
+        """
+        names = set()
+        for unit in self.units:
+            if unit.get('type_id') != RPM:
+                continue
+            name = (unit.get('unit_key') or {}).get('name')
+            if name:
+                names.add(name)
+        return names
+
+
+def split(report, batch):
+    """
+    Split the report of a merged operation into a reply per request.
+    The resolved packages are reported to the request naming them, the
+    dependencies and the packages not named by any request to the first
+    request.  The details of other content types are reported to each
+    request.
+    :param report: The report (dict) of the merged operation.
+    :type report: dict
+    :param batch: The merged requests.
+    :type batch: list
+    :return: A reply per request.
+    :rtype: list
+    """
+    names = [r.names() for r in batch]
+    replies = []
+    for index in range(len(batch)):
+        reply = deepcopy(report)
+        replies.append(reply)
+        rpm = reply.get('details', {}).get(RPM)
+        if not isinstance(rpm, dict) or not isinstance(rpm.get('details'), dict):
+            continue
+        details = rpm['details']
+        resolved = []
+        for package in details.get('resolved', []):
+            owner = 0
+            for n, requested in enumerate(names):
+                if package.get('name') in requested:
+                    owner = n
+                    break
+            if owner == index:
+                resolved.append(package)
+        details['resolved'] = resolved
+        if index and 'deps' in details:
+            details['deps'] = []
+        if 'num_changes' in rpm:
+            changes = len(resolved) + len(details.get('deps', []))
+            if 'num_changes' in reply:
+                reply['num_changes'] += changes - rpm['num_changes']
+            rpm['num_changes'] = changes
+    return replies
+
+
+class Coalescer(object):
+    """
+    Serializes and coalesces Content operations.
+    :ivar lock: The rpm lock.
+    :ivar dispatch: Called as dispatch(method, units, options) to perform
+        an operation and return its report (dict).
+    :type dispatch: callable
+    :ivar queue: The waiting requests.
+    :type queue: list
+    :ivar cancellation: Called on the requesting thread to get a function
+        returning whether the request has been cancelled.
+    :type cancellation: callable
+    :ivar running: The requests dispatched by the current thread.
+    :type running: threading.local
+    """
+
+    def __init__(self, lock, dispatch, cancellation=None):
+        """
+        :param lock: The rpm lock.
+        :param dispatch: Called as dispatch(method, units, options).
+        :type dispatch: callable
+        :param cancellation: Called on the requesting thread to get a
+            function returning whether the request has been cancelled.
+        :type cancellation: callable
+        """
+        self.lock = lock
+        self.dispatch = dispatch
+        self.cancellation = cancellation or (lambda: None)
+        self.queue = []
+        self.mutex = Lock()
+        self.running = local()
+
+    def __call__(self, method, units, options, coalesce=True):
+        """
+        Perform an operation.
+        :param method: The dispatcher method.
+        :type method: str
+        :param units: The content units.
+        :type units: list
+        :param options: The operation options.
+        :type options: dict
+        :param coalesce: Merge with the other waiting requests.
+        :type coalesce: bool
+        :return: The report.
+        :rtype: dict
+        """
+        request = Request(method, units, options, cancelled=self.cancellation())
+        return self.perform(request, coalesce)
+
+    def perform(self, request, coalesce):
+        """
+        Queue a request and wait until it has been processed.
+        :param request: The request.
+        :type request: Request
+        :param coalesce: Merge with the other waiting requests.
+        :type coalesce: bool
+        :return: The reply.
+        """
+        self.mutex.acquire()
+        try:
+            self.queue.append(request)
+        finally:
+            self.mutex.release()
+        while not request.done:
+            self.lock.acquire()
+            try:
+                if request.done:
+                    # processed in a batch taken by another thread
+                    break
+                batch = self.take(coalesce)
+                if batch:
+                    self.run(batch)
+            finally:
+                self.lock.release()
+        if request.exception is not None:
+            raise request.exception
+        return request.reply
+
+    def take(self, coalesce=True):
+        """
+        Take the request at the head of the queue and the consecutive
+        requests compatible with it.
+        :param coalesce: Take more than one request.
+        :type coalesce: bool
+        :return: The requests taken.
+        :rtype: list
+        """
+        self.mutex.acquire()
+        try:
+            if not self.queue:
+                return []
+            batch = [self.queue.pop(0)]
+            while coalesce and self.queue and batch[0].compatible(self.queue[0]):
+                batch.append(self.queue.pop(0))
+            return batch
+        finally:
+            self.mutex.release()
+
+    def cancelled(self):
+        """
+        Get whether the operation dispatched by the current thread has
+        been cancelled, that is, any of its requests.
+        :rtype: bool
+        """
+        for request in getattr(self.running, 'batch', []):
+            if request.cancelled():
+                return True
+        return False
+
+    def dispatched(self, batch, fn, *args):
+        """
+        Call fn while the batch is dispatched by the current thread.
+        :param batch: The requests.
+        :type batch: list
+        :param fn: The function.
+        :type fn: callable
+        :return: What fn returned.
+        """
+        self.running.batch = batch
+        try:
+            return fn(*args)
+        finally:
+            self.running.batch = []
+
+    def run(self, batch):
+        """
+        Dispatch the requests as one operation.
+        :param batch: The requests.
+        :type batch: list
+        """
+        if len(batch) > 1:
+            first = batch[0]
+            units = []
+            for request in batch:
+                units.extend(request.units)
+            try:
+                report = self.dispatched(batch, self.dispatch, first.method, units, first.options)
+                if report.get('succeeded'):
+                    for request, reply in zip(batch, split(report, batch)):
+                        request.reply = reply
+                        request.done = True
+                    return
+                log.info('merged %s of %d requests failed, retried separately', first.method, len(batch))
+            except Exception:
+                log.exception('merged %s of %d requests failed', first.method, len(batch))
+        for request in batch:
+            try:
+                request.reply = self.dispatched(
+                    [request], self.dispatch, request.method, request.units, request.options)
+            except Exception:
+                request.exception = sys.exc_info()[1]
+            request.done = True
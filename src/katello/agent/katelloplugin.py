@@ -20,21 +20,36 @@ import os
 import sys
 import httplib
 
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from functools import wraps
+from threading import Thread, RLock, Condition, Lock
+
 sys.path.append('/usr/share/rhsm')
 sys.path.append('/usr/lib/yum-plugins')
 
 from yum import YumBase
-from time import sleep
+from time import sleep, time
 from logging import getLogger, Logger
 from subprocess import Popen
 
-from gofer.decorators import initializer, remote, action
+from gofer.decorators import initializer, remote
 from gofer.agent.plugin import Plugin
-from gofer.pmon import PathMonitor
 from gofer.agent.rmi import Context
 from gofer.config import Config
 
 import enabled_repos_upload
+import package_upload
+
+from katello import spans
+from katello.agent import pmon, reply
+from katello.agent.coalesce import Coalescer
+from katello.breaker import Breaker, CircuitOpen
+from katello.connection import certificate_digest
+from katello.agent.worker import Worker
 
 try:
     from subscription_manager.identity import ConsumerIdentity
@@ -50,12 +65,28 @@ from pulp.agent.lib.conduit import Conduit as HandlerConduit
 # This plugin
 plugin = Plugin.find(__name__)
 
-# Path monitoring
-path_monitor = PathMonitor()
+# Path monitoring (inotify, else polling)
+path_monitor = pmon.path_monitor()
 
 # Track registration status
 registered = False
 
+# The messaging settings of the broker connection (None when detached)
+attached = None
+
+# Held while an operation mutates the rpmdb
+rpm_lock = RLock()
+
+# Serialize registration changes
+registration_lock = RLock()
+
+# Serialize the operations that mutate the rpmdb in arrival order
+# and coalesce install and update operations
+coalescer = Coalescer(
+    rpm_lock,
+    lambda method, units, options: dispatch(method, units, options),
+    lambda: Context.current().cancelled)
+
 
 log = getLogger(__name__)
 
@@ -64,6 +95,58 @@ RHSM_CONFIG_PATH = '/etc/rhsm/rhsm.conf'
 
 REPOSITORY_PATH = '/etc/yum.repos.d/redhat.repo'
 
+# Seconds between attempts to validate the registration.
+RETRY_DELAY = 60
+
+# Uploads the enabled repositories report under the resource policy.
+ENABLED_REPOS_COMMAND = ['/sbin/katello-enabled-repos-upload', '--background']
+
+
+class State(object):
+    """
+    The plugin state.
+    STARTING -> VALIDATING -> REGISTERED | UNREGISTERED
+    RETRYING while the registration cannot be validated.
+    :ivar name: The state name.
+    :type name: str
+    :ivar error: The last error while RETRYING.
+    :type error: str
+    :ivar since: When the state was entered (epoch seconds).
+    :type since: float
+    """
+
+    STARTING = 'starting'
+    VALIDATING = 'validating'
+    RETRYING = 'retrying'
+    REGISTERED = 'registered'
+    UNREGISTERED = 'unregistered'
+
+    def __init__(self):
+        self.name = State.STARTING
+        self.error = None
+        self.since = time()
+
+    def set(self, name, error=None):
+        """
+        Enter a state.
+        :param name: The state name.
+        :type name: str
+        :param error: The (optional) error.
+        :type error: str
+        """
+        if name != self.name:
+            log.info('state: %s', name)
+        self.name = name
+        self.error = error
+        self.since = time()
+
+    def dict(self):
+        return dict(state=self.name, error=self.error, since=self.since, registered=registered)
+
+
+# The plugin state
+state = State()
+
 
 @initializer
 def init_plugin():
@@ -71,43 +154,85 @@ def init_plugin():
     Initialize the plugin.
     Called (once) immediately after the plugin is loaded.
      - setup path monitoring.
-     - validate registration.  If registered:
-       - setup plugin configuration.
+     - apply a pending restart.
+     - start the background initialization.
+    Returns without waiting for the server.
     """
+    spans.configured(setting('timing', 'enabled', False, boolean) or None)
     path = ConsumerIdentity.certpath()
     path_monitor.add(path, certificate_changed)
     path_monitor.add(REPOSITORY_PATH, send_enabled_report)
+    AgentRestart.prepare()
+    for path in AgentRestart.paths():
+        path_monitor.add(path, AgentRestart.requested)
     path_monitor.start()
+    AgentRestart.requested()
+    thread = Thread(target=initialize, name='Initializer')
+    thread.setDaemon(True)
+    thread.start()
+
+
+def initialize():
+    """
+    Background initialization.
+     - validate registration.  If registered:
+       - setup plugin configuration.
+       - attach to the message broker.
+    Retried until the registration has been validated.
+    """
     while True:
+        registration_lock.acquire()
         try:
-            validate_registration()
-            if registered:
-                update_settings()
-            # DONE
-            break
-        except Exception, e:
-            log.warn(str(e))
-            sleep(60)
+            try:
+                state.set(State.VALIDATING)
+                validate_registration()
+                if registered:
+                    attach(update_settings())
+                    state.set(State.REGISTERED)
+                else:
+                    state.set(State.UNREGISTERED)
+                # DONE
+                break
+            except Exception, e:
+                log.warn(str(e))
+                state.set(State.RETRYING, str(e))
+        finally:
+            registration_lock.release()
+        sleep(retry_delay())
 
 
 def bundle(certificate):
     """
     Bundle the key and cert and write to a file.
+    The file is replaced atomically and only when the content changed.
     :param certificate: A consumer identity certificate.
     :type certificate: ConsumerIdentity
     :return: The path to written bundle.
     :rtype: str
     """
     path = os.path.join(certificate.PATH, 'bundle.pem')
-    fp = open(path, 'w')
+    content = certificate.key + certificate.cert
+    try:
+        fp = open(path)
+        try:
+            if fp.read() == content:
+                return path
+        finally:
+            fp.close()
+    except IOError:
+        pass
+    tmp = path + '.tmp'
+    fp = os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), 'w')
     try:
         fp.write(certificate.key)
         fp.write(certificate.cert)
-        return path
     finally:
         fp.close()
+    os.rename(tmp, path)
+    return path
 
 
+@spans.traced('certificate_changed')
 def certificate_changed(path):
     """
     A certificate change has been detected.
@@ -118,26 +243,101 @@ def certificate_changed(path):
     """
     log.info('changed: %s', path)
     while True:
+        registration_lock.acquire()
         try:
-            validate_registration()
-            if registered:
-                update_settings()
-                enabled_repos_upload.upload_enabled_repos_report()
-                plugin.attach()
-            else:
-                plugin.detach()
-            # DONE
-            break
-        except Exception, e:
-            log.warn(str(e))
-            sleep(60)
+            try:
+                state.set(State.VALIDATING)
+                validate_registration()
+                if registered:
+                    settings = update_settings()
+                    send_enabled_report()
+                    attach(settings)
+                    state.set(State.REGISTERED)
+                else:
+                    detach()
+                    state.set(State.UNREGISTERED)
+                # DONE
+                break
+            except Exception, e:
+                log.warn(str(e))
+                state.set(State.RETRYING, str(e))
+        finally:
+            registration_lock.release()
+        sleep(retry_delay())
 
 def send_enabled_report(path=REPOSITORY_PATH):
-    enabled_repos_upload.upload_enabled_repos_report()
+    """
+    The enabled repositories changed.
+    The report is generated and uploaded by a background process
+    governed by the resource policy, reaped by a daemon thread.
+    :param path: The path to the file that changed.
+    :type path: str
+    """
+    devnull = open(os.devnull, 'r+')
+    try:
+        try:
+            child = Popen(ENABLED_REPOS_COMMAND,
+                          stdin=devnull,
+                          stdout=devnull,
+                          stderr=devnull,
+                          close_fds=True)
+        except OSError, e:
+            log.warn('%s: %s', ENABLED_REPOS_COMMAND[0], e)
+            return
+    finally:
+        devnull.close()
+    thread = Thread(target=child.wait, name='EnabledReport')
+    thread.setDaemon(True)
+    thread.start()
+
+class Settings(object):
+    """
+    Immutable snapshot of the messaging settings.
+    Snapshots are equal when the broker connection is the same,
+    including the content of the CA certificate.
+    :ivar url: The broker URL.
+    :type url: str
+    :ivar uuid: The agent identity.
+    :type uuid: str
+    :ivar cacert: The CA certificate path.
+    :type cacert: str
+    :ivar digest: The digest of the CA certificate.
+    :type digest: str
+    """
+
+    __slots__ = ('url', 'uuid', 'cacert', 'digest')
+
+    def __init__(self, url, uuid, cacert):
+        object.__setattr__(self, 'url', url)
+        object.__setattr__(self, 'uuid', uuid)
+        object.__setattr__(self, 'cacert', cacert)
+        object.__setattr__(self, 'digest', certificate_digest(cacert))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is read-only' % name)
+
+    def key(self):
+        return self.url, self.uuid, self.cacert, self.digest
+
+    def __eq__(self, other):
+        return isinstance(other, Settings) and self.key() == other.key()
 
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __str__(self):
+        return 'url=%s uuid=%s cacert=%s' % (self.url, self.uuid, self.cacert)
+
+
+@spans.traced('update_settings')
 def update_settings():
     """
     Setup the plugin based on the RHSM configuration.
+    :return: The messaging settings.
+    :rtype: Settings
     """
     rhsm_conf = Config(RHSM_CONFIG_PATH)
     certificate = ConsumerIdentity.read()
@@ -163,12 +363,45 @@ def update_settings():
     else:
        log.info('Using %s as the ca cert for qpid connection' % existing_ca_certs[0])
 
-    plugin.cfg.messaging.cacert = existing_ca_certs[0]
-    plugin.cfg.messaging.url = 'proton+amqps://%s:5647' % rhsm_conf['server']['hostname']
-    plugin.cfg.messaging.uuid = 'pulp.agent.%s' % certificate.getConsumerId()
+    settings = Settings(
+        'proton+amqps://%s:5647' % rhsm_conf['server']['hostname'],
+        'pulp.agent.%s' % certificate.getConsumerId(),
+        existing_ca_certs[0])
+    plugin.cfg.messaging.cacert = settings.cacert
+    plugin.cfg.messaging.url = settings.url
+    plugin.cfg.messaging.uuid = settings.uuid
     bundle(certificate)
+    return settings
+
 
+@spans.traced('attach')
+def attach(settings):
+    """
+    Attach to the message broker.
+    Attaching tears down and rebuilds the broker connection, so this
+    is skipped when already attached with the same settings.
+    :param settings: The messaging settings.
+    :type settings: Settings
+    """
+    global attached
+    if settings == attached:
+        log.debug('messaging settings unchanged: %s', settings)
+        return
+    log.info('attaching: %s', settings)
+    plugin.attach()
+    attached = settings
 
+
+def detach():
+    """
+    Detach from the message broker.
+    """
+    global attached
+    plugin.detach()
+    attached = None
+
+
+@spans.traced('validate_registration')
 def validate_registration():
     """
     Validate consumer registration by making a REST call
@@ -185,71 +418,321 @@ def validate_registration():
 
     try:
         uep = UEP()
-        consumer = uep.getConsumer(consumer_id)
+        consumer = Breaker().call(uep.getConsumer, consumer_id)
         registered = (consumer is not None)
     except RemoteServerException, e:
         if e.code != httplib.NOT_FOUND:
             log.warn(str(e))
             raise
+    except CircuitOpen:
+        raise
     except Exception, e:
         log.exception(str(e))
         raise
 
 
+def retry_delay():
+    """
+    Get the seconds to wait before validating the registration again.
+    Deferrals requested by the server are honored.
+    :rtype: float
+    """
+    return max(RETRY_DELAY, Breaker().remaining())
+
+
+def read_json(path):
+    """
+    Read a cached JSON document.
+    :param path: The path to the document.
+    :type path: str
+    :return: The document or None when missing or invalid.
+    """
+    if not os.path.isfile(path):
+        return None
+    fp = open(path)
+    try:
+        try:
+            return json.loads(fp.read())
+        except ValueError:
+            return None
+    finally:
+        fp.close()
+
+
+def setting(section, name, default=None, convert=int):
+    """
+    Get an (optional) plugin configuration setting.
+    :param section: The section name.
+    :type section: str
+    :param name: The setting name.
+    :type name: str
+    :param default: Returned when not specified or not valid.
+    :param convert: Converts the configured string.
+    :type convert: callable
+    :return: The setting value.
+    """
+    try:
+        value = getattr(getattr(plugin.cfg, section), name)
+    except AttributeError:
+        return default
+    if not isinstance(value, basestring) or not value.strip():
+        return default
+    try:
+        return convert(value.strip())
+    except ValueError:
+        return default
+
+
+def boolean(value):
+    """
+    Convert a configured flag.
+    """
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+@spans.traced('content.dispatch')
+def dispatch(method, units, options):
+    """
+    Delegate a content operation to the pulp handlers.
+    When [content] isolated is set, the operation runs in a worker
+    process bounded by the [content] timeout and memory settings and
+    its cancellation is forwarded to the worker.
+    :param method: The dispatcher method name.
+    :type method: str
+    :param units: A list of content units.
+    :type units: list
+    :param options: The operation options.
+    :type options: dict
+    :return: The dispatch report.
+    :rtype: dict
+    """
+    if setting('content', 'isolated', False, boolean):
+        timeout = setting('content', 'timeout')
+        memory = setting('content', 'memory')
+        if memory:
+            memory *= 1024 * 1024
+        worker = Worker(timeout=timeout, memory=memory, cancelled=Conduit().cancelled)
+        return worker(method, units, options)
+    conduit = Conduit()
+    dispatcher = Dispatcher()
+    report = getattr(dispatcher, method)(conduit, units, options)
+    return report.dict()
+
+
+def coalesce(method, units, options):
+    """
+    Perform a content operation in arrival order with the other
+    operations that mutate the rpmdb.
+    Unless [content] coalesce is disabled, compatible install and
+    update operations waiting for the lock are performed as one.
+    :param method: The dispatcher method name.
+    :type method: str
+    :param units: A list of content units.
+    :type units: list
+    :param options: The operation options.
+    :type options: dict
+    :return: The dispatch report.
+    :rtype: dict
+    """
+    return coalescer(method, units, options, setting('content', 'coalesce', True, boolean))
+
+
+class Activity(object):
+    """
+    Tracks the content operations in progress.
+    :ivar count: The number of operations in progress.
+    :type count: int
+    :ivar draining: New operations wait until resumed.
+    :type draining: bool
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.draining = False
+        self.condition = Condition()
+
+    def enter(self):
+        """
+        An operation is starting.
+        Blocks while draining.
+        """
+        self.condition.acquire()
+        try:
+            while self.draining:
+                self.condition.wait()
+            self.count += 1
+        finally:
+            self.condition.release()
+
+    def leave(self):
+        """
+        An operation has completed.
+        """
+        self.condition.acquire()
+        try:
+            self.count -= 1
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def drain(self):
+        """
+        Hold new operations and wait for those in progress to complete.
+        """
+        self.condition.acquire()
+        try:
+            self.draining = True
+            while self.count:
+                self.condition.wait()
+        finally:
+            self.condition.release()
+
+    def resume(self):
+        """
+        Let the held operations start.
+        """
+        self.condition.acquire()
+        try:
+            self.draining = False
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+
+# Content operations in progress
+activity = Activity()
+
+
+def tracked(fn):
+    """
+    Decorator used to track content operations in progress.
+    """
+    @wraps(fn)
+    def _fn(*args, **kwargs):
+        activity.enter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            activity.leave()
+    return _fn
+
+
 class AgentRestart(object):
     """
     Restart the daemon after RPM upgrade.
-    The %post in the RPM will write the RESTART_FILE.  The recurring
-    'apply' action notices file and restarts the goferd service only when
-    this plugin is not longer busy.
+    The %post in the RPM will write the RESTART_FILE in a directory
+    owned by katello-agent and only writable by root.  The path monitor
+    notices the file and the goferd service is restarted as soon as the
+    content operations in progress have completed.  Requests received
+    meanwhile are held; they are still in the gofer pending queue and
+    run after the restart.
+    The LEGACY_RESTART_FILE written by the %post of earlier releases is
+    watched as well, so that an upgrade between releases writing either
+    path restarts the agent.
     """
 
     COMMAND = 'service goferd restart'
-    RESTART_FILE = '/tmp/katello-agent-restart'
+    RESTART_FILE = '/var/run/katello-agent/restart'
+    LEGACY_RESTART_FILE = '/tmp/katello-agent-restart'
+
+    # Seconds allowed after the last operation for its reply to be sent.
+    DRAIN_DELAY = 2
+
+    # Held while a restart is in progress.
+    lock = Lock()
 
     @staticmethod
     def is_busy():
         """
-        Determine if this plugin is busy by counting the pending
-        requests in the persistent queue.
+        Determine if this plugin is busy by counting the
+        content operations in progress.
 
         :return: True if busy.
         :rtype: bool
         """
-        pending = plugin.scheduler.pending
-        path = os.path.join(pending.PENDING, pending.stream)
-        count = len(os.listdir(path))
-        return count > 0
+        return activity.count > 0
+
+    @staticmethod
+    def paths():
+        """
+        Get the paths of the restart files.
+        :rtype: tuple
+        """
+        return AgentRestart.RESTART_FILE, AgentRestart.LEGACY_RESTART_FILE
+
+    @staticmethod
+    def pending():
+        """
+        Get the restart files written.
+        :rtype: list
+        """
+        return [path for path in AgentRestart.paths() if os.path.exists(path)]
 
     @staticmethod
     def restart():
         """
         Restart the goferd service.
-          1. Delete the RESTART_FILE.
+          1. Delete the restart files.
           2. Restart
 
         :return: The restart command exit value.
         :rtype: int
         """
-        os.unlink(AgentRestart.RESTART_FILE)
+        for path in AgentRestart.pending():
+            os.unlink(path)
         p = Popen(AgentRestart.COMMAND, shell=True)
         return p.wait()
 
-    @action(minutes=3)
-    def apply(self):
+    @staticmethod
+    def prepare():
         """
-        Detect the RESTART_FILE and restart the goferd service
-        only when this plugin is not longer busy.  This ensures that
-        an RPM update has completed.
+        Create the directory of the RESTART_FILE (/var/run is
+        cleared at boot) so that it is watched rather than /var/run.
         """
-        if not os.path.exists(AgentRestart.RESTART_FILE):
+        directory = os.path.dirname(AgentRestart.RESTART_FILE)
+        if os.path.isdir(directory):
             return
-        if self.is_busy():
+        try:
+            os.makedirs(directory, 0755)
+        except OSError, e:
+            log.warn(str(e))
+
+    @staticmethod
+    def requested(path=RESTART_FILE):
+        """
+        A restart file has changed.
+        Apply the restart in the background when a file exists.
+        :param path: The path to the file that changed.
+        :type path: str
+        """
+        if not AgentRestart.pending():
             return
-        log.info('Restarting goferd.')
-        exit_val = self.restart()
-        # only reached when restart failed.
-        log.error('Restart failed, exit=%d', exit_val)
+        thread = Thread(target=AgentRestart().apply, name='AgentRestart')
+        thread.setDaemon(True)
+        thread.start()
+
+    def apply(self):
+        """
+        Drain the content operations and restart the goferd service.
+        This ensures that an RPM update has completed.
+        """
+        if not AgentRestart.lock.acquire(False):
+            # already in progress
+            return
+        try:
+            activity.drain()
+            try:
+                sleep(AgentRestart.DRAIN_DELAY)
+                if not AgentRestart.pending():
+                    return
+                log.info('Restarting goferd.')
+                exit_val = self.restart()
+                # only reached when restart failed.
+                log.error('Restart failed, exit=%d', exit_val)
+            finally:
+                activity.resume()
+        finally:
+            AgentRestart.lock.release()
 
 
 class Conduit(HandlerConduit):
@@ -281,11 +764,13 @@ class Conduit(HandlerConduit):
     def cancelled(self):
         """
         Get whether the current operation has been cancelled.
+        Operations run on the thread of the request at the head of the
+        coalescer queue, so the cancellation of every request they
+        perform is checked rather than that of the current thread.
         :return: True if cancelled, else False.
         :rtype: bool
         """
-        context = Context.current()
-        return context.cancelled()
+        return coalescer.cancelled()
 
 class Yum(YumBase):
     """
@@ -340,6 +825,8 @@ class Content(object):
     """
 
     @remote
+    @tracked
+    @spans.traced('content.install')
     def install(self, units, options):
         """
         Install the specified content units using the specified options.
@@ -349,15 +836,16 @@ class Content(object):
             { type_id:<str>, unit_key:<dict> }
         :param options: Install options; based on unit type.
         :type options: dict
-        :return: A dispatch report.
+        :return: A dispatch report, encoded as requested
+            by the 'reply' option.
         :rtype: DispatchReport
         """
-        conduit = Conduit()
-        dispatcher = Dispatcher()
-        report = dispatcher.install(conduit, units, options)
-        return report.dict()
+        options, encoding = reply.requested(options)
+        return reply.encode(coalesce('install', units, options), encoding)
 
     @remote
+    @tracked
+    @spans.traced('content.update')
     def update(self, units, options):
         """
         Update the specified content units using the specified options.
@@ -367,15 +855,16 @@ class Content(object):
             { type_id:<str>, unit_key:<dict> }
         :param options: Update options; based on unit type.
         :type options: dict
-        :return: A dispatch report.
+        :return: A dispatch report, encoded as requested
+            by the 'reply' option.
         :rtype: DispatchReport
         """
-        conduit = Conduit()
-        dispatcher = Dispatcher()
-        report = dispatcher.update(conduit, units, options)
-        return report.dict()
+        options, encoding = reply.requested(options)
+        return reply.encode(coalesce('update', units, options), encoding)
 
     @remote
+    @tracked
+    @spans.traced('content.uninstall')
     def uninstall(self, units, options):
         """
         Uninstall the specified content units using the specified options.
@@ -385,10 +874,48 @@ class Content(object):
             { type_id:<str>, unit_key:<dict> }
         :param options: Uninstall options; based on unit type.
         :type options: dict
-        :return: A dispatch report.
+        :return: A dispatch report, encoded as requested
+            by the 'reply' option.
         :rtype: DispatchReport
         """
-        conduit = Conduit()
-        dispatcher = Dispatcher()
-        report = dispatcher.uninstall(conduit, units, options)
-        return report.dict()
+        options, encoding = reply.requested(options)
+        return reply.encode(coalesce('uninstall', units, options), encoding)
+
+
+class Report(object):
+    """
+    Read-only host reports.
+    These do not take the rpm lock and are answered while
+    content operations are running.
+    """
+
+    @remote
+    def state(self):
+        """
+        Get the plugin state.
+        :return: The state: {state: <str>, error: <str>, since: <float>, registered: <bool>}
+        :rtype: dict
+        """
+        return state.dict()
+
+    @remote
+    def packages(self):
+        """
+        Get the package profile last uploaded to the server.
+        :return: The cached package profile or None.
+        :rtype: list
+        """
+        return read_json(package_upload.CACHE_FILE)
+
+    @remote
+    def enabled_repos(self):
+        """
+        Get the enabled repositories report last uploaded to the server.
+        :return: The cached report or None.
+        :rtype: dict
+        """
+        cached = read_json(enabled_repos_upload.EnabledRepoCache.CACHE_FILE)
+        if not cached:
+            return None
+        consumer_id = enabled_repos_upload.lookup_consumer_id()
+        return cached.get(consumer_id)
@@ -0,0 +1,305 @@
+#
+# Copyright 2017 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+
+"""
+Event driven path monitoring.
+Provides the gofer PathMonitor contract backed by inotify so that
+changes are reported as they happen without periodic wakeups.
+"""
+
+import os
+import errno
+import fcntl
+import select
+import struct
+import ctypes
+import ctypes.util
+
+from hashlib import sha1
+from logging import getLogger
+from threading import Thread, RLock
+
+
+log = getLogger(__name__)
+
+
+# inotify(7) events
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+
+# Events that may change a file within a watched directory
+# or the directory itself.
+MASK = \
+    IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+    IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+EVENT = struct.Struct('iIII')
+
+
+class InotifyError(Exception):
+    """
+    inotify is not available.
+    """
+    pass
+
+
+class Inotify(object):
+    """
+    Minimal ctypes binding of inotify(7).
+    """
+
+    def __init__(self):
+        name = ctypes.util.find_library('c')
+        try:
+            self.libc = ctypes.CDLL(name, use_errno=True)
+            self.libc.inotify_init
+        except (OSError, AttributeError), e:
+            raise InotifyError(str(e))
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise InotifyError(os.strerror(ctypes.get_errno()))
+        flags = fcntl.fcntl(self.fd, fcntl.F_GETFD)
+        fcntl.fcntl(self.fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+    def add_watch(self, path, mask=MASK):
+        wd = self.libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self):
+        """
+        Read pending events.
+        :return: A list of: (wd, mask, name)
+        :rtype: list
+        """
+        events = []
+        buf = os.read(self.fd, 65536)
+        offset = 0
+        while offset < len(buf):
+            wd, mask, cookie, length = EVENT.unpack_from(buf, offset)
+            offset += EVENT.size
+            name = buf[offset:offset + length].rstrip('\0')
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def digest(path):
+    """
+    Get the digest of the file content.
+    :param path: A file path.
+    :type path: str
+    :return: The hex digest or None when the file does not exist.
+    :rtype: str
+    """
+    try:
+        fp = open(path)
+    except IOError:
+        return None
+    try:
+        return sha1(fp.read()).hexdigest()
+    finally:
+        fp.close()
+
+
+def nearest(path):
+    """
+    Get the nearest existing directory of path.
+    :param path: A directory path.
+    :type path: str
+    :rtype: str
+    """
+    while not os.path.isdir(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+class InotifyMonitor(Thread):
+    """
+    Monitors files for changes using inotify.
+    The parent directory of each file is watched so that atomic
+    (rename based) replacement and deletion are detected.  When a
+    directory does not exist, the nearest existing ancestor is watched
+    until it is re-created.  The target is called with the path only
+    when the file content has changed.
+    """
+
+    def __init__(self):
+        Thread.__init__(self, name='InotifyMonitor')
+        self.setDaemon(True)
+        self.inotify = Inotify()
+        self.paths = {}
+        self.watches = {}
+        self.lock = RLock()
+        self.aborted = False
+        self.wake = os.pipe()
+
+    def add(self, path, target):
+        """
+        Add a path to be monitored.
+        :param path: An absolute path to monitor.
+        :type path: str
+        :param target: Called as target(path) when the path changes.
+        :type target: callable
+        """
+        self.lock.acquire()
+        try:
+            self.paths[path] = [target, digest(path)]
+            self.arm()
+        finally:
+            self.lock.release()
+
+    def delete(self, path):
+        """
+        Stop monitoring a path.
+        :param path: A monitored path.
+        :type path: str
+        """
+        self.lock.acquire()
+        try:
+            self.paths.pop(path, None)
+            self.arm()
+        finally:
+            self.lock.release()
+
+    def arm(self):
+        """
+        Watch the nearest existing directory of each monitored path.
+        """
+        wanted = set([nearest(os.path.dirname(p)) for p in self.paths])
+        for wd, path in self.watches.items():
+            if path not in wanted or not os.path.isdir(path):
+                self.inotify.rm_watch(wd)
+                del self.watches[wd]
+        watched = set(self.watches.values())
+        for path in wanted - watched:
+            try:
+                wd = self.inotify.add_watch(path)
+                self.watches[wd] = path
+            except OSError, e:
+                log.warn(str(e))
+
+    def affected(self, events):
+        """
+        Get the monitored paths that may have been changed by the events.
+        Only files named by an event, or below a directory named by
+        an event, are digested so that activity in busy directories
+        such as /tmp is cheap.
+        :param events: The inotify events read.
+        :type events: list
+        :rtype: list
+        """
+        named = set()
+        for wd, mask, name in events:
+            directory = self.watches.get(wd)
+            if directory is None or not name or mask & IN_IGNORED:
+                return self.paths.keys()
+            named.add(os.path.join(directory, name))
+        affected = []
+        for path in self.paths:
+            for changed in named:
+                if path == changed or path.startswith(changed + os.sep):
+                    affected.append(path)
+                    break
+        return affected
+
+    def check(self, events=()):
+        """
+        Notify the targets of paths with changed content.
+        :param events: The inotify events read.
+        :type events: list
+        """
+        changed = []
+        self.lock.acquire()
+        try:
+            if events:
+                affected = self.affected(events)
+            else:
+                affected = self.paths.keys()
+            for wd, mask, name in events:
+                if mask & IN_IGNORED:
+                    # removed by the kernel
+                    self.watches.pop(wd, None)
+            self.arm()
+            for path in affected:
+                entry = self.paths[path]
+                current = digest(path)
+                if current != entry[1]:
+                    entry[1] = current
+                    changed.append((entry[0], path))
+        finally:
+            self.lock.release()
+        for target, path in changed:
+            try:
+                target(path)
+            except Exception:
+                log.exception(path)
+
+    def run(self):
+        fd = self.inotify.fd
+        while not self.aborted:
+            try:
+                readable = select.select([fd, self.wake[0]], [], [])[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if fd not in readable:
+                continue
+            try:
+                events = self.inotify.read()
+            except OSError, e:
+                if e.errno in (errno.EINTR, errno.EAGAIN):
+                    continue
+                raise
+            self.check(events)
+        self.inotify.close()
+
+    def abort(self):
+        """
+        Stop monitoring.
+        """
+        self.aborted = True
+        os.write(self.wake[1], '0')
+
+
+def path_monitor():
+    """
+    Get a path monitor.
+    inotify is used when available, else the polling gofer monitor.
+    :return: A monitor providing add(), delete(), start() and abort().
+    """
+    try:
+        return InotifyMonitor()
+    except InotifyError, e:
+        log.info('inotify not available, polling: %s', e)
+        from gofer.pmon import PathMonitor
+        return PathMonitor()
@@ -0,0 +1,186 @@
+#
+# Copyright 2017 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+
+"""
+Compact encoding of Content operation replies.
+Requested with the 'reply' option of the operation:
+
+  {"reply": {"compress": <bool>, "details": <int>}}
+
+The dispatch report is returned as:
+
+  {"encoding": "compact/1", "compression": null|"zlib",
+   "succeeded": <bool>, "num_changes": <int>, "reboot_scheduled": <bool>,
+   "payload": <packed report>|<base64 zlib compressed JSON of it>}
+
+Lists of dicts having the same keys (such as the resolved packages) are
+packed as one table: {"$table": [<key>, ...], "$rows": [[<value>, ...], ...]}.
+The details of a succeeded content type may be capped to a number of
+entries per list; the count of entries dropped is reported in its
+"truncated" dict.  Failed content types are never capped.
+Replies of requests without the option are not changed.
+"""
+
+import zlib
+
+from base64 import b64encode, b64decode
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+ENCODING = 'compact/1'
+ZLIB = 'zlib'
+
+OPTION = 'reply'
+
+TABLE = '$table'
+ROWS = '$rows'
+
+# Summary fields copied to the envelope.
+SUMMARY = ('succeeded', 'num_changes', 'reboot_scheduled')
+
+
+def requested(options):
+    """
+    Remove and return the reply encoding requested in the options.
+    :param options: The operation options.
+    :type options: dict
+    :return: (options, spec) where options no longer contain the
+        request and spec is the requested encoding (dict) or None.
+    :rtype: tuple
+    """
+    if not isinstance(options, dict) or OPTION not in options:
+        return options, None
+    options = dict(options)
+    spec = options.pop(OPTION)
+    if not isinstance(spec, dict):
+        spec = {}
+    return options, spec
+
+
+def pack(value):
+    """
+    Pack lists of dicts having the same keys as tables.
+    :param value: A decoded JSON value.
+    :return: The packed value.
+    """
+    if isinstance(value, dict):
+        return dict([(k, pack(v)) for k, v in value.items()])
+    if isinstance(value, list):
+        if len(value) > 1 and isinstance(value[0], dict):
+            columns = sorted(value[0].keys())
+            same = True
+            for item in value:
+                if not isinstance(item, dict) or sorted(item.keys()) != columns:
+                    same = False
+                    break
+            if same:
+                rows = [[pack(item[c]) for c in columns] for item in value]
+                return {TABLE: columns, ROWS: rows}
+        return [pack(v) for v in value]
+    return value
+
+
+def unpack(value):
+    """
+    Reverse pack().
+    :param value: A packed value.
+    :return: The original value.
+    """
+    if isinstance(value, dict):
+        if TABLE in value:
+            columns = value[TABLE]
+            return [dict(zip(columns, [unpack(v) for v in row])) for row in value[ROWS]]
+        return dict([(k, unpack(v)) for k, v in value.items()])
+    if isinstance(value, list):
+        return [unpack(v) for v in value]
+    return value
+
+
+def cap(report, limit):
+    """
+    Cap the details of the succeeded content types.
+    :param report: The dispatch report (dict).
+    :type report: dict
+    :param limit: The maximum number of entries kept per list.
+    :type limit: int
+    :return: The capped report.
+    :rtype: dict
+    """
+    details = report.get('details')
+    if not isinstance(details, dict):
+        return report
+    report = dict(report)
+    report['details'] = dict(details)
+    for type_id, type_report in details.items():
+        if not isinstance(type_report, dict) or not type_report.get('succeeded'):
+            continue
+        type_details = type_report.get('details')
+        if not isinstance(type_details, dict):
+            continue
+        capped = dict(type_details)
+        truncated = {}
+        for name, entries in type_details.items():
+            if isinstance(entries, list) and len(entries) > limit:
+                capped[name] = entries[:limit]
+                truncated[name] = len(entries) - limit
+        if truncated:
+            capped['truncated'] = truncated
+            report['details'][type_id] = dict(type_report, details=capped)
+    return report
+
+
+def encode(report, spec):
+    """
+    Encode a dispatch report.
+    :param report: The dispatch report (dict).
+    :type report: dict
+    :param spec: The requested encoding or None.
+    :type spec: dict
+    :return: The reply.
+    :rtype: dict
+    """
+    if spec is None or not isinstance(report, dict):
+        return report
+    limit = spec.get('details')
+    if isinstance(limit, int) and limit >= 0:
+        report = cap(report, limit)
+    reply = dict(encoding=ENCODING, compression=None)
+    for name in SUMMARY:
+        if name in report:
+            reply[name] = report[name]
+    payload = pack(report)
+    if spec.get('compress'):
+        reply['compression'] = ZLIB
+        payload = b64encode(zlib.compress(json.dumps(payload, separators=(',', ':'))))
+    reply['payload'] = payload
+    return reply
+
+
+def decode(reply):
+    """
+    Decode a reply.
+    :param reply: The reply.
+    :type reply: dict
+    :return: The dispatch report (dict).
+    :rtype: dict
+    """
+    if not isinstance(reply, dict) or reply.get('encoding') != ENCODING:
+        return reply
+    payload = reply['payload']
+    if reply.get('compression') == ZLIB:
+        payload = json.loads(zlib.decompress(b64decode(payload)))
+    return unpack(payload)
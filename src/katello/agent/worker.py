@@ -0,0 +1,259 @@
+#
+# Copyright 2017 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+
+"""
+Content operations run in an isolated worker process.
+YumBase leaks and goferd is long lived.  Running the dispatcher in a
+short lived process returns that memory to the system and keeps a
+crashed or hung transaction from taking the agent down with it.
+"""
+
+import os
+import sys
+import time
+import errno
+import signal
+import select
+import resource
+
+from logging import getLogger
+from subprocess import Popen, PIPE
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+log = getLogger(__name__)
+
+
+# Seconds between checks of the cancellation of the operation.
+POLL = 1
+
+# The signal forwarding the cancellation to the worker.
+CANCEL = signal.SIGUSR1
+
+# Set in the worker when the operation has been cancelled.
+cancelled = False
+
+
+class WorkerFailed(Exception):
+    """
+    The worker process did not return a dispatch report.
+    """
+    pass
+
+
+class Worker(object):
+    """
+    Runs a dispatcher operation in a spawned child process.
+    The request is written to the child's stdin and the dispatch
+    report is read from its stdout as JSON.  The cancellation of the
+    operation is forwarded to the child (CANCEL) where it is reported
+    to the handlers by Conduit.cancelled().
+    Once the timeout has expired the child is stopped in steps, GRACE
+    seconds apart: the operation is cancelled, then the child is sent
+    SIGTERM (on which rpm completes the current element and closes the
+    rpmdb) and only then SIGKILL.
+    :ivar timeout: Seconds the operation may run, None = unbounded.
+    :type timeout: int
+    :ivar memory: The address space limit (bytes) of the child, None = unlimited.
+    :type memory: int
+    :ivar cancelled: An (optional) callable returning whether the
+        operation has been cancelled.
+    :type cancelled: callable
+    :ivar expired: The timeout has expired.
+    :type expired: bool
+    """
+
+    COMMAND = [sys.executable, '-m', 'katello.agent.worker']
+
+    # Seconds the child is given to stop after each signal.
+    GRACE = 60
+
+    def __init__(self, timeout=None, memory=None, cancelled=None):
+        self.timeout = timeout
+        self.memory = memory
+        self.cancelled = cancelled
+        self.expired = False
+
+    def limit(self):
+        """
+        Apply the memory limit (in the child).
+        """
+        if self.memory:
+            resource.setrlimit(resource.RLIMIT_AS, (self.memory, self.memory))
+
+    def __call__(self, method, units, options):
+        """
+        Run the dispatcher method.
+        :param method: The dispatcher method name (install|update|uninstall).
+        :type method: str
+        :param units: A list of content units.
+        :type units: list
+        :param options: The operation options.
+        :type options: dict
+        :return: The dispatch report, also when the child replied
+            after the timeout has expired.
+        :rtype: dict
+        :raise WorkerFailed: when the child crashed or was stopped.
+        """
+        request = json.dumps(dict(method=method, units=units, options=options))
+        child = Popen(
+            self.COMMAND,
+            stdin=PIPE,
+            stdout=PIPE,
+            close_fds=True,
+            preexec_fn=self.limit)
+        try:
+            try:
+                child.stdin.write(request)
+                child.stdin.close()
+            except IOError, e:
+                if e.errno != errno.EPIPE:
+                    raise
+                raise WorkerFailed('%s worker exited before reading the request' % method)
+            output = self.read(child)
+        finally:
+            if child.poll() is None:
+                os.kill(child.pid, signal.SIGKILL)
+            child.wait()
+        try:
+            reply = json.loads(output)
+        except ValueError:
+            if self.expired:
+                raise WorkerFailed('%s worker exceeded %d seconds' % (method, self.timeout))
+            raise WorkerFailed('%s worker exited: %d' % (method, child.returncode))
+        if 'error' in reply:
+            raise WorkerFailed(reply['error'])
+        return reply['result']
+
+    def read(self, child):
+        """
+        Read the child's stdout until EOF.
+        The cancellation is checked every POLL seconds and forwarded once.
+        The child is stopped once the timeout has expired.
+        :param child: The child process.
+        :type child: Popen
+        :return: The output.
+        :rtype: str
+        :raise WorkerFailed: when the child has been killed.
+        """
+        fd = child.stdout.fileno()
+        chunks = []
+        deadline = None
+        if self.timeout:
+            deadline = time.time() + self.timeout
+        stopping = [CANCEL, signal.SIGTERM, signal.SIGKILL]
+        forwarded = False
+        while True:
+            wait = None
+            if deadline is not None:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    self.expired = True
+                    signum = stopping.pop(0)
+                    if signum == CANCEL and forwarded:
+                        signum = stopping.pop(0)
+                    log.warn('worker exceeded %d seconds, sending signal %d: %d', self.timeout, signum, child.pid)
+                    os.kill(child.pid, signum)
+                    if signum == signal.SIGKILL:
+                        raise WorkerFailed('worker exceeded %d seconds' % self.timeout)
+                    forwarded = True
+                    deadline = time.time() + self.GRACE
+                    continue
+            if self.cancelled is not None and not forwarded:
+                if self.cancelled():
+                    log.info('operation cancelled, notifying worker: %d', child.pid)
+                    os.kill(child.pid, CANCEL)
+                    forwarded = True
+                else:
+                    wait = min(wait or POLL, POLL)
+            try:
+                readable = select.select([fd], [], [], wait)[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not readable:
+                continue
+            data = os.read(fd, 65536)
+            if not data:
+                return ''.join(chunks)
+            chunks.append(data)
+
+
+# --- worker process ---------------------------------------------------------
+
+
+def dispatch(method, units, options):
+    """
+    Run the dispatcher method (in the worker).
+    :return: The dispatch report.
+    :rtype: dict
+    """
+    from pulp.agent.lib.dispatcher import Dispatcher
+    from pulp.agent.lib.conduit import Conduit as HandlerConduit
+
+    sys.path.append('/usr/share/rhsm')
+    try:
+        from subscription_manager.identity import ConsumerIdentity
+    except ImportError:
+        from subscription_manager.certlib import ConsumerIdentity
+
+    class Conduit(HandlerConduit):
+
+        @property
+        def consumer_id(self):
+            certificate = ConsumerIdentity.read()
+            return certificate.getConsumerId()
+
+        def update_progress(self, report):
+            # Disabled; see katelloplugin.Conduit.
+            pass
+
+        def cancelled(self):
+            return cancelled
+
+    dispatcher = Dispatcher()
+    report = getattr(dispatcher, method)(Conduit(), units, options)
+    return report.dict()
+
+
+def cancel(signum, frame):
+    """
+    The operation has been cancelled (in the worker).
+    """
+    global cancelled
+    cancelled = True
+
+
+def main():
+    signal.signal(CANCEL, cancel)
+    # Handlers and yum may write to stdout; keep it for the reply only.
+    reply = os.fdopen(os.dup(1), 'w')
+    os.dup2(2, 1)
+    try:
+        request = json.loads(sys.stdin.read())
+        result = dispatch(request['method'], request['units'], request['options'])
+        document = dict(result=result)
+    except Exception, e:
+        log.exception(str(e))
+        document = dict(error=str(e))
+    reply.write(json.dumps(document))
+    reply.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,440 @@
+#
+# Copyright 2017 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+
+"""
+Errata applicability computed on the host.
+The updateinfo metadata already cached by yum for the enabled
+repositories is matched against the installed packages.  An erratum is
+applicable when it updates an installed package: a package of the same
+name and arch with a higher EVR than the newest one installed.
+The packages of modular errata (collections of a module stream) are
+ignored: the enabled module streams are not known here, so modular
+applicability is left to the server.
+
+Uploaded document:
+  {errata: [<erratum ID>, ...], rpms: [<name>-<epoch>:<version>-<release>.<arch>, ...]}
+where rpms are the newest packages of the applicable errata.
+
+The document is uploaded only when changed since the last upload.  The
+fingerprint of the rpmdb and of the updateinfo files is kept with the
+last computed document, whether or not its upload succeeded, so that
+callers can skip the computation while neither changed.
+When the server does not support the upload (404 or 405), that is kept
+too and nothing is uploaded until UNSUPPORTED_RETRY seconds have passed.
+
+Cache file content:
+  {fingerprint: <str>, document: <dict>, uploaded: <bool>, unsupported: <float>}
+"""
+
+import os
+import re
+import bz2
+import time
+import gzip
+import httplib
+
+from hashlib import sha1
+from logging import getLogger
+from xml.etree import cElementTree as ElementTree
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+try:
+    from rpm import labelCompare
+except ImportError:
+    labelCompare = None
+
+from katello.packages import rpmdb_fingerprint, RPMDB_PATH
+
+
+log = getLogger(__name__)
+
+
+# HTTP statuses of servers not supporting the upload.
+UNSUPPORTED = (httplib.NOT_FOUND, httplib.METHOD_NOT_ALLOWED)
+# Seconds before uploading again to a server not supporting it.
+UNSUPPORTED_RETRY = 86400
+
+REPOMD = 'repomd.xml'
+UPDATEINFO = 'updateinfo'
+
+OPENERS = {
+    '.gz': gzip.open,
+    '.bz2': bz2.BZ2File,
+    '.xml': open,
+}
+
+# Version segments compared by rpmvercmp().
+SEPARATOR = re.compile(r'^[^a-zA-Z0-9~^]*')
+DIGITS = re.compile(r'^\d*')
+ALPHA = re.compile(r'^[a-zA-Z]*')
+
+
+def rpmvercmp(a, b):
+    """
+    Compare versions (or releases) as rpm does.
+    :return: 1 when a is newer, -1 when b is newer, else 0.
+    :rtype: int
+    """
+    if a == b:
+        return 0
+    one, two = a, b
+    while one or two:
+        one = SEPARATOR.sub('', one)
+        two = SEPARATOR.sub('', two)
+        if one.startswith('~') or two.startswith('~'):
+            if not one.startswith('~'):
+                return 1
+            if not two.startswith('~'):
+                return -1
+            one, two = one[1:], two[1:]
+            continue
+        if one.startswith('^') or two.startswith('^'):
+            if not one:
+                return -1
+            if not two:
+                return 1
+            if not one.startswith('^'):
+                return 1
+            if not two.startswith('^'):
+                return -1
+            one, two = one[1:], two[1:]
+            continue
+        if not (one and two):
+            break
+        if one[0].isdigit():
+            pattern = DIGITS
+        else:
+            pattern = ALPHA
+        segment1 = pattern.match(one).group()
+        segment2 = pattern.match(two).group()
+        one, two = one[len(segment1):], two[len(segment2):]
+        if not segment2:
+            if pattern is DIGITS:
+                return 1
+            return -1
+        if pattern is DIGITS:
+            segment1 = segment1.lstrip('0')
+            segment2 = segment2.lstrip('0')
+            if len(segment1) != len(segment2):
+                return cmp(len(segment1), len(segment2))
+        if segment1 != segment2:
+            return cmp(segment1, segment2)
+    if not one and not two:
+        return 0
+    if one:
+        return 1
+    return -1
+
+
+def compare_evr(evr1, evr2):
+    """
+    Compare (epoch, version, release) tuples.
+    :return: 1 when evr1 is newer, -1 when evr2 is newer, else 0.
+    :rtype: int
+    """
+    e1, v1, r1 = evr1
+    e2, v2, r2 = evr2
+    if labelCompare is not None:
+        return labelCompare((str(e1), v1, r1), (str(e2), v2, r2))
+    result = cmp(int(e1 or 0), int(e2 or 0))
+    if result:
+        return result
+    result = rpmvercmp(v1 or '', v2 or '')
+    if result:
+        return result
+    return rpmvercmp(r1 or '', r2 or '')
+
+
+def local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def updateinfo_path(repodir):
+    """
+    Find the updateinfo file cached for a repository.
+    Both the yum layout (files in the cache directory) and the
+    repository layout (files in repodata/) are supported.
+    :param repodir: The repository cache directory.
+    :type repodir: str
+    :return: The path or None when the repository has no updateinfo.
+    :rtype: str
+    """
+    for directory in (repodir, os.path.join(repodir, 'repodata')):
+        repomd = os.path.join(directory, REPOMD)
+        if not os.path.isfile(repomd):
+            continue
+        try:
+            root = ElementTree.parse(repomd).getroot()
+        except (IOError, SyntaxError), e:
+            log.debug('%s not read: %s', repomd, e)
+            return None
+        for data in root:
+            if local_name(data.tag) != 'data' or data.get('type') != UPDATEINFO:
+                continue
+            for location in data:
+                if local_name(location.tag) != 'location':
+                    continue
+                href = location.get('href', '')
+                for path in (os.path.join(repodir, href),
+                             os.path.join(directory, os.path.basename(href))):
+                    if os.path.isfile(path):
+                        return path
+        return None
+    return None
+
+
+def modular(collection):
+    """
+    Get whether an updateinfo collection belongs to a module stream.
+    :param collection: The collection element.
+    :rtype: bool
+    """
+    for child in collection:
+        if local_name(child.tag) == 'module':
+            return True
+    return False
+
+
+def notices(path):
+    """
+    Read the errata of an updateinfo file.
+    The packages of module stream collections are skipped.
+    :param path: The updateinfo path (.xml, .xml.gz or .xml.bz2).
+    :type path: str
+    :return: A generator of (erratum ID, packages) where packages is a
+        list of (name, epoch, version, release, arch).
+    """
+    opener = OPENERS.get(os.path.splitext(path)[1])
+    if opener is None:
+        log.debug('%s: unsupported compression', path)
+        return
+    fp = opener(path)
+    try:
+        for event, element in ElementTree.iterparse(fp):
+            if local_name(element.tag) != 'update':
+                continue
+            update_id = None
+            packages = []
+            for child in element:
+                if local_name(child.tag) == 'id':
+                    update_id = (child.text or '').strip()
+                    break
+            for collection in element.getiterator():
+                if local_name(collection.tag) != 'collection' or modular(collection):
+                    continue
+                for child in collection:
+                    if local_name(child.tag) != 'package':
+                        continue
+                    packages.append((
+                        child.get('name'),
+                        int(child.get('epoch') or 0),
+                        child.get('version'),
+                        child.get('release'),
+                        child.get('arch')))
+            element.clear()
+            if update_id:
+                yield update_id, packages
+    finally:
+        fp.close()
+
+
+def newest(installed):
+    """
+    Get the newest installed EVR by (name, arch).
+    :param installed: The installed packages.
+    :type installed: katello.packages.Snapshot
+    :rtype: dict
+    """
+    evrs = {}
+    for p in installed:
+        key = (p.name, p.arch)
+        evr = (p.epoch, p.version, p.release)
+        if key not in evrs or compare_evr(evr, evrs[key]) > 0:
+            evrs[key] = evr
+    return evrs
+
+
+def fingerprint(repodirs, dbpath=RPMDB_PATH):
+    """
+    Get a fingerprint of the inputs: the rpmdb and the updateinfo
+    files of the repositories.
+    :param repodirs: The repository cache directories.
+    :type repodirs: list
+    :return: A hex digest or None when the rpmdb is not found.
+    :rtype: str
+    """
+    rpmdb = rpmdb_fingerprint(dbpath)
+    if rpmdb is None:
+        return None
+    digest = sha1(rpmdb)
+    for repodir in sorted(repodirs):
+        path = updateinfo_path(repodir)
+        if path is None:
+            continue
+        st = os.stat(path)
+        digest.update('%s:%d:%d\n' % (path, st.st_size, int(st.st_mtime)))
+    return digest.hexdigest()
+
+
+def applicable(installed, repodirs):
+    """
+    Compute the applicable errata.
+    :param installed: The installed packages.
+    :type installed: katello.packages.Snapshot
+    :param repodirs: The repository cache directories.
+    :type repodirs: list
+    :return: The document to upload.
+    :rtype: dict
+    """
+    evrs = newest(installed)
+    errata = set()
+    updates = {}
+    for repodir in repodirs:
+        path = updateinfo_path(repodir)
+        if path is None:
+            continue
+        for update_id, packages in notices(path):
+            for name, epoch, version, release, arch in packages:
+                key = (name, arch)
+                if key not in evrs:
+                    continue
+                evr = (epoch, version, release)
+                if compare_evr(evr, evrs[key]) <= 0:
+                    continue
+                errata.add(update_id)
+                if key not in updates or compare_evr(evr, updates[key]) > 0:
+                    updates[key] = evr
+    rpms = []
+    for (name, arch), (epoch, version, release) in updates.items():
+        rpms.append('%s-%s:%s-%s.%s' % (name, epoch, version, release, arch))
+    return dict(errata=sorted(errata), rpms=sorted(rpms))
+
+
+def read(path):
+    try:
+        fp = open(path)
+        try:
+            return fp.read()
+        finally:
+            fp.close()
+    except IOError:
+        return None
+
+
+class ApplicabilityCache(object):
+    """
+    The applicability last computed.
+    :ivar fingerprint: The fingerprint of the inputs it was computed from.
+    :type fingerprint: str
+    :ivar document: The computed document.
+    :type document: dict
+    :ivar uploaded: The document was accepted by the server.
+    :type uploaded: bool
+    :ivar unsupported: When the server was found not supporting the upload.
+    :type unsupported: float
+    """
+
+    CACHE_FILE = '/var/cache/katello-agent/applicability.json'
+
+    def __init__(self, path=None):
+        """
+        :param path: The cache file path, default: CACHE_FILE.
+        :type path: str
+        """
+        self.path = path or self.CACHE_FILE
+        self.fingerprint = None
+        self.document = None
+        self.uploaded = False
+        self.unsupported = None
+        content = read(self.path)
+        if not content:
+            return
+        try:
+            cached = json.loads(content)
+        except ValueError:
+            return
+        if isinstance(cached, dict):
+            self.fingerprint = cached.get('fingerprint')
+            self.document = cached.get('document')
+            self.uploaded = bool(cached.get('uploaded'))
+            self.unsupported = cached.get('unsupported')
+
+    def remove_cache(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def is_valid(self, document):
+        """
+        Get whether the document was already uploaded.
+        :param document: The computed document.
+        :type document: dict
+        :rtype: bool
+        """
+        return self.uploaded and self.document == document
+
+    def supported(self, now=None):
+        """
+        Get whether the upload may be supported by the server: it was
+        not found unsupported in the last UNSUPPORTED_RETRY seconds.
+        :param now: The current time, default: time.time().
+        :type now: float
+        :rtype: bool
+        """
+        if not isinstance(self.unsupported, (int, float)):
+            return True
+        if now is None:
+            now = time.time()
+        return not (0 <= now - self.unsupported < UNSUPPORTED_RETRY)
+
+    def not_supported(self, now=None):
+        """
+        Record that the server does not support the upload.
+        :param now: The current time, default: time.time().
+        :type now: float
+        """
+        if now is None:
+            now = time.time()
+        self.unsupported = now
+        self.save(self.fingerprint, self.document, False)
+
+    def save(self, fingerprint, document, uploaded):
+        """
+        Write the cache.
+        :param fingerprint: The fingerprint of the inputs.
+        :type fingerprint: str
+        :param document: The computed document.
+        :type document: dict
+        :param uploaded: The document was accepted by the server.
+        :type uploaded: bool
+        """
+        self.fingerprint = fingerprint
+        self.document = document
+        self.uploaded = uploaded
+        try:
+            fp = open(self.path, 'w')
+            try:
+                fp.write(json.dumps(dict(
+                    fingerprint=fingerprint,
+                    document=document,
+                    uploaded=uploaded,
+                    unsupported=self.unsupported)))
+            finally:
+                fp.close()
+        except IOError, e:
+            log.debug('applicability cache not written: %s', e)
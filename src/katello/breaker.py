@@ -0,0 +1,335 @@
+#
+# Copyright 2017 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+
+"""
+Circuit breaker shared by the upload paths.
+The state is kept on disk, per server, so that once the server has
+been found unreachable the yum and zypper plugins and the upload
+commands all skip the network until the cooling-off period has passed.
+After that, a single caller is let through as a (half-open) probe; it
+closes the circuit on success and re-opens it on failure.
+Server backpressure (429, or Retry-After with an error) is recorded as
+a time before which no call is made.
+
+State file content:
+  {<server>: {failures: <int>, opened: <float>, probing: <float>, not_before: <float>}}
+"""
+
+import time
+import fcntl
+import socket
+import httplib
+
+from email.utils import parsedate_tz, mktime_tz
+from logging import getLogger
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+log = getLogger(__name__)
+
+
+# Consecutive failures that open the circuit.
+THRESHOLD = 3
+# Seconds the circuit stays open before a probe is let through.
+COOLDOWN = 300
+# Seconds after which a probe that never reported is abandoned.
+PROBE_TIMEOUT = 120
+
+# Seconds calls are deferred after 429 without Retry-After.
+DEFAULT_RETRY_AFTER = 60
+# Limits the deferral requested by the server.
+MAX_RETRY_AFTER = 86400
+
+# Name of exceptions raised when the server cannot be reached.
+UNREACHABLE = ('SSLError', 'NetworkException', 'ProxyException', 'TimeoutError')
+
+
+class CircuitOpen(Exception):
+    """
+    The server is considered unavailable and the call was skipped.
+    """
+    pass
+
+
+class RequestFailed(Exception):
+    """
+    A request failed with an HTTP error status.
+    :ivar code: The HTTP status.
+    :type code: int
+    :ivar headers: The response headers.
+    :type headers: dict
+    """
+
+    def __init__(self, code, reason='', headers=None):
+        Exception.__init__(self, '%d %s' % (code, reason))
+        self.code = code
+        self.headers = headers or {}
+
+
+def unreachable(exception):
+    """
+    Get whether an exception indicates that the server is unreachable
+    or failing, as opposed to the request being rejected.
+    :param exception: The raised exception.
+    :type exception: Exception
+    :rtype: bool
+    """
+    if isinstance(exception, (socket.error, httplib.HTTPException)):
+        return True
+    code = getattr(exception, 'code', None)
+    if isinstance(code, int) and code >= 500:
+        return True
+    return exception.__class__.__name__ in UNREACHABLE
+
+
+def parse_retry_after(value, now=None):
+    """
+    Parse a Retry-After header value.
+    :param value: Delay seconds or an HTTP-date.
+    :type value: str
+    :param now: The current time, default: time.time().
+    :type now: float
+    :return: The delay in seconds (limited to MAX_RETRY_AFTER) or None when invalid.
+    :rtype: int
+    """
+    value = str(value).strip()
+    if value.isdigit():
+        seconds = int(value)
+    else:
+        parsed = parsedate_tz(value)
+        if parsed is None:
+            return None
+        if now is None:
+            now = time.time()
+        seconds = int(mktime_tz(parsed) - now)
+    return min(max(0, seconds), MAX_RETRY_AFTER)
+
+
+def retry_after(exception):
+    """
+    Get the delay requested by the server with a failed request.
+    Supports the retry_after attribute of the rhsm exceptions and the
+    headers of RequestFailed.
+    :param exception: The raised exception.
+    :type exception: Exception
+    :return: The delay in seconds or None when not requested.
+    :rtype: int
+    """
+    value = getattr(exception, 'retry_after', None)
+    if value is None:
+        headers = getattr(exception, 'headers', None) or {}
+        for name, header in headers.items():
+            if name.lower() == 'retry-after':
+                value = header
+    if value is not None:
+        seconds = parse_retry_after(value)
+        if seconds is not None:
+            return seconds
+    if getattr(exception, 'code', None) == 429:
+        return DEFAULT_RETRY_AFTER
+    return None
+
+
+def server():
+    """
+    Get the configured server.
+    :return: The server as: <hostname>:<port>.
+    :rtype: str
+    """
+    try:
+        from rhsm.config import initConfig
+        cfg = initConfig()
+        return '%s:%s' % (cfg.get('server', 'hostname'), cfg.get('server', 'port'))
+    except Exception:
+        return 'default'
+
+
+class Breaker(object):
+    """
+    The circuit breaker of a server.
+    Storage problems (such as a missing or read-only cache directory)
+    are logged and leave the circuit closed.
+    :ivar server: The server: <hostname>:<port>.
+    :type server: str
+    :ivar path: The state file path.
+    :type path: str
+    """
+
+    STATE_FILE = '/var/cache/katello-agent/breaker.json'
+
+    def __init__(self, server=None, path=None, threshold=THRESHOLD, cooldown=COOLDOWN):
+        """
+        :param server: The server, default: the configured server.
+        :type server: str
+        :param path: The state file path, default: STATE_FILE.
+        :type path: str
+        :param threshold: Consecutive failures that open the circuit.
+        :type threshold: int
+        :param cooldown: Seconds the circuit stays open.
+        :type cooldown: int
+        """
+        self.server = server
+        self.path = path or self.STATE_FILE
+        self.threshold = threshold
+        self.cooldown = cooldown
+
+    def update(self, fn):
+        """
+        Read, update and write the state of the server while holding
+        the state file lock.
+        :param fn: Called as fn(state) to update the state (dict) in place.
+            The value returned is returned.
+        :type fn: callable
+        :return: What fn returned.
+        """
+        if self.server is None:
+            self.server = server()
+        try:
+            fp = open(self.path, 'a+')
+        except IOError, e:
+            log.debug('breaker state not available: %s', e)
+            return fn({})
+        try:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+            fp.seek(0)
+            try:
+                document = json.loads(fp.read())
+                if not isinstance(document, dict):
+                    raise ValueError()
+            except ValueError:
+                document = {}
+            state = dict(document.get(self.server, {}))
+            result = fn(state)
+            if state != document.get(self.server, {}):
+                document[self.server] = state
+                fp.seek(0)
+                fp.truncate()
+                fp.write(json.dumps(document))
+                fp.flush()
+            return result
+        finally:
+            fp.close()
+
+    def blocked(self):
+        """
+        Get whether calls to the server are to be skipped.
+        The probe is not claimed.
+        :rtype: bool
+        """
+        return self.remaining() > 0
+
+    def remaining(self):
+        """
+        Get the seconds until calls to the server are allowed.
+        :rtype: float
+        """
+        def fn(state):
+            return self._remaining(state, time.time())
+        return self.update(fn)
+
+    def _remaining(self, state, now):
+        remaining = [0]
+        if state.get('probing'):
+            remaining.append(state['probing'] + PROBE_TIMEOUT - now)
+        if state.get('opened'):
+            remaining.append(state['opened'] + self.cooldown - now)
+        if state.get('not_before'):
+            remaining.append(state['not_before'] - now)
+        return max(remaining)
+
+    def acquire(self):
+        """
+        Get permission to call the server.
+        When the cooling-off period has passed, the caller becomes the probe.
+        :raise CircuitOpen: when calls are to be skipped.
+        """
+        def fn(state):
+            now = time.time()
+            remaining = self._remaining(state, now)
+            if remaining > 0:
+                return remaining
+            if state.get('opened'):
+                state['probing'] = now
+            return 0
+        remaining = self.update(fn)
+        if remaining > 0:
+            raise CircuitOpen('%s unavailable for %d seconds' % (self.server, remaining))
+
+    def succeeded(self):
+        """
+        The call succeeded; close the circuit.
+        """
+        def fn(state):
+            not_before = state.get('not_before', 0)
+            state.clear()
+            if not_before > time.time():
+                state['not_before'] = not_before
+        self.update(fn)
+
+    def defer(self, seconds):
+        """
+        The server requested that calls be deferred.
+        :param seconds: The delay in seconds.
+        :type seconds: int
+        """
+        def fn(state):
+            not_before = time.time() + seconds
+            state.pop('probing', None)
+            if not_before > state.get('not_before', 0):
+                log.info('%s requested retry after %d seconds', self.server, seconds)
+                state['not_before'] = not_before
+        self.update(fn)
+
+    def failed(self):
+        """
+        The server could not be reached; open the circuit when
+        the threshold has been reached or the probe failed.
+        """
+        def fn(state):
+            now = time.time()
+            failures = state.get('failures', 0) + 1
+            state['failures'] = failures
+            if state.pop('probing', None) or failures >= self.threshold:
+                if not state.get('opened') or now - state['opened'] >= self.cooldown:
+                    log.info('%s unreachable, circuit opened', self.server)
+                state['opened'] = now
+        self.update(fn)
+
+    def call(self, fn, *args, **kwargs):
+        """
+        Call the server through the breaker.
+        Only failures to reach the server are counted and deferrals
+        requested by the server are recorded.
+        :param fn: The function calling the server.
+        :type fn: callable
+        :return: What fn returned.
+        :raise CircuitOpen: when calls are to be skipped.
+        """
+        self.acquire()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception, e:
+            delay = retry_after(e)
+            if delay is not None:
+                self.defer(delay)
+            elif unreachable(e):
+                self.failed()
+            else:
+                self.succeeded()
+            raise
+        self.succeeded()
+        return result
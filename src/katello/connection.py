@@ -0,0 +1,522 @@
+#
+# Copyright 2017 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+
+"""
+Keep-alive connection to the server shared by the report uploads.
+The uploads of a process (such as the yum hooks of a transaction) share
+one connection so that the TLS handshake is done once per process.
+Request documents are serialized incrementally (see katello.stream) and
+sent with chunked transfer encoding.
+The server certificate is verified against the rhsm CA certificates
+only; where the ssl module cannot do that (python < 2.7.9) the rhsm
+UEPConnection is used instead.
+The proxy is selected as by the rhsm UEPConnection: the rhsm proxy
+settings, else the HTTPS_PROXY (or HTTP_PROXY) environment, unless the
+server matches no_proxy.  Requests are tunneled through it with CONNECT.
+"""
+
+import os
+import re
+import ssl
+import socket
+import httplib
+
+from base64 import b64encode
+from glob import glob
+from hashlib import sha1
+from logging import getLogger
+from threading import RLock
+from urllib import quote
+from urlparse import urlparse
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from katello import spans
+from katello.breaker import Breaker, RequestFailed
+from katello.stream import iterencode, chunks
+
+
+log = getLogger(__name__)
+
+
+DEFAULT_PREFIX = '/rhsm'
+DEFAULT_PORT = 443
+DEFAULT_PROXY_PORT = 3128
+
+# The environment variables specifying the proxy, by precedence.
+PROXY_ENVIRONMENT = ('HTTPS_PROXY', 'https_proxy', 'HTTP_PROXY', 'http_proxy')
+
+# The statuses of servers (or proxies) refusing chunked requests.
+CHUNKED_REFUSED = (httplib.LENGTH_REQUIRED, httplib.BAD_REQUEST)
+
+# The connections shared by the uploads of this process,
+# by (cert path, key path): (cert digest, connection).
+connections = {}
+lock = RLock()
+
+
+def proxy_environment(environ):
+    """
+    Get the proxy specified by the environment.
+    :param environ: The environment.
+    :type environ: dict
+    :return: (host, port, user, password) or None when not specified.
+    :rtype: tuple
+    """
+    for name in PROXY_ENVIRONMENT:
+        url = environ.get(name)
+        if not url:
+            continue
+        if '://' not in url:
+            url = 'http://%s' % url
+        url = urlparse(url)
+        return url.hostname, url.port, url.username, url.password
+    return None
+
+
+def bypassed(host, no_proxy):
+    """
+    Get whether the proxy is bypassed for a host, as by
+    urllib.proxy_bypass_environment().
+    :param host: The server host.
+    :type host: str
+    :param no_proxy: Comma separated host names or domains, or "*".
+    :type no_proxy: str
+    :rtype: bool
+    """
+    if not no_proxy or not host:
+        return False
+    if no_proxy.strip() == '*':
+        return True
+    for name in no_proxy.split(','):
+        name = name.strip().lstrip('.')
+        if name and re.match(r'(.+\.)?%s$' % re.escape(name), host, re.I):
+            return True
+    return False
+
+
+class Settings(object):
+    """
+    The server settings read from the rhsm configuration.
+    """
+
+    def __init__(self, cfg=None, environ=None):
+        """
+        :param cfg: The rhsm configuration, default: the system configuration.
+        :param environ: The environment, default: os.environ.
+        :type environ: dict
+        """
+        if cfg is None:
+            from rhsm.config import initConfig
+            cfg = initConfig()
+        if environ is None:
+            environ = os.environ
+
+        def get(section, name, default=None):
+            try:
+                return cfg.get(section, name) or default
+            except Exception:
+                return default
+
+        self.host = get('server', 'hostname')
+        self.port = int(get('server', 'port', DEFAULT_PORT))
+        self.prefix = get('server', 'prefix', DEFAULT_PREFIX).rstrip('/')
+        self.insecure = str(get('server', 'insecure', '0')).lower() in ('1', 'true', 'yes', 'on')
+        self.ca_cert_dir = get('rhsm', 'ca_cert_dir', '/etc/rhsm/ca/')
+        self.proxy_host = get('server', 'proxy_hostname')
+        self.proxy_port = get('server', 'proxy_port')
+        self.proxy_user = get('server', 'proxy_user')
+        self.proxy_password = get('server', 'proxy_password')
+        if not self.proxy_host:
+            proxy = proxy_environment(environ)
+            if proxy:
+                self.proxy_host, self.proxy_port, self.proxy_user, self.proxy_password = proxy
+        self.no_proxy = get('server', 'no_proxy') or environ.get('NO_PROXY') or environ.get('no_proxy')
+        if bypassed(self.host, self.no_proxy):
+            self.proxy_host = None
+        self.proxy_port = int(self.proxy_port or DEFAULT_PROXY_PORT)
+
+
+class Unsupported(Exception):
+    """
+    The python ssl module cannot verify the server.
+    """
+    pass
+
+
+def supported():
+    """
+    Get whether Connection can be used: the python ssl module must
+    support contexts (python >= 2.7.9) to verify the server certificate
+    against the rhsm CA certificates only.
+    :rtype: bool
+    """
+    return hasattr(ssl, 'SSLContext') and hasattr(ssl.SSLContext, 'check_hostname')
+
+
+def create(cert_file, key_file, settings=None):
+    """
+    Create a connection.
+    The rhsm UEPConnection is used when Connection is not supported.
+    :param cert_file: The consumer certificate path.
+    :type cert_file: str
+    :param key_file: The consumer key path.
+    :type key_file: str
+    :param settings: The server settings, default: read from rhsm.
+    :type settings: Settings
+    :rtype: Connection|UEPAdapter
+    """
+    if supported():
+        return Connection(cert_file, key_file, settings)
+    return UEPAdapter(cert_file, key_file)
+
+
+def certificate_digest(cert_file):
+    """
+    Get the digest of a certificate.
+    :param cert_file: The certificate path.
+    :type cert_file: str
+    :return: A hex digest or None when not readable.
+    :rtype: str
+    """
+    try:
+        fp = open(cert_file)
+        try:
+            return sha1(fp.read()).hexdigest()
+        finally:
+            fp.close()
+    except IOError:
+        return None
+
+
+def shared(cert_file, key_file, settings=None):
+    """
+    Get the connection shared by the uploads of this process.
+    The connection is replaced when the certificate was rotated.
+    :param cert_file: The consumer certificate path.
+    :type cert_file: str
+    :param key_file: The consumer key path.
+    :type key_file: str
+    :param settings: The server settings, default: read from rhsm.
+    :type settings: Settings
+    :rtype: Connection|UEPAdapter
+    """
+    key = (cert_file, key_file)
+    digest = certificate_digest(cert_file)
+    lock.acquire()
+    try:
+        if key in connections:
+            current, conn = connections[key]
+            if current == digest:
+                return conn
+            conn.close()
+        conn = create(cert_file, key_file, settings)
+        connections[key] = (digest, conn)
+        return conn
+    finally:
+        lock.release()
+
+
+class Connection(object):
+    """
+    A keep-alive HTTPS connection authenticated with the consumer
+    certificate.  The connection is opened on the first request and
+    re-opened when the server closed it.  Requests made by concurrent
+    threads are sent one at a time.
+    Provides the UEPConnection methods used by the uploads.
+    :ivar settings: The server settings.
+    :type settings: Settings
+    :ivar compress: Request documents are sent gzip compressed.
+    :type compress: bool
+    :ivar chunked: Request documents are streamed with chunked transfer
+        encoding.  Cleared when the server (or a proxy) refuses it, after
+        which documents are sent buffered with a Content-Length.
+    :type chunked: bool
+    """
+
+    def __init__(self, cert_file, key_file, settings=None, compress=False):
+        """
+        :param cert_file: The consumer certificate path.
+        :type cert_file: str
+        :param key_file: The consumer key path.
+        :type key_file: str
+        :param settings: The server settings, default: read from rhsm.
+        :type settings: Settings
+        :param compress: Send request documents gzip compressed; the
+            server must accept the gzip Content-Encoding.
+        :type compress: bool
+        """
+        self.cert_file = cert_file
+        self.key_file = key_file
+        self.settings = settings or Settings()
+        self.compress = compress
+        self.chunked = True
+        self.conn = None
+        self.lock = RLock()
+
+    def context(self):
+        """
+        Build the SSL context.
+        The server certificate is verified against the CA certificates
+        of the rhsm ca_cert_dir only, unless rhsm is configured insecure.
+        :return: The context.
+        :raise Unsupported: when contexts are not supported (python < 2.7.9).
+        """
+        if not supported():
+            raise Unsupported('SSL contexts not supported')
+        settings = self.settings
+        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+        if settings.insecure:
+            context.verify_mode = ssl.CERT_NONE
+        else:
+            context.verify_mode = ssl.CERT_REQUIRED
+            context.check_hostname = True
+            for path in sorted(glob(os.path.join(settings.ca_cert_dir, '*.pem'))):
+                context.load_verify_locations(path)
+        context.load_cert_chain(self.cert_file, self.key_file)
+        return context
+
+    def open(self):
+        """
+        Open the HTTPS connection.
+        :rtype: httplib.HTTPSConnection
+        """
+        settings = self.settings
+        host, port = settings.host, settings.port
+        if settings.proxy_host:
+            host, port = settings.proxy_host, settings.proxy_port
+        conn = httplib.HTTPSConnection(host, port, context=self.context())
+        if settings.proxy_host:
+            headers = {}
+            if settings.proxy_user:
+                credentials = '%s:%s' % (settings.proxy_user, settings.proxy_password or '')
+                headers['Proxy-Authorization'] = 'Basic %s' % b64encode(credentials)
+            tunnel = getattr(conn, 'set_tunnel', None) or conn._set_tunnel
+            tunnel(settings.host, settings.port, headers)
+        return conn
+
+    @spans.traced('http.request')
+    def request(self, method, path, document=None):
+        """
+        Send a request.
+        A request failing on a re-used connection is sent again
+        on a new connection.  A document refused with chunked transfer
+        encoding (411 or 400) is sent again buffered.
+        :param method: The HTTP method.
+        :type method: str
+        :param path: The path below the server prefix.
+        :type path: str
+        :param document: The (optional) JSON document to send.  It may
+            contain re-iterable objects serialized as arrays.
+        :return: The decoded reply.
+        :raise RequestFailed: on HTTP error status.
+        """
+        headers = {'Accept': 'application/json'}
+        url = self.settings.prefix + path
+        self.lock.acquire()
+        try:
+            chunked = self.chunked
+            response, content = self.exchange(method, url, document, headers, chunked)
+            if document is not None and chunked and response.status in CHUNKED_REFUSED:
+                response, content = self.exchange(method, url, document, headers, False)
+                if response.status not in CHUNKED_REFUSED:
+                    log.info('chunked requests refused, sending buffered requests')
+                    self.chunked = False
+        finally:
+            self.lock.release()
+        if response.status >= 400:
+            raise RequestFailed(response.status, response.reason, dict(response.getheaders()))
+        if not content:
+            return None
+        try:
+            return json.loads(content)
+        except ValueError:
+            return None
+
+    def exchange(self, method, url, document, headers, chunked):
+        """
+        Send a request and read the response.
+        The caller holds the lock.
+        :param method: The HTTP method.
+        :type method: str
+        :param url: The request URL.
+        :type url: str
+        :param document: The (optional) JSON document to send.
+        :param headers: The request headers.
+        :type headers: dict
+        :param chunked: Stream the document as a chunked body.
+        :type chunked: bool
+        :return: (response, content)
+        :rtype: tuple
+        """
+        while True:
+            reused = self.conn is not None
+            try:
+                if not reused:
+                    self.conn = self.open()
+                    spans.call('http.connect', self.conn.connect)
+                if document is None:
+                    self.conn.request(method, url, None, headers)
+                else:
+                    spans.call('http.send', self.send, method, url, document, headers, chunked)
+                response = self.conn.getresponse()
+                content = response.read()
+                break
+            except (httplib.HTTPException, socket.error):
+                self.close()
+                if not reused:
+                    raise
+                log.debug('connection closed by the server, reconnecting')
+        if response.will_close:
+            self.close()
+        return response, content
+
+    def send(self, method, url, document, headers, chunked=True):
+        """
+        Send a request with the document streamed as a chunked body,
+        or buffered with a Content-Length.
+        :param method: The HTTP method.
+        :type method: str
+        :param url: The request URL.
+        :type url: str
+        :param document: The JSON document to send.
+        :param headers: The request headers.
+        :type headers: dict
+        :param chunked: Stream the document as a chunked body.
+        :type chunked: bool
+        """
+        conn = self.conn
+        pieces = chunks(iterencode(document), compress=self.compress)
+        conn.putrequest(method, url, skip_accept_encoding=True)
+        for name, value in headers.items():
+            conn.putheader(name, value)
+        conn.putheader('Content-Type', 'application/json')
+        if self.compress:
+            conn.putheader('Content-Encoding', 'gzip')
+        if not chunked:
+            body = ''.join(pieces)
+            conn.putheader('Content-Length', str(len(body)))
+            conn.endheaders()
+            conn.send(body)
+            return
+        conn.putheader('Transfer-Encoding', 'chunked')
+        conn.endheaders()
+        for chunk in pieces:
+            conn.send('%x\r\n%s\r\n' % (len(chunk), chunk))
+        conn.send('0\r\n\r\n')
+
+    def put(self, path, document):
+        """
+        Send a PUT request.
+        :param path: The path below the server prefix.
+        :type path: str
+        :param document: The JSON document to send.
+        :return: The decoded reply.
+        """
+        return self.request('PUT', path, document)
+
+    def close(self):
+        """
+        Close the connection.
+        """
+        self.lock.acquire()
+        try:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+        finally:
+            self.lock.release()
+
+    def updatePackageProfile(self, consumer_id, pkg_dicts):
+        """
+        Upload the package profile (as UEPConnection).
+        :param consumer_id: The consumer ID.
+        :type consumer_id: str
+        :param pkg_dicts: The package profile (list or re-iterable).
+        """
+        return self.put('/consumers/%s/packages' % quote(consumer_id), pkg_dicts)
+
+    def report_enabled(self, consumer_id, report):
+        """
+        Report enabled repositories (as enabled_repos_upload.UEP).
+        :param consumer_id: The consumer ID.
+        :type consumer_id: str
+        :param report: The report or delta document to send.
+        :type report: dict
+        :return: The decoded reply.
+        """
+        path = '/systems/%s/enabled_repos' % quote(consumer_id)
+        return Breaker().call(self.put, path, report)
+
+    def report_applicability(self, consumer_id, document):
+        """
+        Upload the errata applicability computed on the host.
+        :param consumer_id: The consumer ID.
+        :type consumer_id: str
+        :param document: The applicability (see katello.applicability).
+        :type document: dict
+        :return: The decoded reply.
+        """
+        return self.put('/consumers/%s/applicability' % quote(consumer_id), document)
+
+
+class UEPAdapter(object):
+    """
+    Provides the Connection methods through the rhsm UEPConnection,
+    used when Connection is not supported.
+    Errors with an HTTP status are raised as RequestFailed.
+    """
+
+    def __init__(self, cert_file, key_file):
+        """
+        :param cert_file: The consumer certificate path.
+        :type cert_file: str
+        :param key_file: The consumer key path.
+        :type key_file: str
+        """
+        from rhsm.connection import UEPConnection
+        self.uep = UEPConnection(cert_file=cert_file, key_file=key_file)
+
+    def put(self, path, document):
+        """
+        Send a PUT request.
+        :param path: The path below the server prefix.
+        :type path: str
+        :param document: The JSON document to send.
+        :return: The decoded reply.
+        """
+        document = json.loads(''.join(iterencode(document)))
+        try:
+            return self.uep.conn.request_put(path, document)
+        except Exception, e:
+            code = getattr(e, 'code', None)
+            if not isinstance(code, int):
+                raise
+            raise RequestFailed(code, str(e), getattr(e, 'headers', None))
+
+    def close(self):
+        pass
+
+    def updatePackageProfile(self, consumer_id, pkg_dicts):
+        return self.put('/consumers/%s/packages' % quote(consumer_id), pkg_dicts)
+
+    def report_enabled(self, consumer_id, report):
+        path = '/systems/%s/enabled_repos' % quote(consumer_id)
+        return Breaker().call(self.put, path, report)
+
+    def report_applicability(self, consumer_id, document):
+        return self.put('/consumers/%s/applicability' % quote(consumer_id), document)
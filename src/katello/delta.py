@@ -0,0 +1,80 @@
+#
+# Copyright 2017 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+
+"""
+Delta uploads of the enabled repositories and tracer reports.
+
+A server supporting deltas replies to an upload with the version of the
+stored report: {"version": <token>}.  The report and its version are
+kept in the cache and the next upload is sent as:
+
+  {"delta": {"base": <token>, "added": <entries>, "removed": [<key>, ...]}}
+
+The server replies with the new version, or 409 (Conflict) when the base
+is not its current version; the full report is then uploaded.  Servers
+replying without a version always get the full report.
+"""
+
+# HTTP status of a delta with an unknown base.
+CONFLICT = 409
+
+
+def diff(acknowledged, current):
+    """
+    Get the entries added (or changed) and removed.
+    :param acknowledged: The entries stored by the server, by key.
+    :type acknowledged: dict
+    :param current: The current entries, by key.
+    :type current: dict
+    :return: (added, removed) where added is the dict of new or changed
+        entries and removed the sorted list of keys.
+    :rtype: tuple
+    """
+    added = {}
+    for key, entry in current.items():
+        if acknowledged.get(key) != entry:
+            added[key] = entry
+    removed = sorted([k for k in acknowledged if k not in current])
+    return added, removed
+
+
+def document(base, added, removed):
+    """
+    Build the delta document.
+    :param base: The version of the report stored by the server.
+    :type base: str
+    :rtype: dict
+    """
+    return dict(delta=dict(base=base, added=added, removed=removed))
+
+
+def version(reply):
+    """
+    Get the version of the stored report.
+    :param reply: The (decoded) reply to an upload.
+    :return: The version or None when deltas are not supported.
+    :rtype: str
+    """
+    if isinstance(reply, dict):
+        return reply.get('version')
+    return None
+
+
+def conflict(exception):
+    """
+    Get whether an upload failed because the base version is unknown.
+    :param exception: The raised exception.
+    :type exception: Exception
+    :rtype: bool
+    """
+    return getattr(exception, 'code', None) == CONFLICT
@@ -0,0 +1,270 @@
+#
+# Copyright 2017 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+
+"""
+Resource policy of the background report work.
+Background processes (the upload commands run from cron, goferd or
+a deferred upload) wait while the load average is above a threshold,
+then lower their CPU and I/O scheduling priority and optionally move to
+a transient systemd scope limiting their CPU and I/O.  Every step is
+best effort: a failure leaves the process running at normal priority.
+
+Policy file content:
+  [resources]
+  nice = <int>
+  ionice = <int>
+  cpu_quota = <percent of one CPU>
+  io_weight = <1-10000>
+  max_load = <float>
+  max_defer = <seconds>
+"""
+
+import os
+import time
+
+from ConfigParser import RawConfigParser
+from logging import getLogger
+from subprocess import Popen
+
+try:
+    import dbus
+except ImportError:
+    dbus = None
+
+
+log = getLogger(__name__)
+
+
+POLICY_FILE = '/etc/katello-agent/resources.conf'
+SECTION = 'resources'
+
+# The cgroup mount point.
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+SYSTEMD = 'org.freedesktop.systemd1'
+SYSTEMD_PATH = '/org/freedesktop/systemd1'
+
+# The scope of a background process: <prefix>-<pid>.scope
+UNIT_PREFIX = 'katello-host-tools'
+DESCRIPTION = 'katello-host-tools background work'
+
+# Seconds between load average checks.
+LOAD_INTERVAL = 15
+
+
+class Policy(object):
+    """
+    The resource policy.
+    :ivar nice: The nice increment.
+    :type nice: int
+    :ivar ionice: The ionice scheduling class (1-3) or 0 to keep it.
+    :type ionice: int
+    :ivar cpu_quota: The CPU limit in percent of one CPU, None = unlimited.
+    :type cpu_quota: int
+    :ivar io_weight: The I/O weight (1-10000), None = default.
+    :type io_weight: int
+    :ivar max_load: The 1 minute load average above which work
+        is deferred, None = never deferred.
+    :type max_load: float
+    :ivar max_defer: The maximum seconds work is deferred.
+    :type max_defer: int
+    """
+
+    def __init__(self, nice=10, ionice=3, cpu_quota=None, io_weight=None, max_load=None, max_defer=900):
+        self.nice = nice
+        self.ionice = ionice
+        self.cpu_quota = cpu_quota
+        self.io_weight = io_weight
+        self.max_load = max_load
+        self.max_defer = max_defer
+
+    @staticmethod
+    def read(path=POLICY_FILE):
+        """
+        Read the policy file.
+        Missing or invalid values are defaulted.
+        :param path: The policy file path.
+        :type path: str
+        :rtype: Policy
+        """
+        policy = Policy()
+        parser = RawConfigParser()
+        try:
+            parser.read(path)
+        except Exception, e:
+            log.warn('%s: %s', path, e)
+            return policy
+        if not parser.has_section(SECTION):
+            return policy
+        for name, convert in (
+                ('nice', int),
+                ('ionice', int),
+                ('cpu_quota', int),
+                ('io_weight', int),
+                ('max_load', float),
+                ('max_defer', int)):
+            if not parser.has_option(SECTION, name):
+                continue
+            value = parser.get(SECTION, name).strip()
+            if not value:
+                setattr(policy, name, None)
+                continue
+            try:
+                setattr(policy, name, convert(value))
+            except ValueError:
+                log.warn('%s: invalid %s: %s', path, name, value)
+        return policy
+
+
+def lower_priority(nice, ionice):
+    """
+    Lower the CPU and I/O scheduling priority of the current process.
+    Failures are ignored; work at normal priority is still useful.
+    :param nice: The nice increment.
+    :type nice: int
+    :param ionice: The ionice scheduling class (1-3) or None.
+    :type ionice: int
+    """
+    if nice:
+        try:
+            os.nice(nice)
+        except OSError:
+            pass
+    if ionice:
+        try:
+            command = ['ionice', '-c', str(ionice), '-p', str(os.getpid())]
+            devnull = open(os.devnull, 'w')
+            try:
+                Popen(command, stdout=devnull, stderr=devnull).wait()
+            finally:
+                devnull.close()
+        except OSError:
+            pass
+
+
+def scope_properties(policy, pid, root=CGROUP_ROOT):
+    """
+    Get the properties of the transient scope limiting the CPU and I/O
+    of a process.
+    :param policy: The resource policy.
+    :type policy: Policy
+    :param pid: The process ID.
+    :type pid: int
+    :param root: The cgroup mount point.
+    :type root: str
+    :return: A list of (name, D-Bus signature, value); empty when the
+        policy does not limit the CPU or I/O.
+    :rtype: list
+    """
+    properties = []
+    if policy.cpu_quota is not None:
+        properties.append(('CPUQuotaPerSecUSec', 't', policy.cpu_quota * 10000))
+    if policy.io_weight is not None:
+        if os.path.exists(os.path.join(root, 'cgroup.controllers')):
+            properties.append(('IOWeight', 't', policy.io_weight))
+        else:
+            # cgroup v1 (blkio)
+            properties.append(('BlockIOWeight', 't', min(max(policy.io_weight, 10), 1000)))
+    if not properties:
+        return properties
+    properties.append(('Description', 's', DESCRIPTION))
+    properties.append(('PIDs', 'au', [pid]))
+    return properties
+
+
+def variant(signature, value):
+    if signature == 'au':
+        return dbus.Array([dbus.UInt32(v) for v in value], signature='u')
+    if signature == 't':
+        return dbus.UInt64(value)
+    return dbus.String(value)
+
+
+def enter_scope(policy, pid=None, root=CGROUP_ROOT):
+    """
+    Move a process to a transient systemd scope limiting its CPU and
+    I/O, as systemd-run --scope does.  The scope (and its cgroup) is
+    created and removed by systemd; the cgroup tree is not written.
+    :param policy: The resource policy.
+    :type policy: Policy
+    :param pid: The process ID, default: the current process.
+    :type pid: int
+    :param root: The cgroup mount point.
+    :type root: str
+    :return: True when moved.
+    :rtype: bool
+    """
+    pid = pid or os.getpid()
+    properties = scope_properties(policy, pid, root)
+    if not properties:
+        return False
+    if dbus is None:
+        log.debug('dbus not available, scope not entered')
+        return False
+    try:
+        bus = dbus.SystemBus(private=True)
+        try:
+            systemd = bus.get_object(SYSTEMD, SYSTEMD_PATH)
+            manager = dbus.Interface(systemd, SYSTEMD + '.Manager')
+            manager.StartTransientUnit(
+                '%s-%d.scope' % (UNIT_PREFIX, pid),
+                'fail',
+                dbus.Array([dbus.Struct((n, variant(t, v))) for n, t, v in properties], signature='(sv)'),
+                dbus.Array([], signature='(sa(sv))'))
+        finally:
+            bus.close()
+        return True
+    except dbus.DBusException, e:
+        log.debug('scope not entered: %s', e)
+        return False
+
+
+def wait_for_load(max_load, max_defer, interval=LOAD_INTERVAL):
+    """
+    Wait while the 1 minute load average is above the threshold.
+    :param max_load: The load average threshold, None = no wait.
+    :type max_load: float
+    :param max_defer: The maximum seconds to wait.
+    :type max_defer: int
+    :param interval: Seconds between checks.
+    :type interval: int
+    :return: The seconds waited.
+    :rtype: float
+    """
+    if max_load is None:
+        return 0
+    started = time.time()
+    while True:
+        try:
+            load = os.getloadavg()[0]
+        except OSError:
+            break
+        waited = time.time() - started
+        if load <= max_load or waited >= max_defer:
+            break
+        log.debug('load average %.2f above %.2f, deferred', load, max_load)
+        time.sleep(max(0, min(interval, max_defer - waited)))
+    return time.time() - started
+
+
+def govern(policy=None):
+    """
+    Apply the resource policy to the current (background) process.
+    :param policy: The policy, default: read from the policy file.
+    :type policy: Policy
+    """
+    if policy is None:
+        policy = Policy.read()
+    wait_for_load(policy.max_load, policy.max_defer)
+    lower_priority(policy.nice, policy.ionice)
+    enter_scope(policy)
@@ -0,0 +1,379 @@
+#
+# Copyright 2017 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+
+"""
+Compact snapshot of the installed packages.
+The rpmdb is read once per change and the result is written to a
+versioned binary index that the package, tracer and zypper hooks
+read instead of walking the rpmdb themselves.
+
+Index layout (little endian):
+  header: magic, version, fingerprint, count
+  columns: epoch (int32), installtime (uint32) and, for each string
+    field, count + 1 offsets (uint32) followed by the string blob.
+"""
+
+import os
+import mmap
+import struct
+
+from array import array
+from hashlib import sha1
+
+from katello import spans
+
+
+INDEX_PATH = '/var/cache/katello-agent/packages.idx'
+
+RPMDB_PATH = '/var/lib/rpm'
+
+# Files whose modification signals an rpmdb change (bdb, ndb or sqlite).
+RPMDB_FILES = ('Packages', 'Packages.db', 'rpmdb.sqlite')
+
+
+def rpmdb_fingerprint(dbpath=RPMDB_PATH):
+    """
+    Get a fingerprint of the rpmdb that changes whenever it is written.
+    :param dbpath: The rpmdb directory.
+    :type dbpath: str
+    :return: A hex digest or None when no rpmdb file is found, in which
+        case whatever depends on the rpmdb must always be rebuilt.
+    :rtype: str
+    """
+    digest = sha1()
+    found = False
+    for fn in RPMDB_FILES:
+        path = os.path.join(dbpath, fn)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        found = True
+        digest.update('%s:%d:%d:%d;' % (fn, st.st_ino, st.st_size, int(st.st_mtime * 1000)))
+    if not found:
+        return None
+    return digest.hexdigest()
+
+
+class Package(object):
+    """
+    An installed package.
+    """
+
+    __slots__ = ('name', 'epoch', 'version', 'release', 'arch', 'installtime', 'vendor')
+
+    FIELDS = __slots__
+
+    def __init__(self, name, epoch, version, release, arch, installtime, vendor):
+        self.name = name
+        self.epoch = epoch
+        self.version = version
+        self.release = release
+        self.arch = arch
+        self.installtime = installtime
+        self.vendor = vendor
+
+    @staticmethod
+    def read(pkg):
+        """
+        Build from a yum package object or an rpm header.
+        :param pkg: A yum package or rpm header.
+        :return: The package.
+        :rtype: Package
+        """
+        if hasattr(pkg, 'pkgtup'):
+            get = lambda f: getattr(pkg, f, None)
+        else:
+            get = lambda f: pkg[f]
+        epoch = get('epoch')
+        if epoch is None or epoch == '':
+            epoch = 0
+        return Package(
+            get('name'),
+            int(epoch),
+            get('version'),
+            get('release'),
+            get('arch'),
+            int(get('installtime') or 0),
+            get('vendor'))
+
+    def profile(self):
+        """
+        The entry in the package profile uploaded to the server.
+        :rtype: dict
+        """
+        return dict(
+            name=self.name,
+            version=self.version,
+            release=self.release,
+            epoch=self.epoch,
+            arch=self.arch,
+            vendor=self.vendor)
+
+    def __repr__(self):
+        return '%s-%s:%s-%s.%s' % (self.name, self.epoch, self.version, self.release, self.arch)
+
+
+class Snapshot(object):
+    """
+    Column oriented, memory-mappable package index.
+    """
+
+    MAGIC = 'KPKG'
+    VERSION = 1
+    HEADER = struct.Struct('<4sH40sI')
+    STRINGS = ('name', 'version', 'release', 'arch', 'vendor')
+
+    @staticmethod
+    def build(packages, fingerprint):
+        """
+        Build the index from packages.
+        :param packages: An iterable of: Package.
+        :param fingerprint: The rpmdb fingerprint.
+        :type fingerprint: str
+        :return: The index.
+        :rtype: Snapshot
+        """
+        epoch = array('i')
+        installtime = array('I')
+        strings = dict([(f, (array('I', [0]), [])) for f in Snapshot.STRINGS])
+        count = 0
+        for p in packages:
+            count += 1
+            epoch.append(p.epoch)
+            installtime.append(p.installtime)
+            for f in Snapshot.STRINGS:
+                offsets, blob = strings[f]
+                value = getattr(p, f) or ''
+                blob.append(value)
+                offsets.append(offsets[-1] + len(value))
+        parts = [Snapshot.HEADER.pack(Snapshot.MAGIC, Snapshot.VERSION, fingerprint, count)]
+        parts.append(Snapshot.le(epoch).tostring())
+        parts.append(Snapshot.le(installtime).tostring())
+        for f in Snapshot.STRINGS:
+            offsets, blob = strings[f]
+            parts.append(Snapshot.le(offsets).tostring())
+            parts.append(''.join(blob))
+        return Snapshot(''.join(parts))
+
+    @staticmethod
+    def le(column):
+        """
+        Get the column in little endian byte order.
+        """
+        if struct.pack('=H', 1) != struct.pack('<H', 1):
+            column = array(column.typecode, column)
+            column.byteswap()
+        return column
+
+    @staticmethod
+    def load(path=INDEX_PATH):
+        """
+        Memory map an index written by write().
+        :param path: The index path.
+        :type path: str
+        :return: The index or None when missing or not valid.
+        :rtype: Snapshot
+        """
+        try:
+            fp = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            except (mmap.error, ValueError):
+                return None
+        finally:
+            fp.close()
+        try:
+            return Snapshot(buf)
+        except ValueError:
+            buf.close()
+            return None
+
+    def __init__(self, buf):
+        """
+        :param buf: The index content.
+        :type buf: str|mmap
+        """
+        if len(buf) < self.HEADER.size:
+            raise ValueError('index truncated')
+        magic, version, fingerprint, count = self.HEADER.unpack_from(buf, 0)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError('index version not supported')
+        self.buf = buf
+        self.fingerprint = fingerprint
+        self.count = count
+        offset = self.HEADER.size
+        self.epoch = offset
+        offset += 4 * count
+        self.installtime = offset
+        offset += 4 * count
+        self.strings = {}
+        for f in self.STRINGS:
+            offsets = offset
+            offset += 4 * (count + 1)
+            if offset > len(buf):
+                raise ValueError('index truncated')
+            end, = struct.unpack_from('<I', buf, offsets + 4 * count)
+            self.strings[f] = (offsets, offset)
+            offset += end
+        if offset != len(buf):
+            raise ValueError('index size not valid')
+
+    def string(self, field, n):
+        offsets, blob = self.strings[field]
+        start, end = struct.unpack_from('<II', self.buf, offsets + 4 * n)
+        return self.buf[blob + start:blob + end]
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, n):
+        if n < 0 or n >= self.count:
+            raise IndexError(n)
+        epoch, = struct.unpack_from('<i', self.buf, self.epoch + 4 * n)
+        installtime, = struct.unpack_from('<I', self.buf, self.installtime + 4 * n)
+        return Package(
+            self.string('name', n),
+            epoch,
+            self.string('version', n),
+            self.string('release', n),
+            self.string('arch', n),
+            installtime,
+            self.string('vendor', n) or None)
+
+    def __iter__(self):
+        for n in xrange(self.count):
+            yield self[n]
+
+    def write(self, path=INDEX_PATH):
+        """
+        Atomically write the index.
+        :param path: The index path.
+        :type path: str
+        """
+        tmp = '%s.%d' % (path, os.getpid())
+        fp = open(tmp, 'wb')
+        try:
+            fp.write(self.buf[:])
+        finally:
+            fp.close()
+        os.rename(tmp, path)
+
+    def close(self):
+        if isinstance(self.buf, mmap.mmap):
+            self.buf.close()
+
+
+def read_rpmdb():
+    """
+    Read the installed packages from the rpmdb.
+    :return: A generator of: Package.
+    """
+    import rpm
+    ts = rpm.TransactionSet()
+    for h in ts.dbMatch():
+        if h['name'] == 'gpg-pubkey':
+            continue
+        yield Package.read(h)
+
+
+@spans.traced('packages.snapshot')
+def snapshot(packages=None, path=INDEX_PATH, dbpath=RPMDB_PATH):
+    """
+    Get the installed package snapshot.
+    The index is reused while the rpmdb fingerprint matches, else it
+    is rebuilt (from packages when specified) and written.  It is
+    always rebuilt (and not written) when the rpmdb is not found.
+    :param packages: An (optional) iterable of yum packages or rpm
+        headers used instead of reading the rpmdb.
+    :param path: The index path.
+    :type path: str
+    :param dbpath: The rpmdb directory.
+    :type dbpath: str
+    :return: The snapshot.
+    :rtype: Snapshot
+    """
+    fingerprint = rpmdb_fingerprint(dbpath)
+    if fingerprint is not None:
+        current = Snapshot.load(path)
+        if current is not None:
+            if current.fingerprint == fingerprint:
+                return current
+            current.close()
+    if packages is None:
+        packages = read_rpmdb()
+    else:
+        packages = (Package.read(p) for p in packages)
+    current = spans.call('packages.build', Snapshot.build, packages, fingerprint or '')
+    if fingerprint is None:
+        return current
+    try:
+        current.write(path)
+    except (IOError, OSError):
+        pass
+    return current
+
+
+class Profile(object):
+    """
+    The package profile entries of a snapshot.
+    Re-iterable; the entries are built while iterated.
+    """
+
+    def __init__(self, snapshot):
+        """
+        :param snapshot: The installed packages.
+        :type snapshot: Snapshot
+        """
+        self.snapshot = snapshot
+
+    def __iter__(self):
+        for p in self.snapshot:
+            yield p.profile()
+
+
+def rpm_profile(snapshot):
+    """
+    Get the snapshot as a subscription-manager RPM profile.
+    :param snapshot: The installed packages.
+    :type snapshot: Snapshot
+    :return: The profile.
+    :rtype: rhsm.profile.RPMProfile
+    """
+    from rhsm.profile import RPMProfile, Package as RPMPackage
+    profile = RPMProfile.__new__(RPMProfile)
+    profile.packages = [
+        RPMPackage(p.name, p.version, p.release, p.arch, epoch=p.epoch, vendor=p.vendor)
+        for p in snapshot]
+    return profile
+
+
+def use_snapshot(snapshot):
+    """
+    Have the subscription-manager profile manager report the snapshot
+    instead of reading the rpmdb again.  Whether and how the profile is
+    uploaded is still decided by subscription-manager.  Nothing is done
+    when the profile manager cannot be injected (older versions).
+    :param snapshot: The installed packages.
+    :type snapshot: Snapshot
+    """
+    try:
+        from subscription_manager import injection as inj
+        manager = inj.require(inj.PROFILE_MANAGER)
+        profile = rpm_profile(snapshot)
+    except (ImportError, AttributeError, KeyError):
+        return
+    manager.current_profile = profile
@@ -0,0 +1,113 @@
+#
+# Copyright 2017 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+
+"""
+Runs the report uploads of the yum plugins concurrently.
+Each plugin gathers what it needs from yum in its posttrans_hook (on
+the main thread), submits the upload and waits in its close_hook.
+Failures are reported on the thread calling wait() through the
+callback supplied by the plugin.
+A process may run several transactions (yum shell, goferd): an upload
+submitted while one by the same name is still running is run after it,
+and wait() forgets the uploads it reported.
+"""
+
+import sys
+
+from threading import Thread, RLock
+
+
+# Submitted tasks not yet reported by wait(), in submission order.
+tasks = []
+
+lock = RLock()
+
+
+class Task(Thread):
+    """
+    A submitted upload.
+    :ivar fn: The upload function.
+    :type fn: callable
+    :ivar failed: Called as failed(exception) when fn raised.
+    :type failed: callable
+    :ivar previous: The task by the same name run before this one.
+    :type previous: Task
+    :ivar exception: The exception raised by fn.
+    :type exception: Exception
+    """
+
+    def __init__(self, name, fn, failed, previous=None):
+        Thread.__init__(self, name=name)
+        self.fn = fn
+        self.failed = failed
+        self.previous = previous
+        self.exception = None
+
+    def run(self):
+        if self.previous is not None:
+            self.previous.join()
+            self.previous = None
+        try:
+            self.fn()
+        except:
+            self.exception = sys.exc_info()[1]
+
+
+def submit(name, fn, failed):
+    """
+    Start an upload.  It runs after the upload by the same
+    name submitted before, when still running.
+    :param name: The task name.
+    :type name: str
+    :param fn: The upload function.
+    :type fn: callable
+    :param failed: Called as failed(exception) by wait() when fn raised.
+    :type failed: callable
+    """
+    lock.acquire()
+    try:
+        previous = None
+        for task in tasks:
+            if task.name == name:
+                previous = task
+        task = Task(name, fn, failed, previous)
+        tasks.append(task)
+        task.start()
+    finally:
+        lock.release()
+
+
+def wait():
+    """
+    Wait for the submitted uploads and report the failures.
+    Each failure is reported once; the reported uploads are forgotten.
+    """
+    lock.acquire()
+    try:
+        pending = list(tasks)
+    finally:
+        lock.release()
+    for task in pending:
+        task.join()
+    reported = []
+    lock.acquire()
+    try:
+        for task in pending:
+            if task in tasks:
+                tasks.remove(task)
+                reported.append(task)
+    finally:
+        lock.release()
+    for task in reported:
+        if task.exception is not None:
+            task.failed(task.exception)
@@ -0,0 +1,307 @@
+#
+# Copyright 2017 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+
+"""
+Process scan cache of the tracer query.
+The files used by each process (its file mappings and the files named
+on its command line) are kept per (pid, start time).  A process is
+read again only when it is new or when a file it uses was replaced
+or removed since the last scan, which is only checked after the
+rpmdb changed.  A process is affected when it uses a replaced file
+or a file changed after it started.
+The applications found by tracer are kept with the rpmdb fingerprint
+and the affected processes, and reused while both are unchanged.
+
+Cache file content:
+  {boot: <int>, time: <float>, rpmdb: <str>,
+   processes: {<pid>: [<start>, [<path>, ...], <affected>]},
+   affected: [<pid>:<start>, ...], apps: <dict>}
+"""
+
+import os
+import time
+
+from logging import getLogger
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from katello.packages import rpmdb_fingerprint, RPMDB_PATH
+
+
+log = getLogger(__name__)
+
+
+PROC = '/proc'
+
+# Suffix of mapped files that were replaced or removed.
+DELETED = ' (deleted)'
+
+
+def boot_time(proc=PROC):
+    """
+    Get the boot time.
+    :param proc: The proc mount point.
+    :type proc: str
+    :return: The boot time (epoch seconds) or 0 when unknown.
+    :rtype: int
+    """
+    try:
+        fp = open(os.path.join(proc, 'stat'))
+        try:
+            for line in fp:
+                if line.startswith('btime '):
+                    return int(line.split()[1])
+        finally:
+            fp.close()
+    except (IOError, ValueError):
+        pass
+    return 0
+
+
+def read(path):
+    """
+    Read a file.
+    :return: The content or None when it cannot be read.
+    :rtype: str
+    """
+    try:
+        fp = open(path)
+        try:
+            return fp.read()
+        finally:
+            fp.close()
+    except IOError:
+        return None
+
+
+def start_time(proc, pid):
+    """
+    Get the start time of a process.
+    :param proc: The proc mount point.
+    :type proc: str
+    :param pid: The process ID.
+    :type pid: str
+    :return: Clock ticks after boot or None when the process exited.
+    :rtype: int
+    """
+    content = read(os.path.join(proc, pid, 'stat'))
+    if not content:
+        return None
+    try:
+        # The command name may contain spaces and parentheses.
+        return int(content[content.rindex(')') + 2:].split()[19])
+    except (ValueError, IndexError):
+        return None
+
+
+def used_files(proc, pid):
+    """
+    Get the files used by a process.
+    :param proc: The proc mount point.
+    :type proc: str
+    :param pid: The process ID.
+    :type pid: str
+    :return: The paths or None when the process exited.
+    :rtype: list
+    """
+    maps = read(os.path.join(proc, pid, 'maps'))
+    if maps is None:
+        return None
+    files = set()
+    for line in maps.splitlines():
+        part = line.split(None, 5)
+        if len(part) == 6 and part[5].startswith('/'):
+            files.add(part[5])
+    cmdline = read(os.path.join(proc, pid, 'cmdline')) or ''
+    for arg in cmdline.split('\0')[1:]:
+        if arg.startswith('/') and os.path.isfile(arg):
+            files.add(arg)
+    return sorted(files)
+
+
+class ScanCache(object):
+    """
+    The process scan cache.
+    :ivar processes: The processes found by the last scan.
+    :type processes: dict
+    :ivar rescanned: The number of processes read by the last scan.
+    :type rescanned: int
+    """
+
+    CACHE_FILE = '/var/cache/katello-agent/tracer-scan.json'
+
+    def __init__(self, path=None, proc=PROC, dbpath=RPMDB_PATH):
+        """
+        :param path: The cache file path, default: CACHE_FILE.
+        :type path: str
+        :param proc: The proc mount point.
+        :type proc: str
+        :param dbpath: The rpmdb directory.
+        :type dbpath: str
+        """
+        self.path = path or self.CACHE_FILE
+        self.proc = proc
+        self.dbpath = dbpath
+        self.boot = boot_time(proc)
+        self.ticks = os.sysconf('SC_CLK_TCK')
+        self.previous = {}
+        self.processes = {}
+        self.rpmdb = None
+        self.rescanned = 0
+        self.time = None
+
+    def load(self):
+        """
+        Load the cache file.
+        The cache of a previous boot is discarded.
+        """
+        content = read(self.path)
+        self.previous = {}
+        if not content:
+            return
+        try:
+            document = json.loads(content)
+        except ValueError:
+            return
+        if isinstance(document, dict) and document.get('boot') == self.boot:
+            self.previous = document
+
+    def changed(self):
+        """
+        Get the files used by the cached processes that were replaced
+        or removed since the last scan.  Only checked when the rpmdb
+        changed since then.
+        :rtype: set
+        """
+        changed = set()
+        if self.rpmdb is not None and self.previous.get('rpmdb') == self.rpmdb:
+            return changed
+        since = self.previous.get('time', 0)
+        checked = set()
+        for start, files, affected in self.previous.get('processes', {}).values():
+            for path in files:
+                if path in checked or path.endswith(DELETED):
+                    continue
+                checked.add(path)
+                try:
+                    if os.stat(path).st_ctime > since:
+                        changed.add(path)
+                except OSError:
+                    changed.add(path)
+        return changed
+
+    def affected(self, start, files, ctimes):
+        """
+        Get whether a process uses a file replaced or changed after it started.
+        :param start: The start time (clock ticks after boot).
+        :type start: int
+        :param files: The files used.
+        :type files: list
+        :param ctimes: The change times by path, updated in place.
+        :type ctimes: dict
+        :rtype: bool
+        """
+        started = self.boot + float(start) / self.ticks
+        for path in files:
+            if path.endswith(DELETED):
+                return True
+            if path not in ctimes:
+                try:
+                    ctimes[path] = os.stat(path).st_ctime
+                except OSError:
+                    ctimes[path] = 0
+            if ctimes[path] > started:
+                return True
+        return False
+
+    def scan(self):
+        """
+        Scan the processes.  Only new processes and processes using
+        a changed file are read.
+        :return: The processes: {<pid>: [<start>, <files>, <affected>]}.
+        :rtype: dict
+        """
+        self.load()
+        self.time = time.time()
+        self.rpmdb = rpmdb_fingerprint(self.dbpath)
+        changed = self.changed()
+        previous = self.previous.get('processes', {})
+        ctimes = {}
+        self.processes = {}
+        self.rescanned = 0
+        try:
+            pids = [p for p in os.listdir(self.proc) if p.isdigit()]
+        except OSError:
+            pids = []
+        for pid in pids:
+            start = start_time(self.proc, pid)
+            if start is None:
+                continue
+            entry = previous.get(pid)
+            if entry and entry[0] == start and not changed.intersection(entry[1]):
+                self.processes[pid] = entry
+                continue
+            files = used_files(self.proc, pid)
+            if files is None:
+                continue
+            self.rescanned += 1
+            self.processes[pid] = [start, files, self.affected(start, files, ctimes)]
+        log.debug('%d processes, %d scanned', len(self.processes), self.rescanned)
+        return self.processes
+
+    def affected_processes(self):
+        """
+        Get the affected processes found by the last scan.
+        :return: Sorted list of: <pid>:<start>.
+        :rtype: list
+        """
+        return sorted(['%s:%s' % (pid, entry[0]) for pid, entry in self.processes.items() if entry[2]])
+
+    def apps(self):
+        """
+        Get the applications found by tracer when neither the rpmdb nor
+        the affected processes changed since.
+        :return: The applications or None when tracer is to be queried.
+        :rtype: dict
+        """
+        previous = self.previous
+        if self.rpmdb is None or previous.get('rpmdb') != self.rpmdb:
+            return None
+        if previous.get('affected') != self.affected_processes():
+            return None
+        return previous.get('apps')
+
+    def save(self, apps):
+        """
+        Write the cache.
+        :param apps: The applications found by tracer.
+        :type apps: dict
+        """
+        document = dict(
+            boot=self.boot,
+            time=self.time,
+            rpmdb=self.rpmdb,
+            processes=self.processes,
+            affected=self.affected_processes(),
+            apps=apps)
+        try:
+            fp = open(self.path, 'w')
+            try:
+                fp.write(json.dumps(document))
+            finally:
+                fp.close()
+        except IOError, e:
+            log.debug('scan cache not written: %s', e)
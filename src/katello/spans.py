@@ -0,0 +1,217 @@
+#
+# Copyright 2017 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+
+"""
+Timing spans of the report pipelines.
+A span times one phase (such as reading the rpmdb or an HTTP request)
+and records the span it was started in as its parent.  Finished spans
+are written as JSON lines to a rotating log:
+
+  {"id": <str>, "parent": <str>, "name": <str>, "start": <float>,
+   "duration": <float>, "pid": <int>, "error": <str>, <attribute>: ...}
+
+Spans are disabled by default and cost one test when disabled.  They are
+enabled by the plugin configuration or the KATELLO_TIMING environment
+variable.
+"""
+
+import os
+import sys
+import time
+import logging
+
+from itertools import count
+from logging.handlers import RotatingFileHandler
+from threading import local
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+LOG_FILE = '/var/log/katello-agent/spans.log'
+MAX_BYTES = 1048576
+BACKUP_COUNT = 3
+
+ENVIRONMENT = 'KATELLO_TIMING'
+
+
+# Spans are recorded.
+enabled = False
+
+# The spans log.
+log = logging.getLogger('katello.spans')
+log.propagate = False
+
+# The open spans of the current thread.
+context = local()
+
+# Span numbers, unique within a process.
+numbers = count(1)
+
+
+def enable(path=LOG_FILE, max_bytes=MAX_BYTES, backup_count=BACKUP_COUNT):
+    """
+    Enable spans.
+    Nothing is recorded when the log cannot be opened.
+    :param path: The log path.
+    :type path: str
+    :return: True when enabled.
+    :rtype: bool
+    """
+    global enabled
+    if enabled:
+        return True
+    try:
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+    except (IOError, OSError), e:
+        logging.getLogger(__name__).debug('spans not enabled: %s', e)
+        return False
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    log.addHandler(handler)
+    log.setLevel(logging.INFO)
+    enabled = True
+    return True
+
+
+def disable():
+    """
+    Disable spans.
+    """
+    global enabled
+    enabled = False
+    for handler in list(log.handlers):
+        log.removeHandler(handler)
+        handler.close()
+
+
+def configured(value):
+    """
+    Enable spans when configured.
+    :param value: The configured value (bool) or None when not
+        configured; the environment is then used.
+    :return: True when enabled.
+    :rtype: bool
+    """
+    if value is None:
+        value = os.environ.get(ENVIRONMENT, '').lower() in ('1', 'true', 'yes', 'on')
+    if value:
+        return enable()
+    return False
+
+
+def stack():
+    try:
+        return context.stack
+    except AttributeError:
+        context.stack = []
+        return context.stack
+
+
+class Span(object):
+    """
+    A timed phase.
+    :ivar name: The phase name.
+    :type name: str
+    :ivar attributes: Recorded with the span.
+    :type attributes: dict
+    """
+
+    def __init__(self, name, **attributes):
+        """
+        Start the span.
+        :param name: The phase name.
+        :type name: str
+        """
+        self.name = name
+        self.attributes = attributes
+        self.recorded = enabled
+        if not self.recorded:
+            return
+        spans = stack()
+        self.id = '%x-%x' % (os.getpid(), numbers.next())
+        self.parent = None
+        if spans:
+            self.parent = spans[-1].id
+        spans.append(self)
+        self.start = time.time()
+
+    def finish(self, error=None):
+        """
+        Finish the span and write it.
+        :param error: The (optional) exception raised by the phase.
+        :type error: Exception
+        """
+        if not self.recorded:
+            return
+        self.recorded = False
+        duration = time.time() - self.start
+        spans = stack()
+        if self in spans:
+            del spans[spans.index(self):]
+        record = dict(self.attributes)
+        record.update(
+            id=self.id,
+            parent=self.parent,
+            name=self.name,
+            start=round(self.start, 6),
+            duration=round(duration, 6),
+            pid=os.getpid())
+        if error is not None:
+            record['error'] = '%s: %s' % (error.__class__.__name__, error)
+        try:
+            log.info(json.dumps(record, default=str))
+        except Exception:
+            pass
+
+
+def call(name, fn, *args, **kwargs):
+    """
+    Call a function in a span.
+    :param name: The phase name.
+    :type name: str
+    :param fn: The function.
+    :type fn: callable
+    :return: What fn returned.
+    """
+    if not enabled:
+        return fn(*args, **kwargs)
+    span = Span(name)
+    try:
+        result = fn(*args, **kwargs)
+    except Exception:
+        span.finish(sys.exc_info()[1])
+        raise
+    span.finish()
+    return result
+
+
+def traced(name):
+    """
+    Decorator running the function in a span.
+    :param name: The phase name.
+    :type name: str
+    """
+    def decorator(fn):
+        def _fn(*args, **kwargs):
+            if not enabled:
+                return fn(*args, **kwargs)
+            return call(name, fn, *args, **kwargs)
+        _fn.__name__ = fn.__name__
+        _fn.__doc__ = fn.__doc__
+        return _fn
+    return decorator
@@ -0,0 +1,123 @@
+#
+# Copyright 2017 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+
+"""
+Incremental JSON serialization of the uploaded reports.
+Lists, tuples and other iterables are serialized one item at a time so
+a report (such as the package profile) can be produced by a generator
+and written or sent without building the whole document or its JSON
+text in memory.  Dicts of scalars are encoded in one step.
+"""
+
+import zlib
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+# Size of the chunks produced by chunks().
+CHUNK_SIZE = 65536
+
+ENCODER = json.JSONEncoder(separators=(',', ':'))
+
+SCALARS = (basestring, int, long, float, bool, type(None))
+
+
+def iterencode(document):
+    """
+    Serialize a document incrementally.
+    Iterables other than dicts are serialized as JSON arrays; they are
+    iterated each time the document is serialized, so re-iterable
+    objects should be used rather than generators when it may be
+    serialized more than once (such as when a request is retried).
+    :param document: The document.
+    :return: A generator of JSON text pieces.
+    """
+    if isinstance(document, SCALARS):
+        yield ENCODER.encode(document)
+    elif isinstance(document, dict):
+        scalars = True
+        for value in document.itervalues():
+            if not isinstance(value, SCALARS):
+                scalars = False
+                break
+        if scalars:
+            yield ENCODER.encode(document)
+            return
+        separator = '{'
+        for key, value in document.iteritems():
+            yield separator + ENCODER.encode(key) + ':'
+            separator = ','
+            for piece in iterencode(value):
+                yield piece
+        if separator == '{':
+            yield separator
+        yield '}'
+    else:
+        separator = '['
+        for item in document:
+            yield separator
+            separator = ','
+            for piece in iterencode(item):
+                yield piece
+        if separator == '[':
+            yield separator
+        yield ']'
+
+
+def chunks(pieces, size=CHUNK_SIZE, compress=False):
+    """
+    Join text pieces in chunks.
+    :param pieces: The text pieces.
+    :param size: The (approximate) chunk size.
+    :type size: int
+    :param compress: Compress (gzip) the text.
+    :type compress: bool
+    :return: A generator of chunks.
+    """
+    compressor = None
+    if compress:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    buffered = []
+    length = 0
+    for piece in pieces:
+        if isinstance(piece, unicode):
+            piece = piece.encode('utf-8')
+        buffered.append(piece)
+        length += len(piece)
+        if length < size:
+            continue
+        chunk = ''.join(buffered)
+        buffered = []
+        length = 0
+        if compressor is not None:
+            chunk = compressor.compress(chunk)
+        if chunk:
+            yield chunk
+    chunk = ''.join(buffered)
+    if compressor is not None:
+        chunk = compressor.compress(chunk) + compressor.flush()
+    if chunk:
+        yield chunk
+
+
+def dump(document, fp):
+    """
+    Write a document to a file incrementally.
+    :param document: The document.
+    :param fp: An open file.
+    """
+    for chunk in chunks(iterencode(document)):
+        fp.write(chunk)
@@ -17,6 +17,10 @@ except ImportError:
 
 from rhsm.connection import UEPConnection, RemoteServerException, GoneException
 
+from katello import delta, posttrans, spans
+from katello.breaker import Breaker, CircuitOpen, RequestFailed
+from katello.connection import shared
+
 try:
     from subscription_manager.injectioninit import init_dep_injection
     init_dep_injection()
@@ -26,19 +30,95 @@ except ImportError:
 requires_api_version = '2.3'
 plugin_type = (TYPE_CORE, TYPE_INTERACTIVE)
 
-def upload_enabled_repos_report():
-    path = '/etc/yum.repos.d/redhat.repo'
-    uep = UEP()
-    report = EnabledReport(path)
+REPOSITORY_PATH = '/etc/yum.repos.d/redhat.repo'
+
+# The report was submitted by a posttrans_hook since the last close_hook.
+submitted = False
+
+@spans.traced('enabled_repos.upload')
+def upload_enabled_repos_report(report=None, uep=None, consumer_id=None):
+    """
+    Upload the enabled repos report unless unchanged since the last upload.
+    :param report: An (optional) report already generated.
+    :type report: EnabledReport
+    :param uep: An (optional) open connection.
+    :type uep: katello.connection.Connection
+    :param consumer_id: The (optional) consumer ID.
+    :type consumer_id: str
+    """
+    if uep is None:
+        uep = UEP()
+    if report is None:
+        report = EnabledReport(REPOSITORY_PATH)
     content = report.content
-    consumer_id = lookup_consumer_id()
+    if consumer_id is None:
+        consumer_id = lookup_consumer_id()
     if consumer_id is None:
         error_message('Cannot upload enabled repos report, is this client registered?')
     else:
         cache = EnabledRepoCache(consumer_id, content)
         if not cache.is_valid():
-            uep.report_enabled(consumer_id, content)
-            cache.save()
+            try:
+                version = send_report(uep, consumer_id, content, cache.acknowledged())
+            except (RemoteServerException, GoneException, RequestFailed), e:
+                error_message(str(e))
+                return
+            cache.save(version)
+
+@spans.traced('enabled_repos.send')
+def send_report(uep, consumer_id, content, acknowledged=None):
+    """
+    Send the report as a delta of the acknowledged report when possible.
+    The full report is sent when the server does not know the base version.
+    :param uep: The connection.
+    :type uep: UEP
+    :param consumer_id: The consumer ID.
+    :type consumer_id: str
+    :param content: The report content.
+    :type content: dict
+    :param acknowledged: The (content, version) stored by the server.
+    :type acknowledged: tuple
+    :return: The version of the report stored by the server.
+    :rtype: str
+    """
+    if acknowledged is not None:
+        document = report_delta(content, *acknowledged)
+        if document is not None:
+            try:
+                return delta.version(uep.report_enabled(consumer_id, document))
+            except Exception, e:
+                if not delta.conflict(e):
+                    raise
+    return delta.version(uep.report_enabled(consumer_id, content))
+
+def report_delta(content, acknowledged, version):
+    """
+    Build the delta of the enabled repositories.
+    Repositories are added (or replaced) and removed by repositoryid.
+    :param content: The report content.
+    :type content: dict
+    :param acknowledged: The report content stored by the server.
+    :type acknowledged: dict
+    :param version: The version of the report stored by the server.
+    :type version: str
+    :return: The delta document or None when more than the
+        repositories changed.
+    :rtype: dict
+    """
+    def split(report):
+        enabled = dict(report['enabled_repos'])
+        repos = dict([(r['repositoryid'], r) for r in enabled.pop('repos')])
+        return repos, dict(report, enabled_repos=enabled)
+
+    try:
+        repos, other = split(content)
+        stored, stored_other = split(acknowledged)
+    except (KeyError, TypeError):
+        return None
+    if other != stored_other:
+        return None
+    added, removed = delta.diff(stored, repos)
+    return delta.document(version, [added[k] for k in sorted(added)], removed)
 
 def error_message(msg):
     sys.stderr.write(msg + "\n")
@@ -63,21 +143,45 @@ class EnabledRepoCache:
         except OSError:
             pass
 
-    def is_valid(self):
+    def read(self):
         if not os.path.isfile(self.CACHE_FILE):
-            return False
+            return {}
         file = open(self.CACHE_FILE)
         try:
-            return self.data() == json.loads(file.read())
-        except ValueError:
-            return False
+            try:
+                cached = json.loads(file.read())
+            except ValueError:
+                return {}
+        finally:
+            file.close()
+        if not isinstance(cached, dict):
+            return {}
+        return cached
+
+    def is_valid(self):
+        cached = self.read()
+        return self.consumer_id in cached and cached[self.consumer_id] == self.content
+
+    def acknowledged(self):
+        """
+        Get the report last stored by the server with its version.
+        :return: (content, version) or None when not versioned.
+        :rtype: tuple
+        """
+        cached = self.read()
+        version = cached.get('version')
+        if version and self.consumer_id in cached:
+            return cached[self.consumer_id], version
 
     def data(self):
         return {self.consumer_id: self.content}
 
-    def save(self):
+    def save(self, version=None):
+        data = self.data()
+        if version:
+            data['version'] = version
         file = open(self.CACHE_FILE, 'w')
-        file.write(json.dumps(self.data()))
+        file.write(json.dumps(data))
         file.close()
 
 class UEP(UEPConnection):
@@ -95,14 +199,12 @@ class UEP(UEPConnection):
         Report enabled repositories to the UEP.
         :param consumer_id: The consumer ID.
         :type consumer_id: str
-        :param report: The report to send.
+        :param report: The report or delta document to send.
         :type report: dict
+        :return: The decoded reply.
         """
         method = '/systems/%s/enabled_repos' % self.sanitize(consumer_id)
-        try:
-            self.conn.request_put(method, report)
-        except (RemoteServerException, GoneException), e:
-            error_message(str(e))
+        return Breaker().call(self.conn.request_put, method, report)
 
 class EnabledReport(object):
     """
@@ -139,36 +241,84 @@ class EnabledReport(object):
         return dict(repos=enabled)
 
     @staticmethod
-    def generate(repofn):
+    @spans.traced('enabled_repos.generate')
+    def generate(repofn, yb=None):
         """
         Generate the report content.
         :param repofn: The .repo file basename used to filter the report.
         :type repofn: str
+        :param yb: An (optional) yum lib shared with the caller.
+        :type yb: YumBase
         :return: The report content
         :rtype: dict
         """
-        yb = YumBase()
+        if yb is not None:
+            return dict(enabled_repos=EnabledReport.find_enabled(yb, repofn))
+        yb = spans.call('yum.init', YumBase)
         try:
             return dict(enabled_repos=EnabledReport.find_enabled(yb, repofn))
         finally:
             yb.close()
 
-    def __init__(self, path):
+    def __init__(self, path, yb=None):
         """
         :param path: A .repo file path used to filter the report.
         :type path: str
+        :param yb: An (optional) yum lib shared with the caller.
+        :type yb: YumBase
         """
-        self.content = EnabledReport.generate(os.path.basename(path))
+        if yb is None:
+            self.content = EnabledReport.generate(os.path.basename(path))
+        else:
+            self.content = EnabledReport.generate(os.path.basename(path), yb)
 
     def __str__(self):
         return str(self.content)
 
-def close_hook(conduit):
+def init_hook(conduit):
+    spans.configured(conduit.confBool("main", "timing") or None)
+
+def posttrans_hook(conduit):
+    """
+    Generate the report and upload it concurrently with the
+    other posttrans reports.
+    """
+    global submitted
+    def failed(exception):
+        if isinstance(exception, CircuitOpen):
+            if not conduit.confBool("main", "supress_debug"):
+                conduit.info(2, "%s" % exception)
+            return
+        if not conduit.confBool("main", "supress_errors"):
+            conduit.error(2, "Unable to upload Enabled Repositories Report")
+
+    if Breaker().blocked():
+        failed(CircuitOpen("Server unavailable, skipping Enabled Repositories Report upload"))
+        return
     if not conduit.confBool("main", "supress_debug"):
         conduit.info(2, "Uploading Enabled Repositories Report")
     try:
-        upload_enabled_repos_report()
-    except:
-        if not conduit.confBool("main", "supress_errors"):
-            conduit.error(2, "Unable to upload Enabled Repositories Report")
+        report = EnabledReport(REPOSITORY_PATH)
+    except Exception, e:
+        failed(e)
+        return
+    submitted = True
+    posttrans.submit('enabled_repos', lambda: upload_enabled_repos_report(report, shared(
+        ConsumerIdentity.certpath(), ConsumerIdentity.keypath())), failed)
+
+def close_hook(conduit):
+    global submitted
+    if not submitted and not Breaker().blocked():
+        if not conduit.confBool("main", "supress_debug"):
+            conduit.info(2, "Uploading Enabled Repositories Report")
+        try:
+            upload_enabled_repos_report()
+        except CircuitOpen, e:
+            if not conduit.confBool("main", "supress_debug"):
+                conduit.info(2, "%s" % e)
+        except:
+            if not conduit.confBool("main", "supress_errors"):
+                conduit.error(2, "Unable to upload Enabled Repositories Report")
+    submitted = False
+    posttrans.wait()
 
@@ -27,6 +27,12 @@ try:
 except ImportError:
   from subscription_manager.certlib import ConsumerIdentity
 
+from katello import applicability, posttrans, spans
+from katello.applicability import ApplicabilityCache
+from katello.breaker import Breaker, CircuitOpen, RequestFailed
+from katello.connection import shared
+from katello.packages import snapshot, use_snapshot
+
 from rhsm import connection
 
 try:
@@ -40,16 +46,31 @@ CACHE_FILE = '/var/lib/rhsm/packages/packages.json'
 requires_api_version = '2.3'
 plugin_type = (TYPE_CORE, TYPE_INTERACTIVE)
 
+# The cache directories of the enabled repositories.
+repodirs = []
+
+# The applicability was submitted by a posttrans_hook since the last close_hook.
+submitted = False
+
 def remove_cache():
     try:
         os.remove(CACHE_FILE)
     except OSError:
         pass
 
-def upload_package_profile():
-    uep = connection.UEPConnection(cert_file=ConsumerIdentity.certpath(),
-                                   key_file=ConsumerIdentity.keypath())
-    get_manager().profilelib._do_update()
+@spans.traced('package_profile.upload')
+def upload_package_profile(installed=None):
+    """
+    Upload the package profile through subscription-manager, which
+    skips it when unchanged or not wanted by the server.
+    :param installed: The (optional) installed package snapshot
+        reported instead of subscription-manager reading the rpmdb.
+    :type installed: katello.packages.Snapshot
+    """
+    if installed is None:
+        installed = snapshot()
+    use_snapshot(installed)
+    spans.call('package_profile.send', Breaker().call, get_manager().profilelib._do_update)
 
 def get_manager():
     if 'subscription_manager.action_client' in sys.modules:
@@ -61,12 +82,108 @@ def get_manager():
         mgr = certmgr.CertManager(uep=uep)
     return mgr
 
+@spans.traced('applicability.upload')
+def upload_applicability(installed=None, repodirs=(), uep=None, consumer_id=None):
+    """
+    Compute the applicable errata from the cached updateinfo of the
+    repositories and upload them unless unchanged since the last upload.
+    Nothing is computed while neither the rpmdb nor the updateinfo changed;
+    a document computed but not uploaded is sent again.  Nothing is done
+    for a while once the server was found not supporting the upload.
+    :param installed: The (optional) installed package snapshot.
+    :type installed: katello.packages.Snapshot
+    :param repodirs: The repository cache directories.
+    :type repodirs: list
+    :param uep: An (optional) open connection.
+    :type uep: katello.connection.Connection
+    :param consumer_id: The (optional) consumer ID.
+    :type consumer_id: str
+    """
+    cache = ApplicabilityCache()
+    if not cache.supported():
+        return
+    fingerprint = applicability.fingerprint(repodirs)
+    if fingerprint is not None and cache.fingerprint == fingerprint:
+        if cache.uploaded:
+            return
+        document = cache.document
+    else:
+        if installed is None:
+            installed = snapshot()
+        document = spans.call('applicability.compute', applicability.applicable, installed, repodirs)
+        if cache.is_valid(document):
+            cache.save(fingerprint, document, True)
+            return
+        cache.save(fingerprint, document, False)
+    if consumer_id is None:
+        consumer_id = ConsumerIdentity.read().getConsumerId()
+    if uep is None:
+        uep = shared(ConsumerIdentity.certpath(), ConsumerIdentity.keypath())
+    try:
+        spans.call('applicability.send', Breaker().call, uep.report_applicability, consumer_id, document)
+    except RequestFailed, e:
+        if e.code in applicability.UNSUPPORTED:
+            cache.not_supported()
+        raise
+    cache.save(fingerprint, document, True)
+
+def init_hook(conduit):
+    spans.configured(conduit.confBool("main", "timing") or None)
+
+def postreposetup_hook(conduit):
+    global repodirs
+    if not conduit.confBool("main", "applicability", default=False):
+        return
+    repodirs = [repo.cachedir for repo in conduit.getRepos().listEnabled()]
+
+def applicability_failed(conduit):
+    def failed(exception):
+        if not conduit.confBool("main", "supress_debug"):
+            conduit.info(2, "Unable to upload Applicability: %s" % exception)
+    return failed
+
 def posttrans_hook(conduit):
+    """
+    Read the installed packages and upload the profile concurrently
+    with the other posttrans reports.
+    """
+    global submitted
+    def failed(exception):
+        if isinstance(exception, CircuitOpen):
+            if not conduit.confBool("main", "supress_debug"):
+                conduit.info(2, "%s" % exception)
+            return
+        if not conduit.confBool("main", "supress_errors"):
+            conduit.error(2, "Unable to upload Package Profile")
+
+    if Breaker().blocked():
+        failed(CircuitOpen("Server unavailable, skipping Package Profile upload"))
+        return
     if not conduit.confBool("main", "supress_debug"):
         conduit.info(2, "Uploading Package Profile")
     try:
-        upload_package_profile()
-    except:
-        if not conduit.confBool("main", "supress_errors"):
-            conduit.error(2, "Unable to upload Package Profile")
+        installed = snapshot(conduit.getRpmDB())
+    except Exception, e:
+        failed(e)
+        return
+    posttrans.submit('package_profile', lambda: upload_package_profile(installed), failed)
+    if repodirs:
+        submitted = True
+        posttrans.submit('applicability', lambda: upload_applicability(installed, repodirs),
+                         applicability_failed(conduit))
+
+def close_hook(conduit):
+    """
+    Upload the applicability after the metadata was refreshed
+    outside of a transaction, then wait for the uploads.
+    Skipped for other users than root: the cache and the consumer
+    certificate are not accessible to them.
+    """
+    global submitted
+    if repodirs and not submitted and os.geteuid() == 0 \
+            and os.path.isfile(ConsumerIdentity.certpath()) and not Breaker().blocked():
+        posttrans.submit('applicability', lambda: upload_applicability(None, repodirs),
+                         applicability_failed(conduit))
+    submitted = False
+    posttrans.wait()
 
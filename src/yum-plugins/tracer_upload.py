@@ -1,7 +1,12 @@
+import os
 import sys
 import json
-import httplib
 import time
+import errno
+import select
+import signal
+
+from subprocess import Popen
 
 try:
   from tracer.query import Query
@@ -9,67 +14,419 @@ except ImportError:
   sys.exit('Error Importing tracer! Is tracer installed?')
 
 from yum.plugins import PluginYumExit, TYPE_CORE, TYPE_INTERACTIVE
-from rhsm.config import RhsmConfigParser, initConfig
 
 sys.path.append('/usr/share/rhsm')
 from subscription_manager.identity import ConsumerIdentity
 
+from katello import delta, posttrans, spans
+from katello.breaker import Breaker, CircuitOpen, RequestFailed
+from katello.connection import create, shared
+from katello.governor import Policy, lower_priority, enter_scope
+from katello.packages import snapshot
+from katello.scan import ScanCache
+
 requires_api_version = '2.3'
 plugin_type = (TYPE_CORE, TYPE_INTERACTIVE)
 
-def query_apps(conduit):
+# Wall-clock deadline (seconds) for the tracer query run from posttrans.
+QUERY_TIMEOUT = 60
+# Scheduling priority (nice increment) of the tracer query process.
+QUERY_NICE = 10
+# I/O scheduling class of the tracer query process (3 = idle).
+QUERY_IONICE = 3
+
+# Uploads the tracer profile outside of yum when the query times out.
+DEFERRED_COMMAND = '/sbin/katello-tracer-upload'
+
+
+class TracedPackage(object):
+    """
+    A package name and arch and its last modified time as used by tracer.
+    """
+
+    __slots__ = ('name', 'arch', 'modified')
+
+    def __init__(self, name, arch, modified):
+        self.name = name
+        self.arch = arch
+        self.modified = modified
+
+
+class TracedPackages(object):
+    """
+    The packages passed to tracer.
+    Re-iterable; the records are built while iterated, so the installed
+    packages are streamed from the snapshot into tracer.  Members of the
+    current transaction take precedence over the installed packages of
+    the same name and arch.
+    """
+
+    def __init__(self, members, installed, now=None):
+        """
+        :param members: The (name, arch) of the transaction members.
+        :type members: list
+        :param installed: The installed packages.
+        :type installed: katello.packages.Snapshot
+        :param now: The modified time of the members, default: now.
+        :type now: float
+        """
+        self.members = members
+        self.installed = installed
+        self.now = now or time.time()
+
+    def __iter__(self):
+        seen = set()
+        for name, arch in self.members:
+            if (name, arch) in seen:
+                continue
+            seen.add((name, arch))
+            yield TracedPackage(name, arch, self.now)
+        for pkg in self.installed:
+            if (pkg.name, pkg.arch) in seen:
+                continue
+            yield TracedPackage(pkg.name, pkg.arch, pkg.installtime)
+
+
+class QueryTimeout(Exception):
+    """
+    The tracer query did not finish before its deadline.
+    """
+    pass
+
+
+class BoundedCall(object):
+    """
+    Calls fn() in a forked child process at lowered priority.
+    The child is started on construction and its (JSON serializable)
+    result is returned by result().  The child is killed when it does
+    not finish before the deadline.
+    """
+
+    def __init__(self, fn, timeout=None, nice=QUERY_NICE, ionice=QUERY_IONICE, policy=None):
+        """
+        :param fn: The function to be called.
+        :type fn: callable
+        :param timeout: The wall-clock deadline in seconds, None = unbounded.
+        :type timeout: int
+        :param nice: The nice increment of the child.
+        :type nice: int
+        :param ionice: The ionice scheduling class of the child.
+        :type ionice: int
+        :param policy: The (optional) resource policy limiting the child.
+        :type policy: katello.governor.Policy
+        """
+        self.timeout = timeout
+        self.deadline = None
+        if timeout is not None:
+            self.deadline = time.time() + timeout
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            try:
+                try:
+                    lower_priority(nice, ionice)
+                    if policy is not None:
+                        enter_scope(policy)
+                    payload = json.dumps(dict(result=fn()))
+                except Exception, e:
+                    payload = json.dumps(dict(error=str(e)))
+                fp = os.fdopen(w, 'w')
+                fp.write(payload)
+                fp.close()
+            finally:
+                os._exit(0)
+        os.close(w)
+        self.pid = pid
+        self.fd = r
+
+    def result(self):
+        """
+        Wait for the child.
+        :return: The value returned by fn().
+        :raise QueryTimeout: when the deadline has passed.
+        """
+        try:
+            try:
+                payload = read_until(self.fd, self.deadline, self.timeout)
+            except QueryTimeout:
+                os.kill(self.pid, signal.SIGKILL)
+                raise
+        finally:
+            os.close(self.fd)
+            os.waitpid(self.pid, 0)
+        try:
+            reply = json.loads(payload)
+        except ValueError:
+            raise Exception('tracer query terminated abnormally')
+        if 'error' in reply:
+            raise Exception(reply['error'])
+        return reply['result']
+
+
+def bounded_call(fn, timeout=None, nice=QUERY_NICE, ionice=QUERY_IONICE):
+    """
+    Call fn() in a forked child process at lowered priority and
+    return its (JSON serializable) result to the caller.
+    :return: The value returned by fn().
+    :raise QueryTimeout: when the deadline has passed.
+    """
+    return BoundedCall(fn, timeout, nice, ionice).result()
+
+
+def read_until(fd, deadline=None, timeout=None):
+    """
+    Read the file descriptor until EOF or the deadline.
+    :param fd: An open file descriptor.
+    :type fd: int
+    :param deadline: The deadline (epoch seconds), None = unbounded.
+    :type deadline: float
+    :param timeout: The timeout the deadline was computed from.
+    :type timeout: int
+    :return: The data read.
+    :rtype: str
+    :raise QueryTimeout: when the deadline has passed.
+    """
+    chunks = []
+    while True:
+        wait = None
+        if deadline is not None:
+            wait = deadline - time.time()
+            if wait <= 0:
+                raise QueryTimeout('tracer query exceeded %s seconds' % timeout)
+        try:
+            readable = select.select([fd], [], [], wait)[0]
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        if not readable:
+            continue
+        data = os.read(fd, 65536)
+        if not data:
+            return ''.join(chunks)
+        chunks.append(data)
+
+
+def defer_upload():
+    """
+    Upload the tracer profile from a detached process that
+    outlives the yum transaction.
+    """
+    devnull = open(os.devnull, 'r+')
+    try:
+        Popen([DEFERRED_COMMAND, '--background'],
+              stdin=devnull,
+              stdout=devnull,
+              stderr=devnull,
+              close_fds=True,
+              preexec_fn=os.setsid)
+    finally:
+        devnull.close()
+
+
+def traced_packages(conduit):
+    """
+    When running via yum we need to pass tracer a list of packages and
+    their last modified time so it has no need to access the rpmdb (which
+    would fail as yum/dnf has a lock on it).
+    The transaction members and the snapshot are read here (in yum);
+    the records are built while tracer iterates them.
+    :rtype: TracedPackages
+    """
+    members = [(pkg.name, pkg.arch) for pkg in conduit.getTsInfo().getMembers()]
+    return TracedPackages(members, snapshot(conduit.getRpmDB()))
+
+def query_apps(packages=None):
     """Returns all apps that need restarting """
     query = Query()
-    if conduit:
-        # When running via yum we need to pass tracer a list of packages and 
-        # their last modified time so it has no need to access the rpmdb (which
-        # would fail as yum/dnf has a lock on it) 
-        packages = []
-        pkgs = conduit.getTsInfo().getMembers() # Packages in the current transation
-        for pkg in pkgs:
-            pkg.modified = time.time()
-            packages.append(pkg)
-        rpmdb = conduit.getRpmDB() # All other packages
-        for pkg in rpmdb:
-            pkg.modified = pkg.installtime
-            packages.append(pkg)
+    if packages is not None:
         return query.from_packages(packages).now().affected_applications().get()
     else:
         return query.affected_applications().get()
 
-def get_apps(conduit):
+def query(conduit, timeout=None):
     """
-    Return a array with nested arrays 
-    containing name, how to restart & app type
-    for every package that needs restarting
-    """   
+    Start the tracer query in a child process bounded by timeout.
+    :return: The running query.
+    :rtype: BoundedCall
+    """
+    packages = None
+    policy = Policy.read()
+    nice, ionice = policy.nice, policy.ionice
+    if conduit:
+        packages = traced_packages(conduit)
+        nice = conduit.confInt('main', 'query_nice', default=nice)
+        ionice = conduit.confInt('main', 'query_ionice', default=ionice)
+
+    return BoundedCall(lambda: collect_apps(packages), timeout, nice, ionice, policy)
+
+@spans.traced('tracer.collect')
+def collect_apps(packages=None):
+    """
+    Get the apps that need restarting.
+    The last result is reused while no package changed and the
+    processes using replaced files are the same.
+    :return: {<name>: {helper: <str>, type: <str>}}
+    :rtype: dict
+    """
+    cache = ScanCache()
+    spans.call('tracer.scan', cache.scan)
+    apps = cache.apps()
+    if apps is not None:
+        return apps
     apps = {}
-    for app in query_apps(conduit):
+    for app in spans.call('tracer.query', query_apps, packages):
         apps[app.name] = { "helper": app.helper, "type": app.type}
-    if conduit: 
+    cache.save(apps)
+    return apps
+
+@spans.traced('tracer.get_apps')
+def get_apps(conduit, timeout=None, pending=None):
+    """
+    Return a array with nested arrays
+    containing name, how to restart & app type
+    for every package that needs restarting.
+    :param pending: An (optional) query already started.
+    :type pending: BoundedCall
+    """
+    if pending is None:
+        pending = query(conduit, timeout)
+    apps = pending.result()
+    if conduit:
         #Don't report yum/dnf back if this if being ran via them.
         apps.pop("yum", None)
         apps.pop("dnf", None)
     return apps
 
-def upload_tracer_profile(conduit=False):
-    data =  json.dumps({ "traces": get_apps(conduit) })
-    headers = { "Content-type": "application/json" }
+class TracerCache(object):
+    """
+    The tracer report last stored by the server and its version,
+    used as the base of delta uploads.
+    """
+
+    CACHE_FILE = '/var/cache/katello-agent/tracer.json'
+
+    def __init__(self, consumer_id):
+        self.consumer_id = consumer_id
+
+    @staticmethod
+    def remove_cache():
+        try:
+            os.remove(TracerCache.CACHE_FILE)
+        except OSError:
+            pass
 
-    conn = httplib.HTTPSConnection(
-            RhsmConfigParser.get(initConfig() ,'server', 'hostname'),
-            RhsmConfigParser.get(initConfig() ,'server', 'port'),
-            key_file = ConsumerIdentity.keypath(),
-            cert_file = ConsumerIdentity.certpath()
-           )
-    conn.request('PUT', '/rhsm/consumers/%s/tracer' % (ConsumerIdentity.read().getConsumerId()), data, headers=headers)
-    response = conn.getresponse()
+    def acknowledged(self):
+        """
+        Get the traces last stored by the server with their version.
+        :return: (traces, version) or None when not versioned.
+        :rtype: tuple
+        """
+        try:
+            fp = open(self.CACHE_FILE)
+        except IOError:
+            return None
+        try:
+            try:
+                cached = json.loads(fp.read())
+            except ValueError:
+                return None
+        finally:
+            fp.close()
+        if isinstance(cached, dict) and cached.get('version') and self.consumer_id in cached:
+            return cached[self.consumer_id], cached['version']
+
+    def save(self, traces, version):
+        if not version:
+            TracerCache.remove_cache()
+            return
+        fp = open(self.CACHE_FILE, 'w')
+        try:
+            fp.write(json.dumps({self.consumer_id: traces, 'version': version}))
+        finally:
+            fp.close()
+
+@spans.traced('tracer.upload')
+def upload_tracer_profile(conduit=False, timeout=None, pending=None, conn=None, consumer_id=None):
+    """
+    Upload the tracer profile as a delta of the profile last stored
+    by the server when possible.
+    :param pending: An (optional) query already started.
+    :type pending: BoundedCall
+    :param conn: An (optional) open connection.
+    :type conn: katello.connection.Connection
+    :param consumer_id: The (optional) consumer ID.
+    :type consumer_id: str
+    """
+    breaker = Breaker()
+    if pending is None and breaker.blocked():
+        raise CircuitOpen("Server unavailable, skipping Tracer Profile upload")
+    traces = get_apps(conduit, timeout, pending)
+    if consumer_id is None:
+        consumer_id = ConsumerIdentity.read().getConsumerId()
+    cache = TracerCache(consumer_id)
+    acknowledged = cache.acknowledged()
+    owned = conn is None
+    if owned:
+        conn = create(ConsumerIdentity.certpath(), ConsumerIdentity.keypath())
+    path = '/consumers/%s/tracer' % consumer_id
+    try:
+        if acknowledged is not None:
+            added, removed = delta.diff(acknowledged[0], traces)
+            try:
+                version = delta.version(breaker.call(conn.put, path, delta.document(acknowledged[1], added, removed)))
+                cache.save(traces, version)
+                return
+            except RequestFailed, e:
+                if not delta.conflict(e):
+                    raise
+        version = delta.version(breaker.call(conn.put, path, { "traces": traces }))
+        cache.save(traces, version)
+    finally:
+        if owned:
+            conn.close()
+
+def init_hook(conduit):
+    spans.configured(conduit.confBool("main", "timing") or None)
 
 def posttrans_hook(conduit):
+    """
+    Start the tracer query, then wait for it and upload concurrently
+    with the other posttrans reports.
+    """
+    def failed(exception):
+        if isinstance(exception, CircuitOpen):
+            if not conduit.confBool("main", "supress_debug"):
+                conduit.info(2, "%s" % exception)
+            return
+        if isinstance(exception, QueryTimeout):
+            if not conduit.confBool("main", "supress_debug"):
+                conduit.info(2, "%s; deferring Tracer Profile upload" % exception)
+            try:
+                defer_upload()
+                return
+            except:
+                pass
+        if not conduit.confBool("main", "supress_errors"):
+            conduit.error(2, "Unable to upload Tracer Profile")
+
+    if Breaker().blocked():
+        failed(CircuitOpen("Server unavailable, skipping Tracer Profile upload"))
+        return
     if not conduit.confBool("main", "supress_debug"):
         conduit.info(2, "Uploading Tracer Profile")
+    timeout = conduit.confInt('main', 'query_timeout', default=QUERY_TIMEOUT)
     try:
-        upload_tracer_profile(conduit)
-    except:
-        if not conduit.confBool("main", "supress_errors"):
-            conduit.error(2, "Unable to upload Tracer Profile")
+        pending = query(conduit, timeout)
+    except Exception, e:
+        failed(e)
+        return
+    posttrans.submit(
+        'tracer_profile',
+        lambda: upload_tracer_profile(conduit, timeout, pending, shared(
+            ConsumerIdentity.certpath(), ConsumerIdentity.keypath())),
+        failed)
+
+def close_hook(conduit):
+    posttrans.wait()
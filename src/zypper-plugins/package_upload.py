@@ -20,23 +20,49 @@ sys.path.append('/usr/share/rhsm')
 
 from zypp_plugin import Plugin
 
-try:
-  from subscription_manager import action_client
-except ImportError:
-  from subscription_manager import certmgr
-
-try:
-  from subscription_manager.identity import ConsumerIdentity
-except ImportError:
-  from subscription_manager.certlib import ConsumerIdentity
-
-from rhsm import connection
-
-try:
-    from subscription_manager.injectioninit import init_dep_injection
-    init_dep_injection()
-except ImportError:
-    pass
+from katello import spans
+from katello.breaker import Breaker, CircuitOpen
+from katello.packages import snapshot, use_snapshot
+
+
+@spans.traced('zypper.imports')
+def subscription_manager():
+    """
+    Import the subscription-manager stack.
+    Deferred until the profile is uploaded; zypper waits for the
+    PLUGINBEGIN ack and the imports are most of the start up time.
+    :return: A function getting the subscription-manager action client.
+    :rtype: callable
+    """
+    try:
+      from subscription_manager import action_client
+    except ImportError:
+      from subscription_manager import certmgr
+
+    try:
+      from subscription_manager.identity import ConsumerIdentity
+    except ImportError:
+      from subscription_manager.certlib import ConsumerIdentity
+
+    from rhsm import connection
+
+    try:
+        from subscription_manager.injectioninit import init_dep_injection
+        init_dep_injection()
+    except ImportError:
+        pass
+
+    def get_manager():
+        if 'subscription_manager.action_client' in sys.modules:
+            mgr = action_client.ActionClient()
+        else:
+            # for compatability with subscription-manager > =1.13
+            uep = connection.UEPConnection(cert_file=ConsumerIdentity.certpath(),
+                                            key_file=ConsumerIdentity.keypath())
+            mgr = certmgr.CertManager(uep=uep)
+        return mgr
+
+    return get_manager
 
 class KatelloZyppPlugin(Plugin):
 
@@ -69,21 +95,14 @@ class KatelloZyppPlugin(Plugin):
         return {}
 
 
+    @spans.traced('zypper.upload')
     def upload_package_profile(self):
-	uep = connection.UEPConnection(cert_file=ConsumerIdentity.certpath(),
-				       key_file=ConsumerIdentity.keypath())
-	self.get_manager().profilelib._do_update()
-
-
-    def get_manager(self):
-	if 'subscription_manager.action_client' in sys.modules:
-	    mgr = action_client.ActionClient()
-	else:
-	    # for compatability with subscription-manager > =1.13
-	    uep = connection.UEPConnection(cert_file=ConsumerIdentity.certpath(),
-					    key_file=ConsumerIdentity.keypath())
-	    mgr = certmgr.CertManager(uep=uep)
-	return mgr
+        breaker = Breaker()
+        if breaker.blocked():
+            raise CircuitOpen("Server unavailable, skipping Package Profile upload")
+        get_manager = subscription_manager()
+        use_snapshot(snapshot())
+        spans.call('package_profile.send', breaker.call, get_manager().profilelib._do_update)
 
 
     def PLUGINBEGIN(self, headers, body):
@@ -117,6 +136,8 @@ class KatelloZyppPlugin(Plugin):
 
 	try:
 	    self.upload_package_profile()
+	except CircuitOpen, e:
+	    logging.info(str(e))
 	except:
 	    logging.error("Unable to upload Package Profile")
 
@@ -134,6 +155,7 @@ if "DISABLE_KATELLO_ZYPP_PLUGIN" in environ:
 
 else:
 
+    spans.configured(None)
     plugin = KatelloZyppPlugin()
     plugin.main()
 
@@ -0,0 +1,146 @@
+#!/usr/bin/python
+#
+# Copyright 2017 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+
+"""
+Peak RSS of uploading the package profile.
+
+Compares the legacy approach (building the profile as a list of dicts
+and its whole JSON text before sending it) with the streamed upload
+(profile entries generated from the package index, serialized
+incrementally and sent with chunked transfer encoding), using a
+synthetic package index and the stand-in server.  Needs only openssl:
+
+    python test/bench/profile_memory.py --packages 20000
+"""
+
+import os
+import sys
+import shutil
+import optparse
+import resource
+import tempfile
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../src'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '../load'))
+
+from server import StandInServer, PREFIX, certificate
+
+from katello.connection import Settings, Connection
+from katello.packages import Package, Profile, Snapshot
+
+
+CONSUMER_ID = 'bench'
+
+
+class Config(object):
+
+    def __init__(self, **sections):
+        self.sections = sections
+
+    def get(self, section, name):
+        return self.sections[section][name]
+
+
+def packages(count):
+    for n in xrange(count):
+        yield Package(
+            'package-%d' % n, n % 3, '1.%d.0' % n, '%d.el7' % n,
+            'x86_64', 1500000000 + n, 'Red Hat, Inc.')
+
+
+class Legacy(Connection):
+    """
+    Sends the whole JSON text as the request body.
+    """
+
+    def send(self, method, url, document, headers, chunked=True):
+        headers = dict(headers)
+        headers['Content-Type'] = 'application/json'
+        self.conn.request(method, url, json.dumps(document), headers)
+
+
+def legacy(snapshot):
+    return [p.profile() for p in snapshot]
+
+
+def streamed(snapshot):
+    return Profile(snapshot)
+
+
+def peak_rss(fn, conn, path):
+    """
+    Upload the profile built by fn(snapshot) in a child process.
+    :return: Peak RSS growth KiB.
+    """
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        snapshot = Snapshot.load(path)
+        conn.conn = conn.open()
+        conn.conn.connect()
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        conn.updatePackageProfile(CONSUMER_ID, fn(snapshot))
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        conn.close()
+        os.write(w, '%d' % (after - before))
+        os._exit(0)
+    os.close(w)
+    reply = os.read(r, 1024)
+    os.close(r)
+    os.waitpid(pid, 0)
+    return int(reply)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--packages', type='int', default=20000, help='installed packages')
+    options, args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    server = StandInServer()
+    server.start()
+    try:
+        path = os.path.join(tmp, 'packages.idx')
+        Snapshot.build(packages(options.packages), 'bench').write(path)
+        cert, key = certificate(tmp, 'consumer')
+        cfg = Config(
+            server=dict(hostname='127.0.0.1', port=str(server.port), prefix=PREFIX, insecure='1'),
+            rhsm=dict(ca_cert_dir=tmp))
+        settings = Settings(cfg)
+        runs = [
+            ('legacy', Legacy(cert, key, settings), legacy),
+            ('streamed', Connection(cert, key, settings), streamed),
+            ('streamed (gzip)', Connection(cert, key, settings, compress=True), streamed),
+        ]
+        print '%-20s %12s %10s' % ('approach', 'peak KiB', 'packages')
+        for title, conn, fn in runs:
+            growth = peak_rss(fn, conn, path)
+            document, version = server.versioned('packages', CONSUMER_ID)
+            server.store('packages', CONSUMER_ID, None)
+            if document is None or len(document) != options.packages:
+                raise Exception('%s: profile not stored' % title)
+            print '%-20s %12d %10d' % (title, growth, len(document))
+    finally:
+        server.stop()
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
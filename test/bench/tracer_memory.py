@@ -0,0 +1,164 @@
+#!/usr/bin/python
+#
+# Copyright 2017 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+
+"""
+Peak RSS of building the package list passed to tracer in posttrans.
+
+Compares the legacy approach (tagging every yum package object with a
+'modified' attribute and keeping them all in one list) with the
+streaming TracedPackage pipeline, using synthetic yum packages.  As
+yum's rpmsack, the synthetic rpmdb keeps the package objects it built.
+Run on a host with yum, tracer and subscription-manager installed:
+
+    python test/bench/tracer_memory.py --packages 15000
+"""
+
+import os
+import sys
+import time
+import shutil
+import optparse
+import resource
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../src'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../src/yum-plugins'))
+
+import tracer_upload
+from katello import packages
+
+
+class YumPackage(object):
+    """
+    Stands in for a header backed yum package object.
+    """
+
+    def __init__(self, n):
+        self.pkgtup = ('package-%d' % n, 'x86_64', '0', '1.0', '%d.el7' % n)
+        self.name, self.arch, self.epoch, self.version, self.release = self.pkgtup
+        self.installtime = 1500000000 + n
+        self.vendor = 'Red Hat, Inc.'
+        self.summary = 'Package %d summary' % n
+        self.description = 'Package %d description. ' % n * 20
+        self.files = ['/usr/lib64/package-%d/file-%d' % (n, f) for f in range(40)]
+
+
+class RpmDB(object):
+    """
+    Stands in for the yum rpmsack: package objects are cached by index
+    once built.
+    """
+
+    def __init__(self, count):
+        self.count = count
+        self.cache = {}
+
+    def __iter__(self):
+        for n in xrange(self.count):
+            pkg = self.cache.get(n)
+            if pkg is None:
+                pkg = YumPackage(n)
+                self.cache[n] = pkg
+            yield pkg
+
+
+class TsInfo(object):
+
+    def __init__(self, count):
+        self.members = [YumPackage(n) for n in range(count)]
+
+    def getMembers(self):
+        return self.members
+
+
+class Conduit(object):
+
+    def __init__(self, count, members):
+        self.rpmdb = RpmDB(count)
+        self.tsinfo = TsInfo(members)
+
+    def getTsInfo(self):
+        return self.tsinfo
+
+    def getRpmDB(self):
+        return self.rpmdb
+
+
+def legacy(conduit):
+    found = []
+    for pkg in conduit.getTsInfo().getMembers():
+        pkg.modified = time.time()
+        found.append(pkg)
+    for pkg in conduit.getRpmDB():
+        pkg.modified = pkg.installtime
+        found.append(pkg)
+    return len(found)
+
+
+def streaming(conduit):
+    count = 0
+    for pkg in tracer_upload.traced_packages(conduit):
+        count += 1
+    return count
+
+
+def peak_rss(fn, conduit):
+    """
+    Run fn(conduit) in a child process.
+    :return: (peak RSS growth KiB, package count)
+    """
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        count = fn(conduit)
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(w, '%d %d' % (after - before, count))
+        os._exit(0)
+    os.close(w)
+    reply = os.read(r, 1024)
+    os.close(r)
+    os.waitpid(pid, 0)
+    return tuple(map(int, reply.split()))
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--packages', type='int', default=15000, help='installed packages')
+    parser.add_option('--members', type='int', default=50, help='transaction members')
+    options, args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        index = os.path.join(tmp, 'packages.idx')
+        # The rpmdb fingerprinted by the snapshot.
+        open(os.path.join(tmp, 'Packages'), 'w').close()
+        tracer_upload.snapshot = lambda p: packages.snapshot(p, path=index, dbpath=tmp)
+        conduit = Conduit(options.packages, options.members)
+        runs = [
+            ('legacy', legacy),
+            ('streaming (index rebuilt)', streaming),
+            ('streaming (index reused)', streaming),
+        ]
+        print '%-28s %12s %10s' % ('approach', 'peak KiB', 'packages')
+        for title, fn in runs:
+            growth, count = peak_rss(fn, conduit)
+            print '%-28s %12d %10d' % (title, growth, count)
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,389 @@
+#!/usr/bin/python
+#
+# Copyright 2017 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+
+"""
+Fleet simulator.
+Simulates many hosts in a few processes.  Each host periodically runs
+the real upload_enabled_repos_report(), upload_tracer_profile() and
+validate_registration() code paths with a synthetic identity against
+the stand-in server, and the server side request rate, bytes and the
+client side latency percentiles are reported per time window.
+
+Runs on one host without network access; requires yum, gofer, pulp,
+python-rhsm, subscription-manager and tracer to be installed:
+
+    python test/load/fleet.py --hosts 2000 --processes 4 --duration 300
+
+Only the host data is synthetic: repositories and traces are generated
+and the tracer query runs in-process instead of in a child.
+"""
+
+import os
+import ssl
+import sys
+import time
+import uuid
+import random
+import shutil
+import optparse
+import tempfile
+import threading
+
+from multiprocessing import Process, Queue
+from Queue import Empty
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../src'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../src/yum-plugins'))
+
+from server import StandInServer, Faults, PREFIX, certificate
+
+
+RHSM_CONF = """
+[server]
+hostname = 127.0.0.1
+prefix = %(prefix)s
+port = %(port)d
+insecure = 1
+
+[rhsm]
+ca_cert_dir = %(tmp)s/
+repo_ca_cert = %%(ca_cert_dir)sredhat-uep.pem
+consumerCertDir = %(tmp)s
+"""
+
+OPERATIONS = ('validate_registration', 'enabled_repos', 'tracer')
+
+
+class Host(object):
+    """
+    A simulated host.
+    :ivar consumer_id: The synthetic consumer ID.
+    :ivar repos: The enabled repositories.
+    :ivar traces: The applications needing a restart.
+    :ivar cache: The host private cache directory.
+    """
+
+    def __init__(self, cache, repos, change_rate):
+        self.consumer_id = str(uuid.uuid4())
+        self.cache = os.path.join(cache, self.consumer_id)
+        os.makedirs(self.cache)
+        self.change_rate = change_rate
+        self.repos = [self.repo(n) for n in range(repos)]
+        self.traces = []
+        self.due = 0
+
+    @staticmethod
+    def repo(n):
+        return dict(
+            repositoryid='Org_Product_%d_Repo' % n,
+            baseurl=['https://127.0.0.1/pulp/repos/Org/Library/product-%d/os' % n])
+
+    def change(self):
+        """
+        Randomly change the host state.
+        """
+        if random.random() < self.change_rate:
+            self.repos.append(self.repo(len(self.repos)))
+        if random.random() < self.change_rate:
+            self.traces.append(dict(name='service-%d' % len(self.traces)))
+        elif self.traces and random.random() < self.change_rate:
+            self.traces.pop()
+
+
+# The host of the current thread.
+local = threading.local()
+
+
+class Certificate(object):
+
+    def __init__(self, consumer_id):
+        self.consumer_id = consumer_id
+
+    def getConsumerId(self):
+        return self.consumer_id
+
+
+class Identity(object):
+    """
+    Stands in for ConsumerIdentity using the current host.
+    """
+
+    key = None
+    cert = None
+
+    @staticmethod
+    def read():
+        return Certificate(local.host.consumer_id)
+
+    @staticmethod
+    def existsAndValid():
+        return True
+
+    @staticmethod
+    def keypath():
+        return Identity.key
+
+    @staticmethod
+    def certpath():
+        return Identity.cert
+
+
+class HostPath(object):
+    """
+    Class attribute resolved to a file in the current host's cache.
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def __get__(self, instance, owner):
+        return os.path.join(local.host.cache, self.fn)
+
+
+class InProcess(object):
+    """
+    Stands in for tracer_upload.BoundedCall without forking.
+    """
+
+    def __init__(self, fn, *args, **kwargs):
+        self.fn = fn
+
+    def result(self):
+        return self.fn()
+
+
+class App(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.helper = 'systemctl restart %s' % name
+        self.type = 'daemon'
+
+
+class Patches(object):
+    """
+    Module and class attributes replaced by configure().
+    :ivar saved: The replaced (owner, name, value).
+    :type saved: list
+    """
+
+    MISSING = object()
+
+    def __init__(self):
+        self.saved = []
+
+    def save(self, owner, name):
+        """
+        Save an attribute to be restored by undo().
+        """
+        self.saved.append((owner, name, vars(owner).get(name, self.MISSING)))
+
+    def set(self, owner, name, value):
+        """
+        Replace an attribute until undo().
+        """
+        self.save(owner, name)
+        setattr(owner, name, value)
+
+    def undo(self):
+        """
+        Restore the replaced attributes.
+        """
+        while self.saved:
+            owner, name, value = self.saved.pop()
+            if value is self.MISSING:
+                if name in vars(owner):
+                    delattr(owner, name)
+            else:
+                setattr(owner, name, value)
+
+
+def configure(tmp, port):
+    """
+    Point rhsm at the stand-in server and patch the host tools to
+    use the synthetic host data.
+    :return: (operations, undo) where undo() restores what was patched.
+    :rtype: tuple
+    """
+    patches = Patches()
+    path = os.path.join(tmp, 'rhsm.conf')
+    fp = open(path, 'w')
+    fp.write(RHSM_CONF % dict(prefix=PREFIX, port=port, tmp=tmp))
+    fp.close()
+    from rhsm import config
+    patches.set(config, 'DEFAULT_CONFIG_PATH', path)
+    patches.save(config, 'CFG')
+    config.initConfig(path)
+
+    # The stand-in certificate is self-signed.
+    if hasattr(ssl, '_create_unverified_context'):
+        patches.set(ssl, '_create_default_https_context', ssl._create_unverified_context)
+
+    Identity.cert, Identity.key = certificate(tmp, 'consumer')
+
+    import enabled_repos_upload
+    import tracer_upload
+    from katello.agent import katelloplugin
+    from katello.breaker import Breaker
+    from katello.scan import ScanCache
+
+    for module in (enabled_repos_upload, tracer_upload, katelloplugin):
+        patches.set(module, 'ConsumerIdentity', Identity)
+
+    patches.set(enabled_repos_upload.EnabledReport, 'generate', staticmethod(
+        lambda repofn: dict(enabled_repos=dict(repos=local.host.repos))))
+    patches.set(enabled_repos_upload.EnabledRepoCache, 'CACHE_FILE', HostPath('enabled_repos.json'))
+    patches.set(Breaker, 'STATE_FILE', HostPath('breaker.json'))
+    patches.set(tracer_upload.TracerCache, 'CACHE_FILE', HostPath('tracer.json'))
+    # The synthetic traces change without the processes changing.
+    patches.set(ScanCache, 'scan', lambda self: {})
+    patches.set(ScanCache, 'apps', lambda self: None)
+    patches.set(ScanCache, 'save', lambda self, apps: None)
+
+    patches.set(tracer_upload, 'query_apps', lambda packages=None: [App(t['name']) for t in local.host.traces])
+    patches.set(tracer_upload, 'BoundedCall', InProcess)
+
+    operations = dict(
+        validate_registration=katelloplugin.validate_registration,
+        enabled_repos=enabled_repos_upload.upload_enabled_repos_report,
+        tracer=tracer_upload.upload_tracer_profile)
+    return operations, patches.undo
+
+
+def simulate(hosts, options, port, metrics):
+    """
+    Run the hosts assigned to a process.
+    :param metrics: Used to send (operation, started, latency, ok).
+    :type metrics: Queue
+    """
+    tmp = tempfile.mkdtemp()
+    undo = None
+    try:
+        operations, undo = configure(tmp, port)
+        hosts = [Host(tmp, options.repos, options.change_rate) for n in range(hosts)]
+        for host in hosts:
+            host.due = time.time() + random.uniform(0, options.splay)
+        deadline = time.time() + options.duration
+        threads = []
+        for n in range(options.threads):
+            thread = threading.Thread(
+                target=run, args=(hosts[n::options.threads], operations, options, deadline, metrics))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+    finally:
+        if undo is not None:
+            undo()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def run(hosts, operations, options, deadline, metrics):
+    while hosts and time.time() < deadline:
+        hosts.sort(key=lambda h: h.due)
+        host = hosts[0]
+        delay = host.due - time.time()
+        if delay > 0:
+            time.sleep(max(0, min(delay, deadline - time.time())))
+            continue
+        local.host = host
+        host.change()
+        for name in OPERATIONS:
+            started = time.time()
+            ok = True
+            try:
+                operations[name]()
+            except Exception:
+                ok = False
+            metrics.put((name, started, time.time() - started, ok))
+        host.due = time.time() + options.interval + random.uniform(0, options.splay)
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def report(window, records, samples):
+    """
+    Print the statistics of a time window.
+    """
+    received = sum([r.received for r in records])
+    sent = sum([r.sent for r in records])
+    errors = len([r for r in records if r.status >= 400])
+    line = ['%8.1f %8.1f %10.1f %10.1f %6d' % (
+        time.time(), len(records) / window, received / 1024.0, sent / 1024.0, errors)]
+    for name in OPERATIONS:
+        latency = [s[2] * 1000 for s in samples if s[0] == name]
+        line.append('%7.0f %7.0f %7.0f' % (
+            percentile(latency, 50), percentile(latency, 95), percentile(latency, 99)))
+    print ' '.join(line)
+    sys.stdout.flush()
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--hosts', type='int', default=1000, help='simulated hosts')
+    parser.add_option('--processes', type='int', default=4, help='simulator processes')
+    parser.add_option('--threads', type='int', default=16, help='threads per process')
+    parser.add_option('--duration', type='int', default=120, help='seconds to run')
+    parser.add_option('--interval', type='float', default=60, help='seconds between host runs')
+    parser.add_option('--splay', type='float', default=30, help='random seconds added to the interval')
+    parser.add_option('--window', type='float', default=10, help='seconds per report line')
+    parser.add_option('--repos', type='int', default=20, help='initial repositories per host')
+    parser.add_option('--change-rate', type='float', default=0.05, help='chance of a change per run')
+    parser.add_option('--delay', type='float', default=0, help='server seconds added to each response')
+    parser.add_option('--error-rate', type='float', default=0, help='server fraction of failed requests')
+    parser.add_option('--error-status', type='int', default=503)
+    parser.add_option('--retry-after', type='int', default=None)
+    parser.add_option('--no-delta', action='store_true', help='server does not support delta uploads')
+    options, args = parser.parse_args()
+
+    faults = Faults(options.delay, options.error_rate, options.error_status, options.retry_after)
+    server = StandInServer(faults=faults, delta=not options.no_delta)
+    server.start()
+    metrics = Queue()
+    processes = []
+    for n in range(options.processes):
+        hosts = options.hosts / options.processes
+        if n < options.hosts % options.processes:
+            hosts += 1
+        p = Process(target=simulate, args=(hosts, options, server.port, metrics))
+        p.start()
+        processes.append(p)
+
+    columns = ['%8s %8s %10s %10s %6s' % ('time', 'req/s', 'KiB in', 'KiB out', 'errors')]
+    for name in OPERATIONS:
+        columns.append('%23s' % ('%s p50/95/99 ms' % name[:8]))
+    print ' '.join(columns)
+    try:
+        while [p for p in processes if p.is_alive()]:
+            samples = []
+            end = time.time() + options.window
+            while time.time() < end:
+                try:
+                    samples.append(metrics.get(timeout=max(0.01, end - time.time())))
+                except Empty:
+                    pass
+            report(options.window, server.drain(), samples)
+    finally:
+        for p in processes:
+            p.join()
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,352 @@
+#!/usr/bin/python
+#
+# Copyright 2017 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+
+"""
+Stand-in Katello/candlepin server.
+Implements the subset of the API used by the host tools, records each
+request and can inject latency and errors (with Retry-After).
+The enabled repositories and tracer reports are versioned and accept
+delta uploads (see katello.delta) unless started with --no-delta.
+
+    python test/load/server.py --port 8443
+"""
+
+import os
+import re
+import ssl
+import sys
+import time
+import zlib
+import random
+import shutil
+import socket
+import optparse
+import tempfile
+import threading
+
+from subprocess import Popen, PIPE
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+PREFIX = '/rhsm'
+
+ROUTES = [
+    ('GET', re.compile(r'^/$'), 'resources'),
+    ('GET', re.compile(r'^/consumers/([^/]+)$'), 'consumer'),
+    ('PUT', re.compile(r'^/systems/([^/]+)/enabled_repos$'), 'enabled_repos'),
+    ('PUT', re.compile(r'^/consumers/([^/]+)/tracer$'), 'tracer'),
+    ('PUT', re.compile(r'^/consumers/([^/]+)/packages$'), 'packages'),
+    ('PUT', re.compile(r'^/consumers/([^/]+)/applicability$'), 'applicability'),
+]
+
+
+def certificate(directory, cn='localhost'):
+    """
+    Generate a self-signed certificate and key.
+    :return: (cert path, key path)
+    """
+    cert = os.path.join(directory, '%s.pem' % cn)
+    key = os.path.join(directory, '%s-key.pem' % cn)
+    command = [
+        'openssl', 'req', '-x509', '-nodes', '-newkey', 'rsa:2048', '-days', '1',
+        '-subj', '/CN=%s' % cn, '-keyout', key, '-out', cert]
+    p = Popen(command, stdout=PIPE, stderr=PIPE)
+    p.communicate()
+    if p.returncode:
+        raise Exception('openssl failed: %d' % p.returncode)
+    return cert, key
+
+
+class Record(object):
+    """
+    A handled request.
+    """
+
+    __slots__ = ('time', 'route', 'status', 'received', 'sent', 'latency')
+
+    def __init__(self, route, status, received, sent, latency):
+        self.time = time.time()
+        self.route = route
+        self.status = status
+        self.received = received
+        self.sent = sent
+        self.latency = latency
+
+
+class Faults(object):
+    """
+    Injected server behavior.
+    :ivar delay: Seconds added to each response.
+    :ivar error_rate: Fraction (0-1) of requests answered with error_status.
+    :ivar error_status: The HTTP status of injected errors.
+    :ivar retry_after: The Retry-After (seconds) sent with injected errors.
+    """
+
+    def __init__(self, delay=0, error_rate=0, error_status=503, retry_after=None):
+        self.delay = delay
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(';')[0], 16)
+                if not size:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            body = ''.join(chunks)
+        else:
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length)
+        if self.headers.get('Content-Encoding', '').lower() == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return body
+
+    def dispatch(self, method):
+        started = time.time()
+        server = self.server
+        chunked = self.headers.get('Transfer-Encoding', '').lower() == 'chunked'
+        body = self.body()
+        path = self.path.split('?')[0]
+        route = 'unknown'
+        status = 404
+        headers = {}
+        reply = {'displayMessage': 'not found'}
+        if path.startswith(PREFIX):
+            path = path[len(PREFIX):] or '/'
+        if chunked and not server.chunked:
+            status = 411
+            reply = {'displayMessage': 'length required'}
+        else:
+            for m, pattern, name in ROUTES:
+                match = pattern.match(path)
+                if m == method and match:
+                    route = name
+                    status, reply = getattr(self, name)(body, *match.groups())
+                    break
+        faults = server.faults
+        if faults.delay:
+            time.sleep(faults.delay)
+        if faults.error_rate and random.random() < faults.error_rate:
+            status = faults.error_status
+            reply = {'displayMessage': 'injected error'}
+            if faults.retry_after is not None:
+                headers['Retry-After'] = str(faults.retry_after)
+        content = json.dumps(reply)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+        server.record(Record(route, status, len(body), len(content), time.time() - started))
+
+    def resources(self, body):
+        names = ('consumers', 'packages', 'systems')
+        return 200, [dict(rel=n, href='/%s' % n) for n in names]
+
+    def consumer(self, body, consumer_id):
+        return 200, dict(uuid=consumer_id)
+
+    def enabled_repos(self, body, consumer_id):
+        def apply(document, added, removed):
+            repos = dict([(r['repositoryid'], r) for r in document['enabled_repos']['repos']])
+            for repo in added:
+                repos[repo['repositoryid']] = repo
+            for repoid in removed:
+                repos.pop(repoid, None)
+            document['enabled_repos']['repos'] = [repos[k] for k in sorted(repos)]
+        return self.versioned('enabled_repos', consumer_id, json.loads(body), apply)
+
+    def tracer(self, body, consumer_id):
+        def apply(document, added, removed):
+            document['traces'].update(added)
+            for name in removed:
+                document['traces'].pop(name, None)
+        return self.versioned('tracer', consumer_id, json.loads(body), apply)
+
+    def versioned(self, kind, consumer_id, document, apply):
+        """
+        Store a full report or apply a delta to the stored report.
+        :param apply: Called as apply(stored, added, removed) to apply a delta.
+        :return: (status, reply)
+        """
+        server = self.server
+        if not server.delta:
+            server.store(kind, consumer_id, document)
+            return 200, {}
+        if 'delta' in document:
+            delta = document['delta']
+            stored, version = server.versioned(kind, consumer_id)
+            if version is None or delta['base'] != version:
+                return 409, {'displayMessage': 'unknown base version'}
+            document = json.loads(json.dumps(stored))
+            apply(document, delta['added'], delta['removed'])
+        return 200, {'version': server.store(kind, consumer_id, document)}
+
+    def packages(self, body, consumer_id):
+        self.server.store('packages', consumer_id, json.loads(body))
+        return 200, {}
+
+    def applicability(self, body, consumer_id):
+        self.server.store('applicability', consumer_id, json.loads(body))
+        return 200, {}
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """
+    The stand-in server.
+    :ivar records: The handled requests.
+    :type records: list
+    :ivar documents: The last document stored per (kind, consumer ID).
+    :type documents: dict
+    :ivar chunked: Chunked requests are accepted, else refused (411).
+    :type chunked: bool
+    """
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, port=0, faults=None, delta=True, chunked=True):
+        HTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+        self.tmp = tempfile.mkdtemp()
+        self.cert, self.key = certificate(self.tmp)
+        self.socket = ssl.wrap_socket(
+            self.socket, certfile=self.cert, keyfile=self.key, server_side=True)
+        self.faults = faults or Faults()
+        self.records = []
+        self.documents = {}
+        self.versions = {}
+        self.delta = delta
+        self.chunked = chunked
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def handle_error(self, request, client_address):
+        error = sys.exc_info()[1]
+        if isinstance(error, (ssl.SSLError, socket.error)):
+            # client closed the connection
+            return
+        HTTPServer.handle_error(self, request, client_address)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def record(self, record):
+        self.lock.acquire()
+        try:
+            self.records.append(record)
+        finally:
+            self.lock.release()
+
+    def store(self, kind, consumer_id, document):
+        """
+        Store a document.
+        :return: The new version of the document.
+        :rtype: str
+        """
+        self.lock.acquire()
+        try:
+            key = (kind, consumer_id)
+            self.documents[key] = document
+            version = str(int(self.versions.get(key, 0)) + 1)
+            self.versions[key] = version
+            return version
+        finally:
+            self.lock.release()
+
+    def versioned(self, kind, consumer_id):
+        """
+        Get a stored document and its version.
+        :return: (document, version)
+        :rtype: tuple
+        """
+        self.lock.acquire()
+        try:
+            key = (kind, consumer_id)
+            return self.documents.get(key), self.versions.get(key)
+        finally:
+            self.lock.release()
+
+    def drain(self):
+        """
+        Get and clear the recorded requests.
+        :rtype: list
+        """
+        self.lock.acquire()
+        try:
+            records = self.records
+            self.records = []
+            return records
+        finally:
+            self.lock.release()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread:
+            self.shutdown()
+        self.server_close()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--port', type='int', default=8443)
+    parser.add_option('--delay', type='float', default=0, help='seconds added to each response')
+    parser.add_option('--error-rate', type='float', default=0, help='fraction of failed requests')
+    parser.add_option('--error-status', type='int', default=503)
+    parser.add_option('--retry-after', type='int', default=None)
+    parser.add_option('--no-delta', action='store_true', help='do not version the reports (no delta uploads)')
+    options, args = parser.parse_args()
+    faults = Faults(options.delay, options.error_rate, options.error_status, options.retry_after)
+    server = StandInServer(options.port, faults, not options.no_delta)
+    sys.stdout.write('listening on https://127.0.0.1:%d%s\n' % (server.port, PREFIX))
+    try:
+        server.serve_forever()
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+#
+# Copyright 2017 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+
+"""
+End to end tests of the delta uploads against the stand-in server.
+TestDeltaUpload runs the real upload code and requires the same
+packages as the fleet simulator.
+"""
+
+import os
+import ssl
+import sys
+import shutil
+import httplib
+import tempfile
+
+from unittest import TestCase
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+sys.path.append(os.path.dirname(__file__))
+
+from server import StandInServer, PREFIX
+
+
+class TestServer(TestCase):
+
+    def setUp(self):
+        self.server = StandInServer()
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def put(self, document):
+        conn = httplib.HTTPSConnection(
+            '127.0.0.1', self.server.port, context=ssl._create_unverified_context())
+        try:
+            conn.request('PUT', '%s/consumers/1234/tracer' % PREFIX, json.dumps(document))
+            response = conn.getresponse()
+            return response.status, json.loads(response.read())
+        finally:
+            conn.close()
+
+    def test_delta(self):
+        status, reply = self.put(dict(traces=dict(a=1, b=2)))
+        self.assertEqual(status, 200)
+
+        # test
+        status, reply = self.put(
+            dict(delta=dict(base=reply['version'], added=dict(c=3), removed=['a'])))
+
+        # validation
+        self.assertEqual(status, 200)
+        self.assertEqual(reply['version'], '2')
+        self.assertEqual(self.server.documents[('tracer', '1234')], dict(traces=dict(b=2, c=3)))
+
+    def test_conflict(self):
+        self.put(dict(traces=dict(a=1)))
+
+        # test
+        status, reply = self.put(dict(delta=dict(base='0', added={}, removed=['a'])))
+
+        # validation
+        self.assertEqual(status, 409)
+        self.assertEqual(self.server.documents[('tracer', '1234')], dict(traces=dict(a=1)))
+
+
+class TestDeltaUpload(TestCase):
+
+    REPOS = 200
+
+    def setUp(self):
+        import fleet
+        self.fleet = fleet
+        self.server = StandInServer()
+        self.server.start()
+        self.tmp = tempfile.mkdtemp()
+        self.operations, undo = fleet.configure(self.tmp, self.server.port)
+        self.addCleanup(undo)
+        self.host = fleet.Host(self.tmp, self.REPOS, 0)
+        fleet.local.host = self.host
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def upload(self, kind):
+        self.operations[kind]()
+        records = [r for r in self.server.drain() if r.route == kind]
+        self.assertEqual([r.status for r in records if r.status != 409], [200])
+        return records
+
+    def stored_repos(self):
+        document = self.server.documents[('enabled_repos', self.host.consumer_id)]
+        return sorted(document['enabled_repos']['repos'], key=lambda r: r['repositoryid'])
+
+    def test_enabled_repos(self):
+        full = self.upload('enabled_repos')[0].received
+
+        # test
+        self.host.repos.append(self.host.repo(self.REPOS))
+        self.host.repos.pop(0)
+        records = self.upload('enabled_repos')
+
+        # validation
+        self.assertEqual(len(records), 1)
+        self.assertTrue(records[0].received * 20 < full)
+        self.assertEqual(
+            self.stored_repos(), sorted(self.host.repos, key=lambda r: r['repositoryid']))
+
+    def test_enabled_repos_conflict(self):
+        self.upload('enabled_repos')
+        self.server.versions.clear()
+
+        # test
+        self.host.repos.pop()
+        records = self.upload('enabled_repos')
+
+        # validation
+        self.assertEqual([r.status for r in records], [409, 200])
+        self.assertEqual(
+            self.stored_repos(), sorted(self.host.repos, key=lambda r: r['repositoryid']))
+
+    def test_tracer(self):
+        self.host.traces = [dict(name='service-%d' % n) for n in range(100)]
+        full = self.upload('tracer')[0].received
+
+        # test
+        self.host.traces.append(dict(name='httpd'))
+        records = self.upload('tracer')
+
+        # validation
+        self.assertEqual(len(records), 1)
+        self.assertTrue(records[0].received * 20 < full)
+        document = self.server.documents[('tracer', self.host.consumer_id)]
+        self.assertEqual(
+            sorted(document['traces']), sorted([t['name'] for t in self.host.traces]))
+
+    def test_no_delta(self):
+        self.server.delta = False
+        self.upload('enabled_repos')
+
+        # test
+        self.host.repos.pop()
+        records = self.upload('enabled_repos')
+
+        # validation
+        self.assertEqual([r.status for r in records], [200])
+        self.assertEqual(
+            self.stored_repos(), sorted(self.host.repos, key=lambda r: r['repositoryid']))
@@ -0,0 +1,155 @@
+import os
+import gzip
+import shutil
+import tempfile
+
+from unittest import TestCase
+
+from mock import patch
+
+from katello import applicability
+from katello.applicability import ApplicabilityCache, rpmvercmp, compare_evr
+from katello.packages import Package
+
+
+REPOS = os.path.join(os.path.dirname(__file__), 'data', 'repos')
+
+
+INSTALLED = [
+    Package('zsh', 0, '5.0.2', '28.el7', 'x86_64', 1500000000, 'Red Hat, Inc.'),
+    Package('tzdata', 1, '2017b', '1.el7', 'noarch', 1500000001, None),
+    Package('kernel', 0, '3.10.0', '514.el7', 'x86_64', 1500000002, None),
+    Package('kernel', 0, '3.10.0', '693.2.2.el7', 'x86_64', 1500000003, None),
+]
+
+
+class TestCompare(TestCase):
+
+    def test_rpmvercmp(self):
+        cases = [
+            ('1.0', '1.0', 0),
+            ('1.0', '2.0', -1),
+            ('2.0.1', '2.0', 1),
+            ('1.010', '1.9', 1),
+            ('1.0a', '1.0', 1),
+            ('1.0a', '1.0.1', -1),
+            ('2017b', '2017a', 1),
+            ('28.el7_4.1', '28.el7', 1),
+            ('1.0~rc1', '1.0', -1),
+            ('1.0^git1', '1.0', 1),
+            ('1.0^git1', '1.0.1', -1),
+            ('1_0', '1.0', 0),
+        ]
+        for a, b, expected in cases:
+            # test
+            result = rpmvercmp(a, b)
+
+            # validation
+            self.assertEqual(result, expected, '%s %s: %d' % (a, b, result))
+            self.assertEqual(rpmvercmp(b, a), -expected)
+
+    @patch('katello.applicability.labelCompare', None)
+    def test_epoch(self):
+        # test
+        newer = compare_evr((1, '2017a', '1.el7'), (0, '2017b', '1.el7'))
+
+        # validation
+        self.assertEqual(newer, 1)
+
+
+class TestApplicability(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.repodirs = [os.path.join(REPOS, 'base'), os.path.join(REPOS, 'updates')]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_updateinfo_path(self):
+        # test
+        base = applicability.updateinfo_path(self.repodirs[0])
+        updates = applicability.updateinfo_path(self.repodirs[1])
+        missing = applicability.updateinfo_path(self.tmp)
+
+        # validation
+        self.assertEqual(base, os.path.join(REPOS, 'base', 'repodata', 'updateinfo.xml'))
+        self.assertEqual(updates, os.path.join(REPOS, 'updates', '0f1e2d-updateinfo.xml'))
+        self.assertEqual(missing, None)
+
+    def test_applicable(self):
+        # test
+        document = applicability.applicable(INSTALLED, self.repodirs)
+
+        # validation
+        self.assertEqual(document['errata'], ['RHSA-2017:0001', 'RHSA-2017:0004'])
+        self.assertEqual(document['rpms'], ['zsh-0:5.0.2-28.el7_4.2.x86_64'])
+
+    def test_compressed(self):
+        repodir = os.path.join(self.tmp, 'base')
+        shutil.copytree(self.repodirs[0], repodir)
+        repodata = os.path.join(repodir, 'repodata')
+        plain = os.path.join(repodata, 'updateinfo.xml')
+        fp = gzip.open(plain + '.gz', 'wb')
+        try:
+            fp.write(open(plain).read())
+        finally:
+            fp.close()
+        os.remove(plain)
+        repomd = os.path.join(repodata, 'repomd.xml')
+        content = open(repomd).read().replace('updateinfo.xml', 'updateinfo.xml.gz')
+        open(repomd, 'w').write(content)
+
+        # test
+        document = applicability.applicable(INSTALLED, [repodir])
+
+        # validation
+        self.assertEqual(document['errata'], ['RHSA-2017:0001'])
+
+    def test_cache(self):
+        path = os.path.join(self.tmp, 'applicability.json')
+        open(os.path.join(self.tmp, 'Packages'), 'w').close()
+        document = applicability.applicable(INSTALLED, self.repodirs)
+        fingerprint = applicability.fingerprint(self.repodirs, dbpath=self.tmp)
+
+        # test
+        ApplicabilityCache(path).save(fingerprint, document, True)
+        cache = ApplicabilityCache(path)
+
+        # validation
+        self.assertEqual(cache.fingerprint, fingerprint)
+        self.assertTrue(cache.uploaded)
+        self.assertTrue(cache.is_valid(applicability.applicable(INSTALLED, self.repodirs)))
+        self.assertFalse(cache.is_valid(applicability.applicable(INSTALLED[1:], self.repodirs)))
+        self.assertNotEqual(applicability.fingerprint(self.repodirs[:1], dbpath=self.tmp), fingerprint)
+
+    def test_not_uploaded(self):
+        path = os.path.join(self.tmp, 'applicability.json')
+        document = applicability.applicable(INSTALLED, self.repodirs)
+
+        # test
+        ApplicabilityCache(path).save('a' * 40, document, False)
+        cache = ApplicabilityCache(path)
+
+        # validation
+        self.assertEqual(cache.document, document)
+        self.assertFalse(cache.uploaded)
+        self.assertFalse(cache.is_valid(document))
+
+    def test_not_supported(self):
+        path = os.path.join(self.tmp, 'applicability.json')
+        document = applicability.applicable(INSTALLED, self.repodirs)
+        ApplicabilityCache(path).save('a' * 40, document, False)
+
+        # test
+        ApplicabilityCache(path).not_supported(now=1000.0)
+        cache = ApplicabilityCache(path)
+
+        # validation
+        self.assertEqual(cache.document, document)
+        self.assertFalse(cache.supported(now=1000.0 + applicability.UNSUPPORTED_RETRY - 1))
+        self.assertTrue(cache.supported(now=1000.0 + applicability.UNSUPPORTED_RETRY))
+        self.assertTrue(ApplicabilityCache(os.path.join(self.tmp, 'none.json')).supported())
+
+    def test_rpmdb_not_found(self):
+        self.assertEqual(applicability.fingerprint(self.repodirs, dbpath=self.tmp), None)
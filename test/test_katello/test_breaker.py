@@ -0,0 +1,206 @@
+#
+# Copyright 2017 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+
+import os
+import sys
+import socket
+import shutil
+import tempfile
+
+from unittest import TestCase
+
+from mock import patch, Mock
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../src'))
+
+from katello import breaker
+from katello.breaker import Breaker, CircuitOpen
+
+
+class ServerError(Exception):
+
+    def __init__(self, code):
+        Exception.__init__(self, code)
+        self.code = code
+
+
+class TestBreaker(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'breaker.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def breaker(self, server='katello:443'):
+        return Breaker(server, self.path, threshold=2, cooldown=300)
+
+    def fail(self, b):
+        self.assertRaises(socket.error, b.call, Mock(side_effect=socket.error()))
+
+    def test_closed(self):
+        b = self.breaker()
+        self.assertEqual(b.call(Mock(return_value=1)), 1)
+        self.assertFalse(b.blocked())
+
+    def test_opened(self):
+        b = self.breaker()
+        fn = Mock()
+
+        # test
+        self.fail(b)
+        self.assertFalse(b.blocked())
+        self.fail(b)
+
+        # validation
+        self.assertTrue(b.blocked())
+        self.assertTrue(self.breaker().blocked())
+        self.assertFalse(self.breaker('capsule:443').blocked())
+        self.assertRaises(CircuitOpen, b.call, fn)
+        self.assertFalse(fn.called)
+
+    def test_rejected_not_counted(self):
+        b = self.breaker()
+        for n in range(3):
+            self.assertRaises(ServerError, b.call, Mock(side_effect=ServerError(404)))
+        self.assertFalse(b.blocked())
+        self.fail(self.breaker())
+        self.fail(self.breaker())
+        self.assertTrue(b.blocked())
+
+    def test_server_error_counted(self):
+        b = self.breaker()
+        for n in range(2):
+            self.assertRaises(ServerError, b.call, Mock(side_effect=ServerError(503)))
+        self.assertTrue(b.blocked())
+
+    @patch('katello.breaker.time.time')
+    def test_probe(self, now):
+        b = self.breaker()
+        now.return_value = 1000
+        self.fail(b)
+        self.fail(b)
+
+        # cooled off: a single probe is let through
+        now.return_value = 1300
+        self.assertFalse(b.blocked())
+        b.acquire()
+        self.assertTrue(self.breaker().blocked())
+        self.assertRaises(CircuitOpen, self.breaker().acquire)
+
+        # failed probe: re-opened at once
+        b.failed()
+        self.assertTrue(b.blocked())
+
+        # succeeded probe: closed
+        now.return_value = 1600
+        self.assertEqual(b.call(Mock(return_value=1)), 1)
+        self.assertFalse(b.blocked())
+        self.fail(b)
+        self.assertFalse(b.blocked())
+
+    @patch('katello.breaker.time.time')
+    def test_probe_abandoned(self, now):
+        b = self.breaker()
+        now.return_value = 1000
+        self.fail(b)
+        self.fail(b)
+        now.return_value = 1300
+        b.acquire()
+
+        # test
+        now.return_value = 1300 + breaker.PROBE_TIMEOUT
+
+        # validation
+        self.assertFalse(b.blocked())
+
+    def test_storage_error(self):
+        b = Breaker('katello:443', os.path.join(self.tmp, 'none', 'breaker.json'), threshold=1)
+        self.fail(b)
+        self.assertFalse(b.blocked())
+
+    def test_corrupt(self):
+        fp = open(self.path, 'w')
+        fp.write('[')
+        fp.close()
+        b = self.breaker()
+        self.fail(b)
+        self.fail(b)
+        self.assertTrue(b.blocked())
+
+
+class TestRetryAfter(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'breaker.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_parse_seconds(self):
+        self.assertEqual(breaker.parse_retry_after('120'), 120)
+        self.assertEqual(breaker.parse_retry_after(' 0 '), 0)
+        self.assertEqual(breaker.parse_retry_after('999999999'), breaker.MAX_RETRY_AFTER)
+
+    def test_parse_date(self):
+        now = 784111777 - 30
+        self.assertEqual(breaker.parse_retry_after('Sun, 06 Nov 1994 08:49:37 GMT', now), 30)
+        self.assertEqual(breaker.parse_retry_after('Sun, 06 Nov 1994 08:49:37 GMT', now + 60), 0)
+
+    def test_parse_invalid(self):
+        self.assertEqual(breaker.parse_retry_after('soon'), None)
+        self.assertEqual(breaker.parse_retry_after('-1'), None)
+
+    def test_retry_after(self):
+        self.assertEqual(breaker.retry_after(breaker.RequestFailed(503, headers={'retry-after': '5'})), 5)
+        self.assertEqual(breaker.retry_after(breaker.RequestFailed(503, headers={'Retry-After': '5'})), 5)
+        self.assertEqual(breaker.retry_after(breaker.RequestFailed(503)), None)
+        self.assertEqual(breaker.retry_after(breaker.RequestFailed(429)), breaker.DEFAULT_RETRY_AFTER)
+        rhsm = ServerError(429)
+        rhsm.retry_after = 7
+        self.assertEqual(breaker.retry_after(rhsm), 7)
+        self.assertEqual(breaker.retry_after(ValueError()), None)
+
+    @patch('katello.breaker.time.time')
+    def test_deferred(self, now):
+        b = Breaker('katello:443', self.path)
+        fn = Mock()
+        failed = breaker.RequestFailed(503, headers={'retry-after': '120'})
+        now.return_value = 1000
+
+        # test
+        self.assertRaises(breaker.RequestFailed, b.call, Mock(side_effect=failed))
+
+        # validation
+        self.assertEqual(b.remaining(), 120)
+        self.assertRaises(CircuitOpen, Breaker('katello:443', self.path).call, fn)
+        self.assertFalse(fn.called)
+        now.return_value = 1120
+        b.call(fn)
+        self.assertTrue(fn.called)
+        self.assertFalse(b.blocked())
+
+    @patch('katello.breaker.time.time')
+    def test_deferral_kept(self, now):
+        b = Breaker('katello:443', self.path)
+        now.return_value = 1000
+        b.defer(120)
+        b.defer(10)
+
+        # test
+        b.succeeded()
+
+        # validation
+        self.assertEqual(b.remaining(), 120)
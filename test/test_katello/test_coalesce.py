@@ -0,0 +1,256 @@
+#
+# Copyright 2017 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+
+import os
+import sys
+import time
+
+from threading import Thread, Event, RLock, current_thread
+from unittest import TestCase
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../src'))
+
+from katello.agent.coalesce import Coalescer, Request, split
+
+
+def rpm(name):
+    return dict(type_id='rpm', unit_key=dict(name=name))
+
+
+def package(name):
+    return dict(name=name, version='1', release='1', epoch='0', arch='noarch')
+
+
+def report(resolved, deps=(), succeeded=True):
+    changes = len(resolved) + len(deps)
+    return dict(
+        succeeded=succeeded,
+        num_changes=changes,
+        reboot_scheduled=False,
+        details=dict(rpm=dict(
+            succeeded=succeeded,
+            num_changes=changes,
+            details=dict(resolved=list(resolved), deps=list(deps)))))
+
+
+class FakeDispatch(object):
+    """
+    Blocks the first call until released and resolves
+    each requested rpm to a package.
+    """
+
+    def __init__(self, fail=()):
+        self.calls = []
+        self.started = Event()
+        self.release = Event()
+        self.fail = fail
+
+    def __call__(self, method, units, options):
+        self.calls.append((method, [u['unit_key']['name'] for u in units], options))
+        if len(self.calls) == 1:
+            self.started.set()
+            self.release.wait()
+        names = [u['unit_key']['name'] for u in units]
+        if [n for n in names if n in self.fail]:
+            return report([], succeeded=False)
+        return report([package(n) for n in names], [package('dep')])
+
+
+class TestCoalescer(TestCase):
+
+    def submit(self, coalescer, method, units, options=None, name=None):
+        result = {}
+
+        def run():
+            result['reply'] = coalescer(method, units, options or {})
+
+        thread = Thread(target=run, name=name)
+        thread.start()
+        return thread, result
+
+    def queued(self, coalescer, count):
+        while len(coalescer.queue) < count:
+            time.sleep(0.01)
+
+    def queue(self, coalescer, requests):
+        """
+        Submit a first request, then the requests while it runs.
+        """
+        dispatch = coalescer.dispatch
+        first = self.submit(coalescer, 'install', [rpm('first')])
+        dispatch.started.wait()
+        pending = [self.submit(coalescer, *r) for r in requests]
+        while len(coalescer.queue) < len(requests):
+            time.sleep(0.01)
+        dispatch.release.set()
+        for thread, result in [first] + pending:
+            thread.join()
+        return [result['reply'] for thread, result in pending]
+
+    def test_single(self):
+        dispatch = FakeDispatch()
+        dispatch.release.set()
+        coalescer = Coalescer(RLock(), dispatch)
+
+        # test
+        reply = coalescer('update', [rpm('zsh')], {})
+
+        # validation
+        self.assertEqual(dispatch.calls, [('update', ['zsh'], {})])
+        self.assertEqual(reply, report([package('zsh')], [package('dep')]))
+
+    def test_merged(self):
+        dispatch = FakeDispatch()
+        coalescer = Coalescer(RLock(), dispatch)
+
+        # test
+        replies = self.queue(coalescer, [
+            ('install', [rpm('zsh')]),
+            ('install', [rpm('vim'), rpm('git')]),
+        ])
+
+        # validation
+        self.assertEqual(dispatch.calls[1:], [('install', ['zsh', 'vim', 'git'], {})])
+        self.assertEqual(replies[0], report([package('zsh')], [package('dep')]))
+        self.assertEqual(replies[1], report([package('vim'), package('git')]))
+
+    def test_not_compatible(self):
+        dispatch = FakeDispatch()
+        coalescer = Coalescer(RLock(), dispatch)
+
+        # test
+        self.queue(coalescer, [
+            ('install', [rpm('zsh')]),
+            ('update', [rpm('vim')]),
+            ('update', []),
+            ('update', [rpm('git')], dict(importkeys=True)),
+        ])
+
+        # validation
+        self.assertEqual(len(dispatch.calls), 5)
+
+    def test_failed_separately(self):
+        dispatch = FakeDispatch(fail=['bad'])
+        coalescer = Coalescer(RLock(), dispatch)
+
+        # test
+        replies = self.queue(coalescer, [
+            ('install', [rpm('zsh')]),
+            ('install', [rpm('bad')]),
+        ])
+
+        # validation
+        self.assertEqual(dispatch.calls[1:], [
+            ('install', ['zsh', 'bad'], {}),
+            ('install', ['zsh'], {}),
+            ('install', ['bad'], {}),
+        ])
+        self.assertTrue(replies[0]['succeeded'])
+        self.assertFalse(replies[1]['succeeded'])
+
+    def test_exception(self):
+        def dispatch(method, units, options):
+            raise ValueError()
+        coalescer = Coalescer(RLock(), dispatch)
+        self.assertRaises(ValueError, coalescer, 'install', [rpm('zsh')], {})
+        self.assertEqual(coalescer.queue, [])
+
+    def test_replied_when_done(self):
+        dispatch = FakeDispatch()
+        uninstalling = Event()
+
+        def blocking(method, units, options):
+            if method == 'uninstall':
+                uninstalling.wait()
+            return dispatch(method, units, options)
+
+        coalescer = Coalescer(RLock(), blocking)
+        first = self.submit(coalescer, 'install', [rpm('first')])
+        dispatch.started.wait()
+        installs = []
+        for name in ('zsh', 'vim'):
+            installs.append(self.submit(coalescer, 'install', [rpm(name)]))
+            self.queued(coalescer, len(installs))
+        uninstall = self.submit(coalescer, 'uninstall', [rpm('git')])
+        self.queued(coalescer, 3)
+
+        # test
+        dispatch.release.set()
+        for thread, result in [first] + installs:
+            thread.join(5)
+        replied = [t for t, r in installs if not t.is_alive()]
+        uninstalling.set()
+        uninstall[0].join()
+
+        # validation
+        self.assertEqual(len(replied), 2)
+        self.assertEqual(dispatch.calls[1:], [
+            ('install', ['zsh', 'vim'], {}),
+            ('uninstall', ['git'], {}),
+        ])
+
+    def test_cancelled_separately(self):
+        dispatch = FakeDispatch()
+        cancelled = set(['zsh'])
+
+        def cancellation():
+            name = current_thread().name
+            return lambda: name in cancelled
+
+        def cancellable(method, units, options):
+            if coalescer.cancelled():
+                dispatch.calls.append(('cancelled', [u['unit_key']['name'] for u in units], options))
+                return report([], succeeded=False)
+            return dispatch(method, units, options)
+
+        coalescer = Coalescer(RLock(), cancellable, cancellation)
+        first = self.submit(coalescer, 'install', [rpm('first')], name='first')
+        dispatch.started.wait()
+        pending = []
+        for name in ('zsh', 'vim'):
+            pending.append(self.submit(coalescer, 'install', [rpm(name)], name=name))
+            self.queued(coalescer, len(pending))
+
+        # test
+        dispatch.release.set()
+        for thread, result in [first] + pending:
+            thread.join()
+
+        # validation
+        self.assertEqual(dispatch.calls[1:], [
+            ('cancelled', ['zsh', 'vim'], {}),
+            ('cancelled', ['zsh'], {}),
+            ('install', ['vim'], {}),
+        ])
+        self.assertFalse(pending[0][1]['reply']['succeeded'])
+        self.assertTrue(pending[1][1]['reply']['succeeded'])
+
+
+class TestSplit(TestCase):
+
+    def test_other_types(self):
+        merged = dict(succeeded=True, details=dict(erratum=dict(details=dict(resolved=[1]))))
+        batch = [Request('install', [dict(type_id='erratum', unit_key={})], {})] * 2
+        self.assertEqual(split(merged, batch), [merged, merged])
+
+    def test_unrequested(self):
+        merged = report([package('zsh'), package('other')])
+        batch = [Request('install', [rpm('vim')], {}), Request('install', [rpm('zsh')], {})]
+
+        # test
+        replies = split(merged, batch)
+
+        # validation
+        self.assertEqual(replies[0]['details']['rpm']['details']['resolved'], [package('other')])
+        self.assertEqual(replies[1]['details']['rpm']['details']['resolved'], [package('zsh')])
+        self.assertEqual(replies[1]['num_changes'], 1)
@@ -0,0 +1,61 @@
+#
+# Copyright 2017 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+
+import os
+import sys
+
+from unittest import TestCase
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../src'))
+
+from katello import delta
+
+
+class Failed(Exception):
+
+    def __init__(self, code):
+        Exception.__init__(self, code)
+        self.code = code
+
+
+class TestDelta(TestCase):
+
+    def test_diff(self):
+        acknowledged = dict(a=1, b=2, c=3)
+        current = dict(a=1, b=20, d=4)
+
+        # test
+        added, removed = delta.diff(acknowledged, current)
+
+        # validation
+        self.assertEqual(added, dict(b=20, d=4))
+        self.assertEqual(removed, ['c'])
+
+    def test_diff_unchanged(self):
+        self.assertEqual(delta.diff(dict(a=1), dict(a=1)), ({}, []))
+
+    def test_document(self):
+        self.assertEqual(
+            delta.document('3', dict(d=4), ['c']),
+            dict(delta=dict(base='3', added=dict(d=4), removed=['c'])))
+
+    def test_version(self):
+        self.assertEqual(delta.version(dict(version='3')), '3')
+        self.assertEqual(delta.version({}), None)
+        self.assertEqual(delta.version(None), None)
+        self.assertEqual(delta.version([]), None)
+
+    def test_conflict(self):
+        self.assertTrue(delta.conflict(Failed(409)))
+        self.assertFalse(delta.conflict(Failed(500)))
+        self.assertFalse(delta.conflict(ValueError()))
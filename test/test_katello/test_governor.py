@@ -0,0 +1,160 @@
+import os
+import shutil
+import tempfile
+
+from unittest import TestCase
+
+from mock import patch, Mock
+
+from katello import governor
+from katello.governor import Policy, enter_scope, wait_for_load
+
+
+class TestPolicy(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'resources.conf')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_read(self):
+        fp = open(self.path, 'w')
+        fp.write('[resources]\nnice=5\nionice=2\ncpu_quota=50\nio_weight=\nmax_load=4.5\nmax_defer=bad\n')
+        fp.close()
+
+        # test
+        policy = Policy.read(self.path)
+
+        # validation
+        self.assertEqual(policy.nice, 5)
+        self.assertEqual(policy.ionice, 2)
+        self.assertEqual(policy.cpu_quota, 50)
+        self.assertEqual(policy.io_weight, None)
+        self.assertEqual(policy.max_load, 4.5)
+        self.assertEqual(policy.max_defer, 900)
+
+    def test_missing(self):
+        # test
+        policy = Policy.read(self.path)
+
+        # validation
+        self.assertEqual(policy.nice, 10)
+        self.assertEqual(policy.ionice, 3)
+        self.assertEqual(policy.max_load, None)
+
+
+class DBusException(Exception):
+    pass
+
+
+class TestScope(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.dbus = Mock(DBusException=DBusException)
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_properties(self):
+        open(os.path.join(self.root, 'cgroup.controllers'), 'w').close()
+        policy = Policy(cpu_quota=25, io_weight=50)
+
+        # test
+        properties = governor.scope_properties(policy, 1234, self.root)
+
+        # validation
+        self.assertEqual(properties, [
+            ('CPUQuotaPerSecUSec', 't', 250000),
+            ('IOWeight', 't', 50),
+            ('Description', 's', governor.DESCRIPTION),
+            ('PIDs', 'au', [1234]),
+        ])
+
+    def test_properties_v1(self):
+        # test
+        properties = governor.scope_properties(Policy(io_weight=5000), 1234, self.root)
+
+        # validation
+        self.assertEqual(properties[0], ('BlockIOWeight', 't', 1000))
+
+    def test_enter(self):
+        manager = self.dbus.Interface.return_value
+
+        # test
+        with patch('katello.governor.dbus', self.dbus):
+            entered = enter_scope(Policy(cpu_quota=25), 1234, self.root)
+
+        # validation
+        self.assertTrue(entered)
+        self.dbus.SystemBus.assert_called_once_with(private=True)
+        self.assertEqual(manager.StartTransientUnit.call_args[0][:2], ('katello-host-tools-1234.scope', 'fail'))
+        self.dbus.SystemBus.return_value.close.assert_called_once_with()
+        self.assertEqual(os.listdir(self.root), [])
+
+    def test_failed(self):
+        self.dbus.SystemBus.side_effect = DBusException()
+
+        # test
+        with patch('katello.governor.dbus', self.dbus):
+            entered = enter_scope(Policy(cpu_quota=25), 1234, self.root)
+
+        # validation
+        self.assertFalse(entered)
+
+    def test_no_dbus(self):
+        # test
+        with patch('katello.governor.dbus', None):
+            entered = enter_scope(Policy(cpu_quota=25), 1234, self.root)
+
+        # validation
+        self.assertFalse(entered)
+
+    def test_unlimited(self):
+        # test
+        with patch('katello.governor.dbus', self.dbus):
+            entered = enter_scope(Policy(), 1234, self.root)
+
+        # validation
+        self.assertFalse(entered)
+        self.assertFalse(self.dbus.SystemBus.called)
+
+
+class TestLoad(TestCase):
+
+    @patch('katello.governor.time.sleep')
+    @patch('katello.governor.os.getloadavg')
+    def test_deferred(self, getloadavg, sleep):
+        getloadavg.side_effect = [(8.0, 0, 0), (6.0, 0, 0), (2.0, 0, 0)]
+
+        # test
+        wait_for_load(4, 900)
+
+        # validation
+        self.assertEqual(getloadavg.call_count, 3)
+        self.assertEqual(sleep.call_count, 2)
+
+    @patch('katello.governor.time.time')
+    @patch('katello.governor.time.sleep')
+    @patch('katello.governor.os.getloadavg')
+    def test_max_defer(self, getloadavg, sleep, now):
+        getloadavg.return_value = (8.0, 0, 0)
+        now.side_effect = [0, 0, 20, 40, 40]
+
+        # test
+        waited = wait_for_load(4, 30, 15)
+
+        # validation
+        self.assertEqual(waited, 40)
+        self.assertEqual([c[0][0] for c in sleep.call_args_list], [15, 10])
+
+    @patch('katello.governor.os.getloadavg')
+    def test_no_threshold(self, getloadavg):
+        # test
+        waited = wait_for_load(None, 900)
+
+        # validation
+        self.assertEqual(waited, 0)
+        self.assertFalse(getloadavg.called)
@@ -0,0 +1,183 @@
+#
+# Copyright 2017 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+
+import os
+import sys
+import shutil
+import tempfile
+
+from unittest import TestCase
+
+from mock import patch, Mock
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../src'))
+
+from katello.packages import Package, Snapshot, snapshot, use_snapshot, rpmdb_fingerprint
+
+
+PACKAGES = [
+    Package('zsh', 0, '5.0.2', '28.el7', 'x86_64', 1500000000, 'Red Hat, Inc.'),
+    Package('tzdata', 1, '2017b', '1.el7', 'noarch', 1500000001, None),
+]
+
+
+class SnapshotTest(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'packages.idx')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+
+class TestSnapshot(SnapshotTest):
+
+    def test_round_trip(self):
+        fingerprint = 'a' * 40
+
+        # test
+        Snapshot.build(PACKAGES, fingerprint).write(self.path)
+        index = Snapshot.load(self.path)
+
+        # validation
+        self.assertEqual(index.fingerprint, fingerprint)
+        self.assertEqual(len(index), len(PACKAGES))
+        for p, q in zip(PACKAGES, index):
+            self.assertEqual(p.profile(), q.profile())
+            self.assertEqual(p.installtime, q.installtime)
+
+    def test_load_missing(self):
+        self.assertEqual(Snapshot.load(self.path), None)
+
+    def test_load_truncated(self):
+        Snapshot.build(PACKAGES, 'a' * 40).write(self.path)
+        fp = open(self.path, 'rb')
+        content = fp.read()
+        fp.close()
+        fp = open(self.path, 'wb')
+        fp.write(content[:-3])
+        fp.close()
+
+        # test and validation
+        self.assertEqual(Snapshot.load(self.path), None)
+
+    @patch('katello.packages.rpmdb_fingerprint')
+    def test_reused(self, fingerprint):
+        fingerprint.return_value = 'b' * 40
+        Snapshot.build(PACKAGES, fingerprint.return_value).write(self.path)
+
+        # test
+        index = snapshot(object(), path=self.path)
+
+        # validation
+        self.assertEqual(len(index), len(PACKAGES))
+
+    @patch('katello.packages.rpmdb_fingerprint')
+    def test_rebuilt(self, fingerprint):
+        fingerprint.return_value = 'c' * 40
+        Snapshot.build([], 'b' * 40).write(self.path)
+        yum_package = Mock(
+            pkgtup=(), epoch='1', installtime=12, vendor=None,
+            version='2', release='3', arch='noarch')
+        yum_package.name = 'bash'
+
+        # test
+        index = snapshot([yum_package], path=self.path)
+
+        # validation
+        self.assertEqual(index.fingerprint, fingerprint.return_value)
+        self.assertEqual(Snapshot.load(self.path).fingerprint, fingerprint.return_value)
+        self.assertEqual(index[0].profile(), dict(
+            name='bash', epoch=1, version='2', release='3', arch='noarch', vendor=None))
+
+    def test_rpmdb_not_found(self):
+        yum_package = Mock(
+            pkgtup=(), epoch='1', installtime=12, vendor=None,
+            version='2', release='3', arch='noarch')
+        yum_package.name = 'bash'
+
+        # test
+        index = snapshot([yum_package], path=self.path, dbpath=self.tmp)
+
+        # validation
+        self.assertEqual(rpmdb_fingerprint(self.tmp), None)
+        self.assertEqual(len(index), 1)
+        self.assertFalse(os.path.exists(self.path))
+
+
+class TestFingerprint(SnapshotTest):
+
+    def test_ndb(self):
+        path = os.path.join(self.tmp, 'Packages.db')
+        fp = open(path, 'w')
+        fp.write('ndb')
+        fp.close()
+
+        # test
+        before = rpmdb_fingerprint(self.tmp)
+        fp = open(path, 'a')
+        fp.write('changed')
+        fp.close()
+        after = rpmdb_fingerprint(self.tmp)
+
+        # validation
+        self.assertNotEqual(before, None)
+        self.assertNotEqual(before, after)
+
+
+class TestUseSnapshot(SnapshotTest):
+
+    class RPMProfile(object):
+        pass
+
+    class RPMPackage(object):
+
+        def __init__(self, name, version, release, arch, epoch=0, vendor=None):
+            self.name = name
+            self.epoch = epoch
+            self.vendor = vendor
+
+    def modules(self, manager):
+        profile = Mock(RPMProfile=self.RPMProfile, Package=self.RPMPackage)
+        injection = Mock(PROFILE_MANAGER='PROFILE_MANAGER')
+        injection.require.return_value = manager
+        subscription_manager = Mock(injection=injection)
+        return {
+            'rhsm': Mock(profile=profile),
+            'rhsm.profile': profile,
+            'subscription_manager': subscription_manager,
+            'subscription_manager.injection': injection,
+        }
+
+    def test_reported(self):
+        manager = Mock()
+
+        # test
+        with patch.dict(sys.modules, self.modules(manager)):
+            use_snapshot(PACKAGES)
+
+        # validation
+        profile = manager.current_profile
+        self.assertTrue(isinstance(profile, self.RPMProfile))
+        self.assertEqual(
+            [(p.name, p.epoch, p.vendor) for p in profile.packages],
+            [('zsh', 0, 'Red Hat, Inc.'), ('tzdata', 1, None)])
+
+    def test_not_injected(self):
+        modules = self.modules(None)
+        modules['subscription_manager.injection'].require.side_effect = KeyError('PROFILE_MANAGER')
+
+        # test
+        with patch.dict(sys.modules, modules):
+            use_snapshot(PACKAGES)
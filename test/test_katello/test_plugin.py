@@ -13,7 +13,12 @@
 
 import os
 import sys
+import time
+import shutil
 import httplib
+import tempfile
+
+from threading import Thread
 
 from unittest import TestCase
 
@@ -55,30 +60,46 @@ class PluginTest(TestCase):
 
 class TestBundle(PluginTest):
 
-    @patch('__builtin__.open')
-    def test_bundle(self, fake_open):
-        fake_fp = Mock()
-        fake_open.return_value = fake_fp
+    def setUp(self):
+        PluginTest.setUp(self)
+        self.certificate = Mock()
+        self.certificate.PATH = tempfile.mkdtemp()
+        self.certificate.key = 'TEST-KEY'
+        self.certificate.cert = 'TEST-CERT'
+        self.path = os.path.join(self.certificate.PATH, 'bundle.pem')
+
+    def tearDown(self):
+        shutil.rmtree(self.certificate.PATH, ignore_errors=True)
+
+    def test_bundle(self):
+        # test
+        path = self.plugin.bundle(self.certificate)
+
+        # validation
+        self.assertEqual(path, self.path)
+        self.assertEqual(open(path).read(), 'TEST-KEYTEST-CERT')
+        self.assertEqual(os.stat(path).st_mode & 0777, 0600)
+        self.assertEqual(os.listdir(self.certificate.PATH), ['bundle.pem'])
+
+    @patch('katello.agent.katelloplugin.os.rename')
+    def test_unchanged(self, rename):
+        fp = open(self.path, 'w')
+        fp.write('TEST-KEYTEST-CERT')
+        fp.close()
 
         # test
-        certificate = Mock()
-        certificate.PATH = '/tmp/path/test'
-        certificate.key = 'TEST-KEY'
-        certificate.cert = 'TEST-CERT'
-        self.plugin.bundle(certificate)
+        self.plugin.bundle(self.certificate)
 
         # validation
-        fake_open.assert_called_with(os.path.join(certificate.PATH, 'bundle.pem'), 'w')
-        fake_fp.write.assert_any_call(certificate.key)
-        fake_fp.write.assert_any_call(certificate.cert)
-        fake_fp.close.assert_called_with()
+        self.assertFalse(rename.called)
 
 
 class TestCertificateChanged(PluginTest):
 
+    @patch('katello.agent.katelloplugin.send_enabled_report')
     @patch('katello.agent.katelloplugin.update_settings')
     @patch('katello.agent.katelloplugin.validate_registration')
-    def test_registered(self, validate, update_settings):
+    def test_registered(self, validate, update_settings, send_enabled_report):
 
         # test
         self.plugin.certificate_changed('')
@@ -86,6 +107,7 @@ class TestCertificateChanged(PluginTest):
         # validation
         validate.assert_called_with()
         update_settings.assert_called_with()
+        send_enabled_report.assert_called_once_with()
         self.plugin.plugin.attach.assert_called_with()
 
     @patch('katello.agent.katelloplugin.update_settings')
@@ -116,6 +138,31 @@ class TestCertificateChanged(PluginTest):
         update_settings.assert_called_with()
         self.plugin.plugin.attach.assert_called_with()
 
+class TestSendEnabledReport(PluginTest):
+
+    @patch('katello.agent.katelloplugin.Thread')
+    @patch('katello.agent.katelloplugin.Popen')
+    def test_reaped(self, popen, thread):
+        # test
+        self.plugin.send_enabled_report()
+
+        # validation
+        self.assertEqual(popen.call_args[0][0], self.plugin.ENABLED_REPOS_COMMAND)
+        thread.assert_called_once_with(target=popen.return_value.wait, name='EnabledReport')
+        thread.return_value.start.assert_called_once_with()
+
+    @patch('katello.agent.katelloplugin.Thread')
+    @patch('katello.agent.katelloplugin.Popen')
+    def test_not_found(self, popen, thread):
+        popen.side_effect = OSError()
+
+        # test
+        self.plugin.send_enabled_report()
+
+        # validation
+        self.assertFalse(thread.called)
+
+
 class TestUpdateSettings(PluginTest):
     host = 'redhat.com'
     server_ca_cert = '%(ca_cert_dir)skatello-server-ca.pem'
@@ -167,9 +214,10 @@ class TestUpdateSettings(PluginTest):
         fake_read.return_value = fake_certificate
 
         # test
-        self.plugin.update_settings()
+        settings = self.plugin.update_settings()
 
         # validation
+        self.assertEqual(settings.uuid, 'pulp.agent.%s' % consumer_id)
         fake_read.assert_called_with()
         fake_bundle.assert_called_with(fake_certificate)
         plugin_cfg = self.plugin.plugin.cfg
@@ -178,12 +226,78 @@ class TestUpdateSettings(PluginTest):
         self.assertEqual(plugin_cfg.messaging.uuid, 'pulp.agent.%s' % consumer_id)
 
 
+class TestAttach(PluginTest):
+
+    def settings(self, uuid='pulp.agent.1234'):
+        return self.plugin.Settings('proton+amqps://redhat.com:5647', uuid, '/etc/rhsm/ca/katello-default-ca.pem')
+
+    def test_attach(self):
+        # test
+        self.plugin.attach(self.settings())
+
+        # validation
+        self.plugin.plugin.attach.assert_called_once_with()
+        self.assertEqual(self.plugin.attached, self.settings())
+
+    def test_unchanged(self):
+        self.plugin.attach(self.settings())
+
+        # test
+        self.plugin.attach(self.settings())
+
+        # validation
+        self.assertEqual(self.plugin.plugin.attach.call_count, 1)
+
+    def test_changed(self):
+        self.plugin.attach(self.settings())
+
+        # test
+        self.plugin.attach(self.settings('pulp.agent.5678'))
+
+        # validation
+        self.assertEqual(self.plugin.plugin.attach.call_count, 2)
+
+    def test_cacert_rotated(self):
+        tmp = tempfile.mkdtemp()
+        cacert = os.path.join(tmp, 'katello-default-ca.pem')
+        open(cacert, 'w').write('old')
+        url = 'proton+amqps://redhat.com:5647'
+        try:
+            self.plugin.attach(self.plugin.Settings(url, 'pulp.agent.1234', cacert))
+            open(cacert, 'w').write('new')
+
+            # test
+            self.plugin.attach(self.plugin.Settings(url, 'pulp.agent.1234', cacert))
+        finally:
+            shutil.rmtree(tmp)
+
+        # validation
+        self.assertEqual(self.plugin.plugin.attach.call_count, 2)
+
+    def test_detached(self):
+        self.plugin.attach(self.settings())
+        self.plugin.detach()
+
+        # test
+        self.plugin.attach(self.settings())
+
+        # validation
+        self.plugin.plugin.detach.assert_called_once_with()
+        self.assertEqual(self.plugin.plugin.attach.call_count, 2)
+
+    def test_read_only(self):
+        settings = self.settings()
+        self.assertRaises(AttributeError, setattr, settings, 'uuid', 'x')
+
+
 class TestInitializer(PluginTest):
 
+    @patch('katello.agent.katelloplugin.AgentRestart.prepare')
+    @patch('katello.agent.katelloplugin.Thread')
     @patch('katello.agent.katelloplugin.path_monitor')
     @patch('katello.agent.katelloplugin.ConsumerIdentity.certpath')
     @patch('katello.agent.katelloplugin.validate_registration')
-    def test_init(self, fake_validate, fake_path, fake_pmon):
+    def test_init(self, fake_validate, fake_path, fake_pmon, fake_thread, fake_prepare):
         self.plugin.registered = False
 
         # test
@@ -192,20 +306,29 @@ class TestInitializer(PluginTest):
         # validation
         fake_path.assert_called_with()
         fake_pmon.add.assert_any_call(fake_path(), self.plugin.certificate_changed)
+        fake_prepare.assert_called_once_with()
+        fake_pmon.add.assert_any_call(
+            self.plugin.AgentRestart.RESTART_FILE, self.plugin.AgentRestart.requested)
+        fake_pmon.add.assert_any_call(
+            self.plugin.AgentRestart.LEGACY_RESTART_FILE, self.plugin.AgentRestart.requested)
         fake_pmon.start.assert_called_with()
-        fake_validate.assert_called_with()
+        fake_thread.assert_called_with(target=self.plugin.initialize, name='Initializer')
+        fake_thread.return_value.start.assert_called_with()
+        self.assertFalse(fake_validate.called)
+        self.assertEqual(self.plugin.state.name, self.plugin.State.STARTING)
 
     @patch('katello.agent.katelloplugin.update_settings')
     @patch('katello.agent.katelloplugin.validate_registration')
     def test_registered(self, validate, update_settings):
 
         # test
-        self.plugin.init_plugin()
+        self.plugin.initialize()
 
         # validation
         validate.assert_called_with()
         update_settings.assert_called_with()
-        self.assertFalse(self.plugin.plugin.attach.called)
+        self.plugin.plugin.attach.assert_called_with()
+        self.assertEqual(self.plugin.state.name, self.plugin.State.REGISTERED)
 
     @patch('katello.agent.katelloplugin.update_settings')
     @patch('katello.agent.katelloplugin.validate_registration')
@@ -213,27 +336,32 @@ class TestInitializer(PluginTest):
         self.plugin.registered = False
 
         # test
-        self.plugin.init_plugin()
+        self.plugin.initialize()
 
         # validation
         validate.assert_called_with()
         self.assertFalse(update_settings.called)
         self.assertFalse(self.plugin.plugin.attach.called)
+        self.assertEqual(self.plugin.state.name, self.plugin.State.UNREGISTERED)
 
     @patch('katello.agent.katelloplugin.sleep')
     @patch('katello.agent.katelloplugin.update_settings')
     @patch('katello.agent.katelloplugin.validate_registration')
     def test_run_validate_failed(self, validate, update_settings, sleep):
-        validate.side_effect = [ValueError, None]
+        states = []
+        validate.side_effect = [ValueError('down'), None]
+        sleep.side_effect = lambda n: states.append(self.plugin.Report().state())
 
         # test
-        self.plugin.init_plugin()
+        self.plugin.initialize()
 
         # validation
         validate.assert_called_with()
         sleep.assert_called_once_with(60)
         update_settings.assert_called_with()
-        self.assertFalse(self.plugin.plugin.attach.called)
+        self.plugin.plugin.attach.assert_called_with()
+        self.assertEqual(states[0]['state'], self.plugin.State.RETRYING)
+        self.assertEqual(states[0]['error'], 'down')
 
 
 class TestConduit(PluginTest):
@@ -272,23 +400,27 @@ class TestConduit(PluginTest):
         mock_context.cancelled = Mock(return_value=True)
         mock_current.return_value = mock_context
         conduit = self.plugin.Conduit()
+        dispatch = Mock(side_effect=lambda method, units, options: conduit.cancelled())
 
         # test
-        cancelled = conduit.cancelled()
+        with patch.object(self.plugin.coalescer, 'dispatch', dispatch):
+            cancelled = self.plugin.coalescer('install', [], {})
 
         # validation
         self.assertTrue(cancelled)
         self.assertTrue(mock_context.cancelled.called)
 
     @patch('gofer.agent.rmi.Context.current')
-    def test_cancelled(self, mock_current):
+    def test_not_cancelled(self, mock_current):
         mock_context = Mock()
         mock_context.cancelled = Mock(return_value=False)
         mock_current.return_value = mock_context
         conduit = self.plugin.Conduit()
+        dispatch = Mock(side_effect=lambda method, units, options: conduit.cancelled())
 
         # test
-        cancelled = conduit.cancelled()
+        with patch.object(self.plugin.coalescer, 'dispatch', dispatch):
+            cancelled = self.plugin.coalescer('install', [], {})
 
         # validation
         self.assertFalse(cancelled)
@@ -425,6 +557,28 @@ class TestValidateRegistration(PluginTest):
         get_consumer.assert_called_with(consumer_id)
         self.assertFalse(self.plugin.registered)
 
+    @patch('katello.agent.katelloplugin.Breaker')
+    @patch('katello.agent.katelloplugin.UEP.getConsumer')
+    @patch('katello.agent.katelloplugin.ConsumerIdentity.read')
+    @patch('katello.agent.katelloplugin.ConsumerIdentity.existsAndValid')
+    def test_validate_registration_deferred(self, valid, read, get_consumer, breaker):
+        valid.return_value = True
+        breaker.return_value.call.side_effect = self.plugin.CircuitOpen()
+
+        # test
+        self.assertRaises(self.plugin.CircuitOpen, self.plugin.validate_registration)
+
+        # validation
+        self.assertFalse(get_consumer.called)
+        self.assertFalse(self.plugin.registered)
+
+    @patch('katello.agent.katelloplugin.Breaker')
+    def test_retry_delay(self, breaker):
+        breaker.return_value.remaining.return_value = 0
+        self.assertEqual(self.plugin.retry_delay(), self.plugin.RETRY_DELAY)
+        breaker.return_value.remaining.return_value = 600
+        self.assertEqual(self.plugin.retry_delay(), 600)
+
 class TestConsumer(PluginTest):
 
     def test_unregister(self):
@@ -484,39 +638,137 @@ class TestContent(PluginTest):
         mock_dispatcher().uninstall.assert_called_with(mock_conduit(), units, options)
         self.assertEqual(report, _report.dict())
 
+    @patch('katello.agent.katelloplugin.coalescer')
+    def test_uninstall_queued(self, coalescer):
+        coalescer.return_value = {'report': 18}
+
+        # test
+        units = [{'A': 100}]
+        options = {'B': 200}
+        content = self.plugin.Content()
+        report = content.uninstall(units, options)
+
+        # validation
+        coalescer.assert_called_once_with('uninstall', units, options, True)
+        self.assertEqual(report, {'report': 18})
+
+
+class TestReport(PluginTest):
+
+    @patch('katello.agent.katelloplugin.read_json')
+    def test_packages(self, read_json):
+        read_json.return_value = [{'name': 'zsh'}]
+
+        # test
+        report = self.plugin.Report()
+        packages = report.packages()
+
+        # validation
+        read_json.assert_called_once_with(self.plugin.package_upload.CACHE_FILE)
+        self.assertEqual(packages, read_json.return_value)
+
+    @patch('katello.agent.katelloplugin.enabled_repos_upload.lookup_consumer_id')
+    @patch('katello.agent.katelloplugin.read_json')
+    def test_enabled_repos(self, read_json, lookup):
+        lookup.return_value = '1234'
+        read_json.return_value = {'1234': {'enabled_repos': {'repos': []}}}
+
+        # test
+        report = self.plugin.Report()
+        enabled = report.enabled_repos()
+
+        # validation
+        self.assertEqual(enabled, {'enabled_repos': {'repos': []}})
+
+    @patch('katello.agent.katelloplugin.read_json')
+    def test_enabled_repos_not_cached(self, read_json):
+        read_json.return_value = None
+
+        # test
+        report = self.plugin.Report()
+
+        # validation
+        self.assertEqual(report.enabled_repos(), None)
+
+
+class TestDispatch(PluginTest):
+
+    @patch('katello.agent.katelloplugin.Worker')
+    @patch('katello.agent.katelloplugin.Conduit')
+    def test_isolated(self, conduit, worker):
+        self.plugin.plugin.cfg.content = Mock(isolated='1', timeout='60', memory='10')
+        worker.return_value.return_value = {'report': 1}
+
+        # test
+        units = [{'A': 1}]
+        options = {'B': 2}
+        report = self.plugin.dispatch('install', units, options)
+
+        # validation
+        worker.assert_called_once_with(
+            timeout=60, memory=10 * 1024 * 1024, cancelled=conduit.return_value.cancelled)
+        worker.return_value.assert_called_once_with('install', units, options)
+        self.assertEqual(report, {'report': 1})
+
+    @patch('katello.agent.katelloplugin.Worker')
+    @patch('katello.agent.katelloplugin.Conduit')
+    @patch('katello.agent.katelloplugin.Dispatcher')
+    def test_in_process(self, dispatcher, conduit, worker):
+        self.plugin.plugin.cfg.content = Mock(isolated='0', timeout='', memory='')
+        dispatcher().update.return_value.dict.return_value = {'report': 2}
+
+        # test
+        report = self.plugin.dispatch('update', [], {})
+
+        # validation
+        self.assertFalse(worker.called)
+        dispatcher().update.assert_called_with(conduit(), [], {})
+        self.assertEqual(report, {'report': 2})
+
 
 class TestAgentRestart(PluginTest):
 
-    @patch('os.listdir')
-    def test_busy(self, listdir):
-        listdir.return_value = [
-            'file0',
-            'file1'
-        ]
+    def test_busy(self):
+        self.plugin.activity.enter()
 
         # test
         restart = self.plugin.AgentRestart()
         busy = restart.is_busy()
 
         # validation
-        listdir.assert_called_once_with('/tmp/pending/abc')
         self.assertTrue(busy)
 
-    @patch('os.listdir')
-    def test_not_busy(self, listdir):
-        listdir.return_value = []
+    def test_not_busy(self):
+        self.plugin.activity.enter()
+        self.plugin.activity.leave()
 
         # test
         restart = self.plugin.AgentRestart()
         busy = restart.is_busy()
 
         # validation
-        listdir.assert_called_once_with('/tmp/pending/abc')
         self.assertFalse(busy)
 
+    def test_prepare(self):
+        tmp = tempfile.mkdtemp()
+        path = os.path.join(tmp, 'katello-agent', 'restart')
+
+        # test
+        try:
+            with patch.object(self.plugin.AgentRestart, 'RESTART_FILE', path):
+                self.plugin.AgentRestart.prepare()
+                self.plugin.AgentRestart.prepare()
+
+            # validation
+            self.assertTrue(os.path.isdir(os.path.dirname(path)))
+        finally:
+            shutil.rmtree(tmp)
+
+    @patch('os.path.exists')
     @patch('os.unlink')
     @patch('katello.agent.katelloplugin.Popen')
-    def test_restart(self, popen, unlink):
+    def test_restart(self, popen, unlink, exists):
+        exists.side_effect = lambda path: path == self.plugin.AgentRestart.RESTART_FILE
         popen.return_value.wait.return_value = 123
 
         # test
@@ -529,45 +781,103 @@ class TestAgentRestart(PluginTest):
         popen.return_value.wait.assert_called_once_with()
         self.assertEqual(exit_val, popen.return_value.wait.return_value)
 
+    @patch('katello.agent.katelloplugin.Thread')
+    @patch('os.path.exists')
+    def test_requested(self, exists, thread):
+        exists.return_value = True
+
+        # test
+        self.plugin.AgentRestart.requested(self.plugin.AgentRestart.RESTART_FILE)
+
+        # validation
+        exists.assert_any_call(self.plugin.AgentRestart.RESTART_FILE)
+        thread.return_value.start.assert_called_once_with()
+
+    @patch('katello.agent.katelloplugin.Thread')
     @patch('os.path.exists')
-    def test_apply_not_requested(self, exists):
+    def test_requested_legacy(self, exists, thread):
+        exists.side_effect = lambda path: path == self.plugin.AgentRestart.LEGACY_RESTART_FILE
+
+        # test
+        self.plugin.AgentRestart.requested(self.plugin.AgentRestart.LEGACY_RESTART_FILE)
+
+        # validation
+        thread.return_value.start.assert_called_once_with()
+
+    @patch('katello.agent.katelloplugin.Thread')
+    @patch('os.path.exists')
+    def test_not_requested(self, exists, thread):
         exists.return_value = False
 
         # test
-        restart = self.plugin.AgentRestart()
-        restart.restart = Mock()
-        restart.apply()
+        self.plugin.AgentRestart.requested(self.plugin.AgentRestart.RESTART_FILE)
 
         # validation
-        exists.assert_called_once_with(self.plugin.AgentRestart.RESTART_FILE)
-        self.assertFalse(restart.restart.called)
+        self.assertFalse(thread.called)
 
+    @patch('katello.agent.katelloplugin.sleep')
     @patch('os.path.exists')
-    def test_apply_request_and_busy(self, exists):
+    def test_apply_drained(self, exists, sleep):
         exists.return_value = True
+        activity = self.plugin.activity
+        activity.enter()
+        restart = self.plugin.AgentRestart()
+        restart.restart = Mock(return_value=1)
+        thread = Thread(target=restart.apply)
+        thread.start()
+        while not activity.draining:
+            time.sleep(0.01)
 
         # test
-        restart = self.plugin.AgentRestart()
-        restart.is_busy = Mock(return_value=True)
-        restart.restart = Mock()
-        restart.apply()
+        self.assertFalse(restart.restart.called)
+        activity.leave()
+        thread.join()
 
         # validation
-        exists.assert_called_once_with(self.plugin.AgentRestart.RESTART_FILE)
-        restart.is_busy.assert_called_once_with()
-        self.assertFalse(restart.restart.called)
+        sleep.assert_called_once_with(self.plugin.AgentRestart.DRAIN_DELAY)
+        restart.restart.assert_called_once_with()
+        self.assertFalse(activity.draining)
 
+    @patch('katello.agent.katelloplugin.sleep')
     @patch('os.path.exists')
-    def test_apply_restarted(self, exists):
+    def test_apply_restarted(self, exists, sleep):
         exists.return_value = True
 
         # test
         restart = self.plugin.AgentRestart()
-        restart.is_busy = Mock(return_value=False)
         restart.restart = Mock(return_value=0)
         restart.apply()
 
         # validation
-        exists.assert_called_once_with(self.plugin.AgentRestart.RESTART_FILE)
-        restart.is_busy.assert_called_once_with()
+        exists.assert_any_call(self.plugin.AgentRestart.RESTART_FILE)
         restart.restart.assert_called_once_with()
+
+
+class TestTracked(PluginTest):
+
+    def test_tracked(self):
+        counts = []
+        fn = self.plugin.tracked(lambda: counts.append(self.plugin.activity.count))
+
+        # test
+        fn()
+
+        # validation
+        self.assertEqual(counts, [1])
+        self.assertEqual(self.plugin.activity.count, 0)
+
+    def test_held_while_draining(self):
+        activity = self.plugin.activity
+        fn = self.plugin.tracked(Mock(__name__='fn'))
+        activity.drain()
+        thread = Thread(target=fn)
+        thread.start()
+
+        # test
+        time.sleep(0.1)
+        self.assertEqual(activity.count, 0)
+        activity.resume()
+        thread.join()
+
+        # validation
+        self.assertEqual(activity.count, 0)
@@ -0,0 +1,91 @@
+#
+# Copyright 2017 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+
+import os
+import sys
+import shutil
+import tempfile
+
+from Queue import Queue, Empty
+from unittest import TestCase
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../src'))
+
+from katello.agent.pmon import InotifyMonitor
+
+
+def write(path, content):
+    fp = open(path, 'w')
+    fp.write(content)
+    fp.close()
+
+
+class TestInotifyMonitor(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.dir = os.path.join(self.tmp, 'consumer')
+        os.mkdir(self.dir)
+        self.path = os.path.join(self.dir, 'cert.pem')
+        write(self.path, 'A')
+        self.changed = Queue()
+        self.monitor = InotifyMonitor()
+        self.monitor.add(self.path, self.changed.put)
+        self.monitor.start()
+
+    def tearDown(self):
+        self.monitor.abort()
+        self.monitor.join(5)
+        shutil.rmtree(self.tmp)
+
+    def assertChanged(self):
+        self.assertEqual(self.changed.get(timeout=5), self.path)
+
+    def assertNotChanged(self):
+        self.assertRaises(Empty, self.changed.get, timeout=0.2)
+
+    def test_write(self):
+        write(self.path, 'B')
+        self.assertChanged()
+
+    def test_touch(self):
+        os.utime(self.path, None)
+        self.assertNotChanged()
+
+    def test_rename_replace(self):
+        tmp = os.path.join(self.dir, '.cert.pem.tmp')
+        write(tmp, 'B')
+        os.rename(tmp, self.path)
+        self.assertChanged()
+
+    def test_delete(self):
+        os.unlink(self.path)
+        self.assertChanged()
+
+    def test_directory_recreated(self):
+        shutil.rmtree(self.dir)
+        self.assertChanged()
+        os.mkdir(self.dir)
+        write(self.path, 'C')
+        self.assertChanged()
+        write(self.path, 'D')
+        self.assertChanged()
+
+    def test_unrelated(self):
+        write(os.path.join(self.dir, 'key.pem'), 'K')
+        self.assertNotChanged()
+
+    def test_affected(self):
+        wd = [w for w, p in self.monitor.watches.items() if p == self.dir][0]
+        self.assertEqual(self.monitor.affected([(wd, 0, 'key.pem')]), [])
+        self.assertEqual(self.monitor.affected([(wd, 0, 'cert.pem')]), [self.path])
@@ -0,0 +1,84 @@
+#
+# Copyright 2017 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+
+import os
+import sys
+import time
+
+from unittest import TestCase
+
+from mock import Mock
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../src'))
+
+from katello import posttrans
+
+
+class TestPosttrans(TestCase):
+
+    def test_concurrent(self):
+        started = time.time()
+
+        # test
+        for name in ('a', 'b', 'c'):
+            posttrans.submit(name, lambda: time.sleep(0.5), Mock())
+        posttrans.wait()
+
+        # validation
+        self.assertTrue(time.time() - started < 1.4)
+
+    def test_back_to_back(self):
+        fn = Mock()
+        failed = Mock()
+        exception = ValueError()
+
+        # test
+        for n in range(2):
+            posttrans.submit('a', fn, Mock())
+            posttrans.submit('b', Mock(side_effect=exception), failed)
+            posttrans.wait()
+
+        # validation
+        self.assertEqual(fn.call_count, 2)
+        self.assertEqual(failed.call_count, 2)
+        self.assertEqual(posttrans.tasks, [])
+
+    def test_same_name_ordered(self):
+        calls = []
+
+        def first():
+            time.sleep(0.3)
+            calls.append(1)
+
+        # test
+        posttrans.submit('a', first, Mock())
+        posttrans.submit('a', lambda: calls.append(2), Mock())
+        posttrans.wait()
+
+        # validation
+        self.assertEqual(calls, [1, 2])
+
+    def test_failed_reported_once(self):
+        failed = Mock()
+        exception = ValueError()
+        succeeded = Mock()
+
+        # test
+        posttrans.submit('a', Mock(side_effect=exception), failed)
+        posttrans.submit('b', Mock(), succeeded)
+        posttrans.wait()
+        posttrans.wait()
+
+        # validation
+        failed.assert_called_once_with(exception)
+        self.assertFalse(succeeded.called)
@@ -0,0 +1,101 @@
+from unittest import TestCase
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from katello.agent import reply
+
+
+def package(n):
+    return dict(
+        name='package-%d' % n,
+        epoch='0',
+        version='1.%d' % n,
+        release='1.el7',
+        arch='x86_64',
+        qname='package-%d-1.%d-1.el7.x86_64' % (n, n),
+        repoid='Org-Red_Hat_Enterprise_Linux_Server-Red_Hat_Enterprise_Linux_7_Server_RPMs_x86_64_7Server')
+
+
+def report(resolved=500, deps=300):
+    return dict(
+        succeeded=False,
+        num_changes=resolved + deps,
+        reboot_scheduled=False,
+        details=dict(
+            rpm=dict(
+                succeeded=True,
+                num_changes=resolved + deps,
+                details=dict(
+                    resolved=[package(n) for n in range(resolved)],
+                    deps=[package(n) for n in range(resolved, resolved + deps)])),
+            erratum=dict(
+                succeeded=False,
+                details=dict(message='failed', errors=['e%d' % n for n in range(20)]))))
+
+
+class TestReply(TestCase):
+
+    def test_not_requested(self):
+        options = dict(importkeys=True)
+        original = report(2, 1)
+
+        # test
+        options, spec = reply.requested(options)
+        encoded = reply.encode(original, spec)
+
+        # validation
+        self.assertEqual(options, dict(importkeys=True))
+        self.assertTrue(encoded is original)
+
+    def test_requested(self):
+        options = dict(importkeys=True, reply=dict(compress=True))
+
+        # test
+        stripped, spec = reply.requested(options)
+
+        # validation
+        self.assertEqual(stripped, dict(importkeys=True))
+        self.assertEqual(spec, dict(compress=True))
+        self.assertTrue('reply' in options)
+
+    def test_round_trip(self):
+        original = report()
+
+        for spec in (dict(), dict(compress=True)):
+            # test
+            encoded = reply.encode(original, spec)
+            decoded = reply.decode(json.loads(json.dumps(encoded)))
+
+            # validation
+            self.assertEqual(encoded['encoding'], reply.ENCODING)
+            self.assertEqual(encoded['num_changes'], 800)
+            self.assertEqual(decoded, original)
+
+    def test_size(self):
+        original = report()
+
+        # test
+        encoded = reply.encode(original, dict(compress=True))
+
+        # validation
+        size = len(json.dumps(original))
+        compact = len(json.dumps(encoded))
+        self.assertTrue(compact * 10 <= size, '%d -> %d bytes' % (size, compact))
+
+    def test_details(self):
+        original = report()
+
+        # test
+        encoded = reply.encode(original, dict(details=10))
+        decoded = reply.decode(encoded)
+
+        # validation
+        rpm = decoded['details']['rpm']
+        self.assertEqual(len(rpm['details']['resolved']), 10)
+        self.assertEqual(rpm['details']['truncated'], dict(resolved=490, deps=290))
+        self.assertEqual(rpm['num_changes'], 800)
+        self.assertEqual(decoded['details']['erratum'], original['details']['erratum'])
+        self.assertEqual(len(original['details']['rpm']['details']['resolved']), 500)
@@ -0,0 +1,145 @@
+import os
+import time
+import shutil
+import tempfile
+
+from unittest import TestCase
+
+from katello import scan
+from katello.scan import ScanCache
+
+
+MAPS = '7f0000000000-7f0000001000 r-xp 00000000 fd:00 1234 %s\n'
+
+
+class TestScanCache(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.proc = os.path.join(self.tmp, 'proc')
+        self.dbpath = os.path.join(self.tmp, 'rpm')
+        self.lib = os.path.join(self.tmp, 'lib')
+        os.makedirs(self.proc)
+        os.makedirs(self.dbpath)
+        os.makedirs(self.lib)
+        self.write(os.path.join(self.proc, 'stat'), 'cpu 1 2 3\nbtime 1000\n')
+        self.write(os.path.join(self.dbpath, 'Packages'), 'rpmdb')
+        self.path = os.path.join(self.tmp, 'scan.json')
+        # Processes started long after the libraries were written.
+        self.boot = int(time.time()) + 1000
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def write(self, path, content):
+        fp = open(path, 'w')
+        fp.write(content)
+        fp.close()
+
+    def library(self, name):
+        path = os.path.join(self.lib, name)
+        self.write(path, name)
+        return path
+
+    def process(self, pid, start, *paths):
+        directory = os.path.join(self.proc, str(pid))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        stat = '%d (a (b) c) S' % pid + ' 0' * 18 + ' %d 0 0\n' % start
+        self.write(os.path.join(directory, 'stat'), stat)
+        self.write(os.path.join(directory, 'maps'), ''.join([MAPS % p for p in paths]))
+        self.write(os.path.join(directory, 'cmdline'), '/usr/bin/a\0-v\0')
+
+    def cache(self):
+        cache = ScanCache(self.path, self.proc, self.dbpath)
+        cache.ticks = 100
+        cache.boot = self.boot
+        cache.scan()
+        return cache
+
+    def test_start_time(self):
+        self.process(1, 4242)
+
+        # test
+        start = scan.start_time(self.proc, '1')
+
+        # validation
+        self.assertEqual(start, 4242)
+
+    def test_reused(self):
+        lib = self.library('libc.so')
+        self.process(1, 10, lib)
+        self.process(2, 20, lib)
+        cache = self.cache()
+        cache.save(dict(sshd={}))
+        self.process(3, 30, lib)
+
+        # test
+        cache = self.cache()
+
+        # validation
+        self.assertEqual(cache.rescanned, 1)
+        self.assertEqual(sorted(cache.processes), ['1', '2', '3'])
+        self.assertEqual(cache.apps(), dict(sshd={}))
+
+    def test_affected_exited(self):
+        lib = self.library('libc.so')
+        self.process(1, 10, lib + scan.DELETED)
+        self.process(2, 20, lib)
+        cache = self.cache()
+        self.assertEqual(cache.affected_processes(), ['1:10'])
+        cache.save(dict(sshd={}))
+        shutil.rmtree(os.path.join(self.proc, '1'))
+
+        # test
+        cache = self.cache()
+
+        # validation
+        self.assertEqual(cache.rescanned, 0)
+        self.assertEqual(cache.affected_processes(), [])
+        self.assertEqual(cache.apps(), None)
+
+    def test_package_changed(self):
+        lib = self.library('libc.so')
+        other = self.library('libm.so')
+        self.process(1, 10, lib)
+        self.process(2, 20, other)
+        self.cache().save({})
+        fp = open(os.path.join(self.dbpath, 'Packages'), 'a')
+        fp.write('changed')
+        fp.close()
+        os.remove(lib)
+
+        # test
+        cache = self.cache()
+
+        # validation
+        self.assertEqual(cache.rescanned, 1)
+        self.assertEqual(cache.apps(), None)
+
+    def test_package_changed_unused(self):
+        lib = self.library('libc.so')
+        self.process(1, 10, lib)
+        self.cache().save({})
+        fp = open(os.path.join(self.dbpath, 'Packages'), 'a')
+        fp.write('changed')
+        fp.close()
+
+        # test
+        cache = self.cache()
+
+        # validation
+        self.assertEqual(cache.rescanned, 0)
+        self.assertEqual(cache.apps(), None)
+
+    def test_rpmdb_not_found(self):
+        lib = self.library('libc.so')
+        self.process(1, 10, lib)
+        os.remove(os.path.join(self.dbpath, 'Packages'))
+        self.cache().save(dict(sshd={}))
+
+        # test
+        cache = self.cache()
+
+        # validation
+        self.assertEqual(cache.apps(), None)
@@ -0,0 +1,276 @@
+#
+# Copyright 2017 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+
+"""
+Memory soak of the goferd plugin.
+Drives the plugin API thousands of times against fake yum, rhsm and
+pulp handlers and fails when memory grows per operation.
+Growth is measured in objects tracked by the garbage collector, counted
+by type; memory held outside of python objects is not measured.
+
+The iterations are set with KATELLO_SOAK_ITERATIONS (default: 200).
+Run standalone to print the types that grew the most:
+
+    python test/test_katello/test_soak.py 5000
+"""
+
+import gc
+import os
+import sys
+import logging
+
+from unittest import TestCase
+
+from mock import patch
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../src'))
+
+
+ITERATIONS = int(os.environ.get('KATELLO_SOAK_ITERATIONS', 200))
+
+# Allowed growth (objects) per operation.
+MAX_OBJECTS = 0.5
+
+
+class Namespace(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakePlugin(object):
+    """
+    Stands in for the gofer plugin without recording calls.
+    """
+
+    def __init__(self):
+        self.cfg = Namespace(messaging=Namespace(), content=Namespace())
+
+    def attach(self):
+        pass
+
+    def detach(self):
+        pass
+
+
+class FakeCertificate(object):
+    PATH = '/tmp'
+    key = 'KEY'
+    cert = 'CERT'
+
+    def getConsumerId(self):
+        return '1234'
+
+
+class NullHandler(logging.Handler):
+
+    def emit(self, record):
+        pass
+
+
+class FakeUEP(object):
+
+    def getConsumer(self, consumer_id):
+        return dict(uuid=consumer_id)
+
+
+class FakeReport(object):
+
+    def __init__(self, units):
+        self.units = units
+
+    def dict(self):
+        return dict(succeeded=True, details=dict(rpm=dict(resolved=self.units)))
+
+
+class FakeDispatcher(object):
+    """
+    Emulates the pulp handlers: constructs and closes the plugin's
+    Yum object and, like yum, attaches handlers to yum.* loggers.
+    The parent loggers are created first, as yum does, so that none
+    of the yum.* loggers is a logging placeholder.
+    """
+
+    plugin = None
+
+    def operation(self, conduit, units, options):
+        yb = self.plugin.Yum()
+        logging.getLogger('yum')
+        logging.getLogger('yum.verbose')
+        logging.getLogger('yum.verbose.YumPlugins').addHandler(NullHandler())
+        conduit.consumer_id
+        yb.close()
+        return FakeReport(units)
+
+    install = operation
+    update = operation
+    uninstall = operation
+
+
+class FakeContext(object):
+    """
+    Stands in for the RMI context of the request being dispatched.
+    """
+
+    @staticmethod
+    def current():
+        return FakeContext()
+
+    def cancelled(self):
+        return False
+
+
+def no_op(*args, **kwargs):
+    pass
+
+
+class FakeChild(object):
+    """
+    Stands in for the upload command process.
+    """
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def wait(self):
+        return 0
+
+
+def rhsm_conf(path):
+    return {
+        'server': {'hostname': 'katello.example.com'},
+        'rhsm': {'ca_cert_dir': '/etc/rhsm/ca/', 'repo_ca_cert': __file__},
+    }
+
+
+class Soak(object):
+    """
+    Measures memory growth of repeated operations in objects
+    tracked by the garbage collector.
+    """
+
+    def __init__(self, operations, iterations=ITERATIONS, warmup=20):
+        self.operations = operations
+        self.iterations = iterations
+        self.warmup = warmup
+
+    @staticmethod
+    def objects():
+        counts = {}
+        for obj in gc.get_objects():
+            name = type(obj).__name__
+            counts[name] = counts.get(name, 0) + 1
+        return counts
+
+    def run(self):
+        """
+        :return: (objects per operation, top types)
+        :rtype: tuple
+        """
+        ops = len(self.operations) * self.iterations
+        for n in range(self.warmup):
+            self.cycle()
+        gc.collect()
+        before = self.objects()
+        for n in range(self.iterations):
+            self.cycle()
+        gc.collect()
+        after = self.objects()
+        diff = [(after[k] - before.get(k, 0), k) for k in after]
+        diff.sort(reverse=True)
+        growth = sum([d for d, k in diff])
+        top = ['%s: %+d objects' % (k, d) for d, k in diff[:10] if d]
+        return float(growth) / ops, top
+
+    def cycle(self):
+        for fn in self.operations:
+            fn()
+
+
+class PluginSoak(object):
+    """
+    The plugin loaded with fake dependencies.
+    """
+
+    def __init__(self):
+        plugin = __import__('katello.agent.katelloplugin', {}, {}, ['katelloplugin'])
+        reload(plugin)
+        plugin.plugin = FakePlugin()
+        plugin.registered = True
+        FakeDispatcher.plugin = plugin
+        self.plugin = plugin
+        self.patches = [
+            patch('katello.agent.katelloplugin.Dispatcher', FakeDispatcher),
+            patch('katello.agent.katelloplugin.UEP', FakeUEP),
+            patch('katello.agent.katelloplugin.Config', rhsm_conf),
+            patch('katello.agent.katelloplugin.Context', FakeContext),
+            patch('katello.agent.katelloplugin.bundle', no_op),
+            patch('katello.agent.katelloplugin.ConsumerIdentity.read', staticmethod(FakeCertificate)),
+            patch('katello.agent.katelloplugin.ConsumerIdentity.existsAndValid', staticmethod(lambda: True)),
+            patch('katello.agent.katelloplugin.YumBase.__init__', no_op),
+            patch('katello.agent.katelloplugin.YumBase.close', no_op),
+            patch('katello.agent.katelloplugin.YumBase.closeRpmDB', no_op),
+            patch('katello.agent.katelloplugin.Popen', FakeChild),
+        ]
+
+    def start(self):
+        for p in self.patches:
+            p.start()
+
+    def stop(self):
+        for p in self.patches:
+            p.stop()
+
+    def operations(self):
+        content = self.plugin.Content()
+        units = [dict(type_id='rpm', unit_key=dict(name='zsh'))]
+        return [
+            lambda: content.install(units, {}),
+            lambda: content.update(units, {}),
+            lambda: content.uninstall(units, {}),
+            lambda: self.plugin.certificate_changed('/etc/pki/consumer/cert.pem'),
+            lambda: self.plugin.send_enabled_report(),
+        ]
+
+
+class TestSoak(TestCase):
+
+    def test_soak(self):
+        soak = PluginSoak()
+        soak.start()
+        try:
+            growth, top = Soak(soak.operations()).run()
+        finally:
+            soak.stop()
+        self.assertTrue(
+            growth <= MAX_OBJECTS,
+            'memory grew %.2f objects/operation:\n%s' % (growth, '\n'.join(top)))
+
+
+def main():
+    iterations = ITERATIONS
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+    soak = PluginSoak()
+    soak.start()
+    try:
+        growth, top = Soak(soak.operations(), iterations).run()
+    finally:
+        soak.stop()
+    print 'growth: %.2f objects/operation' % growth
+    for site in top:
+        print '  %s' % site
+
+
+if __name__ == '__main__':
+    main()
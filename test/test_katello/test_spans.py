@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+
+from unittest import TestCase
+
+from mock import patch
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from katello import spans
+
+
+class TestSpans(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'log', 'spans.log')
+
+    def tearDown(self):
+        spans.disable()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def records(self):
+        return [json.loads(line) for line in open(self.path)]
+
+    def test_nested(self):
+        spans.enable(self.path)
+
+        @spans.traced('outer')
+        def outer():
+            return spans.call('inner', lambda n: n * 2, 21)
+
+        # test
+        result = outer()
+
+        # validation
+        self.assertEqual(result, 42)
+        inner, outer = self.records()
+        self.assertEqual(inner['name'], 'inner')
+        self.assertEqual(outer['name'], 'outer')
+        self.assertEqual(inner['parent'], outer['id'])
+        self.assertEqual(outer['parent'], None)
+        self.assertTrue(outer['duration'] >= inner['duration'])
+
+    def test_error(self):
+        spans.enable(self.path)
+
+        def fail():
+            raise ValueError('bad')
+
+        # test
+        self.assertRaises(ValueError, spans.call, 'failed', fail)
+        spans.call('next', lambda: None)
+
+        # validation
+        failed, next = self.records()
+        self.assertEqual(failed['error'], 'ValueError: bad')
+        self.assertEqual(next['parent'], None)
+
+    def test_disabled(self):
+        # test
+        result = spans.call('ignored', lambda: 1)
+
+        # validation
+        self.assertEqual(result, 1)
+        self.assertFalse(os.path.exists(self.path))
+
+    @patch('katello.spans.enable')
+    def test_configured(self, enable):
+        os.environ[spans.ENVIRONMENT] = '1'
+        try:
+            # test
+            spans.configured(None)
+            spans.configured(False)
+        finally:
+            del os.environ[spans.ENVIRONMENT]
+
+        # validation
+        enable.assert_called_once_with()
@@ -0,0 +1,71 @@
+import zlib
+
+from StringIO import StringIO
+from unittest import TestCase
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from katello import stream
+
+
+class Entries(object):
+
+    def __init__(self, count):
+        self.count = count
+
+    def __iter__(self):
+        for n in xrange(self.count):
+            yield dict(name=u'package-%d-\xe9' % n, epoch=n % 2, version='1.0', vendor=None)
+
+
+class TestStream(TestCase):
+
+    def test_iterencode(self):
+        document = dict(
+            traces={},
+            repos=[],
+            enabled_repos=dict(repos=[dict(repositoryid='a', baseurl=['x', 'y'])]),
+            entries=Entries(3),
+            nested=(1, [2.5, True, None], u'\u2603'))
+
+        # test
+        encoded = ''.join(stream.iterencode(document))
+
+        # validation
+        decoded = json.loads(encoded)
+        expected = json.loads(json.dumps(dict(document, entries=list(Entries(3)))))
+        self.assertEqual(decoded, expected)
+
+    def test_chunks(self):
+        pieces = stream.iterencode(Entries(2000))
+
+        # test
+        chunks = list(stream.chunks(pieces, size=4096))
+
+        # validation
+        self.assertTrue(len(chunks) > 10)
+        self.assertTrue(max(map(len, chunks)) < 4096 * 2)
+        self.assertEqual(json.loads(''.join(chunks)), list(Entries(2000)))
+
+    def test_compressed(self):
+        pieces = stream.iterencode(Entries(2000))
+
+        # test
+        compressed = ''.join(stream.chunks(pieces, compress=True))
+
+        # validation
+        text = zlib.decompress(compressed, 16 + zlib.MAX_WBITS)
+        self.assertEqual(json.loads(text), list(Entries(2000)))
+        self.assertTrue(len(compressed) * 5 < len(text))
+
+    def test_dump(self):
+        fp = StringIO()
+
+        # test
+        stream.dump(Entries(10), fp)
+
+        # validation
+        self.assertEqual(json.loads(fp.getvalue()), list(Entries(10)))
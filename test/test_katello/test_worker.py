@@ -0,0 +1,132 @@
+#
+# Copyright 2017 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+
+import os
+import sys
+import time
+
+from unittest import TestCase
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../src'))
+
+from katello.agent.worker import Worker, WorkerFailed
+
+
+def worker(script, **kwargs):
+    w = Worker(**kwargs)
+    w.COMMAND = [sys.executable, '-c', script]
+    return w
+
+
+class TestWorker(TestCase):
+
+    def test_report(self):
+        script = (
+            'import os, sys, json\n'
+            'request = json.loads(sys.stdin.read())\n'
+            'reply = os.fdopen(os.dup(1), "w")\n'
+            'os.dup2(2, 1)\n'
+            'print "noise written by a handler"\n'
+            'reply.write(json.dumps(dict(result=request)))\n')
+
+        # test
+        report = worker(script)('install', [{'A': 1}], {'B': 2})
+
+        # validation
+        self.assertEqual(report, dict(method='install', units=[{'A': 1}], options={'B': 2}))
+
+    def test_error(self):
+        script = 'import json; print json.dumps(dict(error="failed"))'
+
+        # test and validation
+        self.assertRaises(WorkerFailed, worker(script), 'install', [], {})
+
+    def test_crashed(self):
+        script = 'import os; os.abort()'
+
+        # test and validation
+        self.assertRaises(WorkerFailed, worker(script), 'install', [], {})
+
+    def test_timeout(self):
+        script = 'import time; time.sleep(30)'
+
+        # test and validation
+        self.assertRaises(WorkerFailed, worker(script, timeout=1), 'update', [], {})
+
+    def test_timeout_terminated(self):
+        script = (
+            'import os, sys, json, signal, time\n'
+            'def terminate(*args):\n'
+            '    sys.stdout.write(json.dumps(dict(result=signals)))\n'
+            '    sys.stdout.flush()\n'
+            '    os._exit(0)\n'
+            'signals = []\n'
+            'signal.signal(signal.SIGUSR1, lambda *args: signals.append("cancel"))\n'
+            'signal.signal(signal.SIGTERM, terminate)\n'
+            'sys.stdin.read()\n'
+            'while True:\n'
+            '    time.sleep(0.1)\n')
+        w = worker(script, timeout=1)
+        w.GRACE = 1
+
+        # test
+        report = w('update', [], {})
+
+        # validation
+        self.assertEqual(report, ['cancel'])
+        self.assertTrue(w.expired)
+
+    def test_timeout_killed(self):
+        script = (
+            'import sys, signal, time\n'
+            'signal.signal(signal.SIGUSR1, signal.SIG_IGN)\n'
+            'signal.signal(signal.SIGTERM, signal.SIG_IGN)\n'
+            'sys.stdin.read()\n'
+            'time.sleep(30)\n')
+        w = worker(script, timeout=1)
+        w.GRACE = 1
+        started = time.time()
+
+        # test and validation
+        self.assertRaises(WorkerFailed, w, 'update', [], {})
+        self.assertTrue(time.time() - started < 10)
+
+    def test_cancelled(self):
+        script = (
+            'import os, sys, json, signal, time\n'
+            'def cancel(*args):\n'
+            '    sys.stdout.write(json.dumps(dict(result="cancelled")))\n'
+            '    sys.stdout.flush()\n'
+            '    os._exit(0)\n'
+            'signal.signal(signal.SIGUSR1, cancel)\n'
+            'sys.stdin.read()\n'
+            'time.sleep(30)\n')
+        calls = []
+
+        def cancelled():
+            calls.append(1)
+            return len(calls) > 1
+
+        # test
+        report = worker(script, timeout=20, cancelled=cancelled)('install', [], {})
+
+        # validation
+        self.assertEqual(report, 'cancelled')
+        self.assertEqual(len(calls), 2)
+
+    def test_exited_before_request(self):
+        script = 'import os, time; os.close(0); time.sleep(30)'
+        units = [{'A': 'x' * 1048576}]
+
+        # test and validation
+        self.assertRaises(WorkerFailed, worker(script), 'install', units, {})
@@ -12,6 +12,7 @@ sys.path.append(os.path.join(os.path.dirname(__file__), '../../src/yum-plugins/'
 
 import enabled_repos_upload
 from enabled_repos_upload import UEP
+from katello.breaker import RequestFailed
 
 FAKE_REPORT = {'foobar': 1}
 
@@ -61,3 +62,21 @@ class TestSendEnabledReport(TestCase):
         fake_report.assert_called_with('/etc/yum.repos.d/redhat.repo')
         fake_certificate.getConsumerId.assert_called_with()
         fake_report_enabled.assert_not_called()
+
+    @patch('enabled_repos_upload.error_message')
+    @patch('enabled_repos_upload.EnabledRepoCache.acknowledged', Mock(return_value=None))
+    @patch('enabled_repos_upload.EnabledRepoCache.is_valid')
+    @patch('enabled_repos_upload.EnabledRepoCache.save')
+    def test_failed(self, cache_save, cache_valid, error_message):
+        cache_valid.return_value = False
+        report = Mock(content=FAKE_REPORT)
+        uep = Mock()
+        uep.report_enabled.side_effect = RequestFailed(httplib.INTERNAL_SERVER_ERROR, 'failed')
+
+        # test
+        enabled_repos_upload.upload_enabled_repos_report(report, uep, '1234')
+
+        # validation
+        uep.report_enabled.assert_called_with('1234', FAKE_REPORT)
+        error_message.assert_called_with('500 failed')
+        self.assertFalse(cache_save.called)
@@ -0,0 +1,5 @@
+import os
+import time
+
+# The subscription-manager stack is slow to import.
+time.sleep(float(os.environ.get('IMPORT_DELAY', 0)))
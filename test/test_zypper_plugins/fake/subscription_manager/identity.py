@@ -0,0 +1,5 @@
+class ConsumerIdentity(object):
+
+    @staticmethod
+    def read():
+        raise IOError('not registered')
@@ -0,0 +1,51 @@
+"""
+Stands in for zypp_plugin: the zypper plugin protocol.
+Frames are read from stdin and written to stdout as:
+  <command>\n<name>:<value>\n...\n\n<body>\0
+"""
+
+import sys
+
+
+class Plugin(object):
+
+    def read(self):
+        command = sys.stdin.readline()
+        if not command:
+            return None
+        headers = {}
+        while True:
+            line = sys.stdin.readline().rstrip('\n')
+            if not line:
+                break
+            name, value = line.split(':', 1)
+            headers[name] = value
+        body = []
+        while True:
+            c = sys.stdin.read(1)
+            if not c or c == '\0':
+                break
+            body.append(c)
+        return command.strip(), headers, ''.join(body)
+
+    def answer(self, command, headers=None, body=''):
+        lines = [command]
+        for item in (headers or {}).items():
+            lines.append('%s:%s' % item)
+        sys.stdout.write('\n'.join(lines) + '\n\n' + body + '\0')
+        sys.stdout.flush()
+
+    def ack(self, headers=None, body=''):
+        self.answer('ACK', headers, body)
+
+    def main(self):
+        while True:
+            frame = self.read()
+            if frame is None:
+                break
+            command, headers, body = frame
+            method = getattr(self, command, None)
+            if method is None:
+                self.answer('_ENOMETHOD')
+            else:
+                method(headers, body)
@@ -0,0 +1,75 @@
+import os
+import sys
+import time
+
+from subprocess import Popen, PIPE
+from unittest import TestCase
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+PLUGIN = os.path.join(HERE, '../../src/zypper-plugins/package_upload.py')
+
+# The fake zypp_plugin, subscription_manager and rhsm.
+FAKE = os.path.join(HERE, 'fake')
+
+# Seconds the fake subscription-manager stack takes to import.
+IMPORT_DELAY = 1.0
+
+
+class Zypper(object):
+    """
+    Runs the plugin as zypper does and exchanges protocol frames.
+    """
+
+    def __init__(self):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([FAKE, os.path.join(HERE, '../../src')])
+        env['IMPORT_DELAY'] = str(IMPORT_DELAY)
+        env.pop('DISABLE_KATELLO_ZYPP_PLUGIN', None)
+        self.child = Popen([sys.executable, PLUGIN], stdin=PIPE, stdout=PIPE, env=env)
+
+    def send(self, command, headers=None):
+        lines = [command]
+        for item in (headers or {}).items():
+            lines.append('%s:%s' % item)
+        self.child.stdin.write('\n'.join(lines) + '\n\n\0')
+        self.child.stdin.flush()
+        return self.receive()
+
+    def receive(self):
+        frame = []
+        while True:
+            c = self.child.stdout.read(1)
+            if not c or c == '\0':
+                break
+            frame.append(c)
+        return ''.join(frame).split('\n')[0]
+
+    def close(self):
+        self.child.stdin.close()
+        return self.child.wait()
+
+
+class TestPlugin(TestCase):
+
+    def test_fast_ack(self):
+        zypper = Zypper()
+        try:
+            # test
+            started = time.time()
+            begin = zypper.send('PLUGINBEGIN', dict(userdata='a=b'))
+            acked = time.time() - started
+            commit = zypper.send('COMMITBEGIN')
+            started = time.time()
+            end = zypper.send('PLUGINEND')
+            uploaded = time.time() - started
+        finally:
+            status = zypper.close()
+
+        # validation
+        self.assertEqual(begin, 'ACK')
+        self.assertEqual(commit, 'ACK')
+        self.assertEqual(end, 'ACK')
+        self.assertEqual(status, 0)
+        self.assertTrue(acked < IMPORT_DELAY, 'first ack after %.2f seconds' % acked)
+        self.assertTrue(uploaded >= IMPORT_DELAY)